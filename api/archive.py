@@ -0,0 +1,223 @@
+'''
+  流式 zip 打包
+
+  直接从源文件生成 zip 数据写入 http 响应, 不需要先复制到临时目录再压缩
+  - 所有条目都使用 STORED(图片本身已经压缩过, 标签文本很小), 因此 zip 的总大小以及每个条目的位置在开始之前就可以算出来
+  - 生成的内容是确定的(顺序, 时间戳都来自源文件), 可以支持 Range 请求, 实现断点续传
+  - CRC 写在每个条目之后的 data descriptor 中, 边读边算; 跳过的条目也需要读取一次计算 CRC, 结果按照 mtime + size 缓存
+  - 文件或者偏移超过 4GB, 条目超过 65535 个时自动使用 zip64
+'''
+
+from collections import OrderedDict
+import threading
+import hashlib
+import struct
+import time
+import zlib
+
+
+CHUNK_SIZE = 1024 * 1024
+MAX_CRC_CACHE = 100000
+
+_crc_cache: OrderedDict[tuple, int] = OrderedDict()
+_crc_lock = threading.Lock()
+
+ZIP64_LIMIT = 0xFFFFFFFF
+
+
+def _dos_time(mtime: float) -> tuple[int, int]:
+  t = time.localtime(mtime)
+  if t.tm_year < 1980:
+    t = time.localtime(315532800) # 1980-01-01
+  date = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+  dtime = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+  return dtime, date
+
+
+class Entry:
+  def __init__(self, arcname: str, size: int, mtime: float, path: str | None = None, data: bytes | None = None):
+    self.arcname = arcname.encode('utf-8')
+    self.size = size
+    self.mtime = mtime
+    self.path = path    # 来自文件
+    self.data = data    # 来自内存
+    self.offset = 0     # 本地文件头在 zip 中的偏移
+    self.crc = zlib.crc32(data) if data is not None else None
+
+  @property
+  def zip64(self) -> bool:
+    return self.size >= ZIP64_LIMIT
+
+  def local_header(self) -> bytes:
+    dtime, date = _dos_time(self.mtime)
+    extra = b''
+    version = 20
+    if self.zip64:
+      # 使用 data descriptor 时本地文件头中的大小为 0, zip64 extra 中同样为 0
+      extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+      version = 45
+    # 0x08: 大小与 CRC 在 data descriptor 中; 0x800: 文件名为 utf-8
+    header = struct.pack('<IHHHHHIIIHH', 0x04034b50, version, 0x0808, 0, dtime, date,
+      0, 0xFFFFFFFF if self.zip64 else 0, 0xFFFFFFFF if self.zip64 else 0, len(self.arcname), len(extra))
+    return header + self.arcname + extra
+
+  def local_header_size(self) -> int:
+    return 30 + len(self.arcname) + (20 if self.zip64 else 0)
+
+  def descriptor(self) -> bytes:
+    if self.zip64:
+      return struct.pack('<IIQQ', 0x08074b50, self.crc, self.size, self.size)
+    return struct.pack('<IIII', 0x08074b50, self.crc, self.size, self.size)
+
+  def descriptor_size(self) -> int:
+    return 24 if self.zip64 else 16
+
+  def _central_extra(self) -> bytes:
+    fields = []
+    if self.size >= ZIP64_LIMIT:
+      fields += [self.size, self.size]
+    if self.offset >= ZIP64_LIMIT:
+      fields.append(self.offset)
+    if len(fields) <= 0:
+      return b''
+    return struct.pack(f'<HH{len(fields)}Q', 0x0001, 8 * len(fields), *fields)
+
+  def central_header(self) -> bytes:
+    dtime, date = _dos_time(self.mtime)
+    extra = self._central_extra()
+    version = 45 if len(extra) > 0 else 20
+    size = 0xFFFFFFFF if self.size >= ZIP64_LIMIT else self.size
+    offset = 0xFFFFFFFF if self.offset >= ZIP64_LIMIT else self.offset
+    header = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, 0x0808, 0, dtime, date,
+      self.crc, size, size, len(self.arcname), len(extra), 0, 0, 0, 0, offset)
+    return header + self.arcname + extra
+
+  def central_header_size(self) -> int:
+    return 46 + len(self.arcname) + len(self._central_extra())
+
+  def compute_crc(self) -> int:
+    if self.crc is None:
+      key = (self.path, self.mtime, self.size)
+      with _crc_lock:
+        crc = _crc_cache.get(key)
+      if crc is None:
+        crc = 0
+        with open(self.path, 'rb') as f:
+          while chunk := f.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+        _cache_crc(key, crc)
+      self.crc = crc
+    return self.crc
+
+
+def _cache_crc(key: tuple, crc: int):
+  with _crc_lock:
+    _crc_cache[key] = crc
+    _crc_cache.move_to_end(key)
+    while len(_crc_cache) > MAX_CRC_CACHE:
+      _crc_cache.popitem(last=False)
+
+
+class ZipStream:
+  '''
+    entries 确定之后即可得到 zip 的总大小, iter_bytes(start, end) 生成 [start, end) 范围内的数据
+  '''
+  def __init__(self, entries: list[Entry]):
+    self.entries = entries
+    offset = 0
+    for entry in entries:
+      entry.offset = offset
+      offset += entry.local_header_size() + entry.size + entry.descriptor_size()
+    self.central_offset = offset
+    self.central_size = sum(entry.central_header_size() for entry in entries)
+    self.zip64 = (len(entries) >= 0xFFFF or self.central_offset >= ZIP64_LIMIT
+      or self.central_size >= ZIP64_LIMIT)
+    self.size = self.central_offset + self.central_size + (56 + 20 if self.zip64 else 0) + 22
+
+  def etag(self) -> str:
+    h = hashlib.sha1()
+    for entry in self.entries:
+      h.update(entry.arcname)
+      h.update(struct.pack('<Qd', entry.size, entry.mtime))
+      if entry.data is not None:
+        h.update(struct.pack('<I', entry.crc))
+    return f'"{h.hexdigest()}"'
+
+  def _end_records(self) -> bytes:
+    count = len(self.entries)
+    records = b''
+    if self.zip64:
+      zip64_eocd_offset = self.central_offset + self.central_size
+      records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+        count, count, self.central_size, self.central_offset)
+      records += struct.pack('<IIQI', 0x07064b50, 0, zip64_eocd_offset, 1)
+    records += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0,
+      min(count, 0xFFFF), min(count, 0xFFFF),
+      min(self.central_size, ZIP64_LIMIT), min(self.central_offset, ZIP64_LIMIT), 0)
+    return records
+
+  def _read_file(self, entry: Entry, start: int, end: int):
+    '''
+      读取 entry 数据中 [start, end) 的部分, 读取整个文件时顺便计算 CRC
+    '''
+    with open(entry.path, 'rb') as f:
+      if start > 0 or end < entry.size or entry.crc is not None:
+        f.seek(start)
+        remain = end - start
+        while remain > 0:
+          chunk = f.read(min(CHUNK_SIZE, remain))
+          if not chunk:
+            raise IOError(f'{entry.path} changed while exporting')
+          remain -= len(chunk)
+          yield chunk
+        return
+      crc = 0
+      position = 0
+      while chunk := f.read(CHUNK_SIZE):
+        crc = zlib.crc32(chunk, crc)
+        position += len(chunk)
+        yield chunk
+      if position != entry.size:
+        raise IOError(f'{entry.path} changed while exporting')
+      entry.crc = crc
+      _cache_crc((entry.path, entry.mtime, entry.size), crc)
+
+  def iter_bytes(self, start: int = 0, end: int | None = None):
+    end = self.size if end is None else end
+
+    def clip(data: bytes, offset: int):
+      # 返回 data(位于 offset) 与 [start, end) 的交集
+      lo, hi = max(start, offset), min(end, offset + len(data))
+      return data[lo - offset:hi - offset] if lo < hi else b''
+
+    for entry in self.entries:
+      if entry.offset >= end:
+        return
+      offset = entry.offset
+      header = entry.local_header()
+      if chunk := clip(header, offset):
+        yield chunk
+      offset += len(header)
+      lo, hi = max(start, offset), min(end, offset + entry.size)
+      if lo < hi:
+        if entry.data is not None:
+          yield entry.data[lo - offset:hi - offset]
+        else:
+          yield from self._read_file(entry, lo - offset, hi - offset)
+      offset += entry.size
+      if end > offset and start < offset + entry.descriptor_size():
+        entry.compute_crc()
+        if chunk := clip(entry.descriptor(), offset):
+          yield chunk
+
+    if end <= self.central_offset:
+      return
+    offset = self.central_offset
+    for entry in self.entries:
+      size = entry.central_header_size()
+      if offset + size > start and offset < end:
+        entry.compute_crc()
+        yield clip(entry.central_header(), offset)
+      offset += size
+    if chunk := clip(self._end_records(), offset):
+      yield chunk
@@ -0,0 +1,82 @@
+'''
+  进程内的 LRU 缓存
+
+  按照值的字节数限制总大小, 超过容量时淘汰最久没有使用的条目
+  每个条目带有版本号(例如图片的 mtime + size), 读取时版本不一致视为未命中并删除, 不会返回过期的内容
+  可以在事件循环与线程池中同时使用
+'''
+
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+import threading
+
+
+class LRUCache:
+  def __init__(self, capacity: int):
+    self.capacity = capacity  # 字节, 0 表示不缓存
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries: OrderedDict[Hashable, tuple[Any, Any, int]] = OrderedDict()  # key: (version, value, size)
+    self._lock = threading.Lock()
+
+  def get(self, key: Hashable, version: Any = None) -> Any | None:
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] == version:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+      if entry is not None:
+        self._remove(key)
+      self.misses += 1
+      return None
+
+  def put(self, key: Hashable, value: Any, size: int, version: Any = None):
+    # 超过容量 1/8 的条目不缓存, 避免一次挤掉大量条目
+    if size > self.capacity // 8:
+      return
+    with self._lock:
+      if key in self._entries:
+        self._remove(key)
+      self._entries[key] = (version, value, size)
+      self.size += size
+      while self.size > self.capacity:
+        self._remove(next(iter(self._entries)))
+        self.evictions += 1
+
+  def _remove(self, key: Hashable):
+    _, _, size = self._entries.pop(key)
+    self.size -= size
+
+  def pop(self, key: Hashable):
+    with self._lock:
+      if key in self._entries:
+        self._remove(key)
+
+  def discard(self, predicate: Callable[[Hashable], bool]):
+    '''
+      删除所有 predicate(key) 为 True 的条目
+    '''
+    with self._lock:
+      for key in [key for key in self._entries if predicate(key)]:
+        self._remove(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.size = 0
+
+  def stats(self) -> dict:
+    with self._lock:
+      total = self.hits + self.misses
+      return {
+        'entries': len(self._entries),
+        'size': self.size,
+        'capacity': self.capacity,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': self.hits / total if total > 0 else None,
+      }
@@ -0,0 +1,321 @@
+'''
+  标签存储
+
+  标签以索引(catalog 的 caption 表)为准, 读取时不再打开图片的 exif
+  保存标签只写入索引并标记为 dirty, 由后台线程延迟 caption_flush_delay 秒之后批量写回图片 exif 与同名 txt 文件,
+  短时间内对同一张图片的多次保存只会写一次文件
+    POST /caption/flush     立即写回所有等待的标签
+    POST /caption/migrate   从 exif/txt 批量导入标签(已有数据集第一次使用, 或者在外部修改了文件之后)
+    GET  /caption/check     检查索引与 exif, txt 是否一致, repair=true 时以索引为准重新写回
+    GET  /caption/status    等待写回的数量
+  移动, 重命名与删除图片文件时需要持有 file_lock, 避免与写回同时进行
+'''
+
+from fastapi import APIRouter, HTTPException
+from concurrent.futures import ProcessPoolExecutor
+from .config import CONF_REPO_DIR, CONF_CAPTION_FLUSH_DELAY, CONF_CAPTION_WORKERS
+from .importer import IMAGE_EXTENSIONS
+from .job import progress
+from . import job
+from . import catalog
+import threading
+import json
+import time
+import os
+
+
+api_caption = APIRouter()
+
+PARALLEL_WRITE_MIN = 16 # 少量图片直接在当前线程写回, 避免启动进程池的开销
+
+file_lock = threading.RLock()
+_flush_event = threading.Event()
+_writer_thread: threading.Thread | None = None
+_writer_lock = threading.Lock()
+
+
+def read_exif_caption(abs_path: str) -> list[str] | None:
+  '''
+    读取 exif 注释中的标签, 没有注释或者无法解析时返回 None
+  '''
+  import pyexiv2
+  try:
+    metadata = pyexiv2.Image(abs_path)
+    tags = metadata.read_comment()
+    metadata.close()
+  except Exception as e:
+    # 这里会报异常 XMP Toolkit error 203: Duplicate property or field node
+    # 是否应该 clear, 目前只能够使用 exiftool 手动删除
+    print(abs_path)
+    print('exception', e)
+    return None
+  try:
+    tags = json.loads(tags)
+  except:
+    return None
+  return tags if isinstance(tags, list) else None
+
+
+def txt_path(abs_path: str) -> str:
+  name, _ = os.path.splitext(abs_path)
+  return f'{name}.txt'
+
+
+def read_txt_caption(abs_path: str) -> str | None:
+  try:
+    with open(txt_path(abs_path), 'r', encoding='utf-8') as f:
+      return f.read()
+  except OSError:
+    return None
+
+
+def parse_txt_caption(s: str) -> list[str]:
+  return [tag.strip() for tag in s.split(',') if tag.strip()]
+
+
+def read_file_caption(abs_path: str) -> list[str]:
+  '''
+    从文件中读取标签, exif 优先, 其次是同名 txt 文件
+  '''
+  tags = read_exif_caption(abs_path)
+  if tags is None:
+    s = read_txt_caption(abs_path)
+    tags = parse_txt_caption(s) if s is not None else []
+  return tags
+
+
+def read_file_captions(abs_path: str) -> tuple[list[str] | None, str | None]:
+  '''
+    在子进程中执行, 返回 (exif 中的标签, txt 文件内容)
+  '''
+  return read_exif_caption(abs_path), read_txt_caption(abs_path)
+
+
+def write_file_caption(abs_path: str, tags: list[str]):
+  '''
+    将标签写入图片 exif 注释与同名 txt 文件, 失败时抛出异常
+  '''
+  import pyexiv2
+  metadata = pyexiv2.Image(abs_path)
+  try:
+    metadata.modify_comment(json.dumps(tags))
+  finally:
+    metadata.close()
+  with open(txt_path(abs_path), 'w', encoding='utf-8') as f:
+    f.write(", ".join(tags))
+
+
+def _write(abs_path: str, captions: str) -> str | None:
+  '''
+    在子进程中执行, captions 为 json, 返回错误信息
+  '''
+  try:
+    write_file_caption(abs_path, json.loads(captions))
+  except Exception as e:
+    return str(e)
+  return None
+
+
+def load_captions(paths: list[str]) -> dict[str, list[str]]:
+  return catalog.get_captions(paths)
+
+
+def save_captions(captions: dict[str, list[str]]) -> list[str]:
+  '''
+    保存标签, 只写入索引, 文件在后台写回
+    return 实际发生变化的 path
+  '''
+  changed = catalog.set_captions(captions)
+  if len(changed) > 0:
+    _flush_event.set()
+  return changed
+
+
+def rewrite(paths: list[str]):
+  '''
+    图片被重新编码(exif 已经丢失)之后调用, 由后台线程将索引中的标签重新写回文件
+    调用方需要持有 file_lock, 避免后台线程在替换文件之前写回
+  '''
+  catalog.mark_dirty(paths)
+  _flush_event.set()
+
+
+def save(captions: dict[str, list[str]], sync: bool = False) -> dict[str, dict]:
+  '''
+    批量保存标签, 与索引中相同的标签会被跳过
+    sync 为 True 时立即写回发生变化的图片, 否则由后台线程写回
+    return { path: { status: 'saved' | 'unchanged' | 'failed', error: str | None } }
+  '''
+  results = {}
+  valid = {}
+  for path, tags in captions.items():
+    if not os.path.isfile(os.path.join(CONF_REPO_DIR, path)):
+      results[path] = { 'status': 'failed', 'error': 'image not found' }
+      continue
+    valid[path] = tags
+  changed = set(save_captions(valid))
+  for path in valid:
+    results[path] = { 'status': 'saved' if path in changed else 'unchanged', 'error': None }
+  if sync and len(changed) > 0:
+    keys = { os.path.normpath(path).replace('\\', '/'): path for path in changed }
+    for key, error in flush(list(keys.keys())).items():
+      if error is not None and key in keys:
+        results[keys[key]] = { 'status': 'failed', 'error': error }
+  return results
+
+
+def flush(paths: list[str] | None = None) -> dict[str, str | None]:
+  '''
+    将等待的标签写回文件, paths 为 None 时写回所有, 图片较多时在进程池中并行写入
+    return { path: 错误信息或者 None }
+  '''
+  results = {}
+  with file_lock:
+    dirty = []
+    for path, captions in catalog.get_dirty(paths):
+      if not os.path.isfile(os.path.join(CONF_REPO_DIR, path)):
+        # 图片已经不存在, 丢弃标签
+        catalog.remove_images([path])
+        results[path] = 'image not found'
+        continue
+      dirty.append((path, captions))
+    abs_paths = [os.path.join(CONF_REPO_DIR, path) for path, _ in dirty]
+    values = [captions for _, captions in dirty]
+    if len(dirty) >= PARALLEL_WRITE_MIN:
+      with ProcessPoolExecutor(max_workers=max(1, min(CONF_CAPTION_WORKERS, len(dirty)))) as executor:
+        errors = list(executor.map(_write, abs_paths, values, chunksize=16))
+    else:
+      errors = [_write(abs_path, value) for abs_path, value in zip(abs_paths, values)]
+    written = []
+    for (path, captions), error in zip(dirty, errors):
+      results[path] = error
+      if error is not None:
+        print(path, error)
+        continue
+      written.append((path, captions))
+    catalog.mark_clean(written)
+  return results
+
+
+def _writer():
+  while True:
+    _flush_event.wait()
+    _flush_event.clear()
+    # 等待一段时间, 合并短时间内的多次保存
+    time.sleep(CONF_CAPTION_FLUSH_DELAY)
+    try:
+      flush()
+    except Exception as e:
+      print('fail to write captions', e)
+
+
+def start():
+  '''
+    启动后台写回线程, 由 launch.py 在启动时调用; 进程池中的子进程也会导入本模块, 不能在导入时启动
+  '''
+  global _writer_thread
+  with _writer_lock:
+    if _writer_thread is not None:
+      return
+    # 写回上次退出前没有写回的标签
+    _flush_event.set()
+    _writer_thread = threading.Thread(target=_writer, name='caption-writer', daemon=True)
+    _writer_thread.start()
+
+
+def list_images(imageset_name: str) -> list[str]:
+  '''
+    imageset 下的所有图片, 从 imageset-xxx 开始
+  '''
+  base_dir = 'imageset-' + imageset_name
+  if not os.path.exists(os.path.join(CONF_REPO_DIR, base_dir)):
+    raise HTTPException(status_code=404, detail=f'imageset {imageset_name} is not found')
+  result = []
+  for dirpath, dirnames, filenames in os.walk(os.path.join(CONF_REPO_DIR, base_dir)):
+    dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+    for filename in sorted(filenames):
+      if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+        result.append(os.path.relpath(os.path.join(dirpath, filename), CONF_REPO_DIR).replace('\\', '/'))
+  return result
+
+
+def _read_all(paths: list[str], desc: str):
+  abs_paths = [os.path.join(CONF_REPO_DIR, path) for path in paths]
+  if len(paths) <= 0:
+    return
+  with ProcessPoolExecutor(max_workers=max(1, min(CONF_CAPTION_WORKERS, len(paths)))) as executor:
+    results = executor.map(read_file_captions, abs_paths, chunksize=16)
+    yield from progress(zip(paths, results), total=len(paths), desc=desc)
+
+
+def migrate(imageset_name: str, force: bool = False) -> dict:
+  '''
+    从 exif/txt 批量导入标签, force 为 False 时只导入没有记录的图片
+  '''
+  images = list_images(imageset_name)
+  if not force:
+    stored = catalog.list_captions('imageset-' + imageset_name)
+    images = [path for path in images if path not in stored]
+  captions = {}
+  for path, (exif, txt) in _read_all(images, 'migrate captions'):
+    captions[path] = exif if exif is not None else parse_txt_caption(txt) if txt is not None else []
+  imported = catalog.import_captions(captions, force=force)
+  return { 'scanned': len(images), 'imported': imported }
+
+
+def check(imageset_name: str, repair: bool = False) -> dict:
+  '''
+    检查索引中的标签与 exif, txt 是否一致
+    return {
+      checked: int, dirty: int,
+      mismatched: [{ path, captions, exif, txt }],  // 已经写回但是文件内容与索引不一致
+      missing: [path],                              // 没有标签记录的图片
+      orphaned: [path],                             // 图片已经不存在的标签记录
+    }
+    repair 为 True 时删除 orphaned, 导入 missing, 并以索引为准重新写回 mismatched
+  '''
+  images = list_images(imageset_name)
+  stored = catalog.list_captions('imageset-' + imageset_name)
+  existing = set(images)
+  mismatched = []
+  missing = [path for path in images if path not in stored]
+  orphaned = [path for path in stored if path not in existing]
+  clean = [path for path in images if path in stored and not stored[path][1]]
+  for path, (exif, txt) in _read_all(clean, 'check captions'):
+    captions = stored[path][0]
+    # 没有标签的图片可以没有 exif 注释与 txt 文件
+    if (exif or []) != captions or (txt or '') != ", ".join(captions):
+      mismatched.append({ 'path': path, 'captions': captions, 'exif': exif, 'txt': txt })
+  if repair:
+    catalog.remove_images(orphaned)
+    catalog.get_captions(missing)
+    catalog.mark_dirty([item['path'] for item in mismatched])
+    flush()
+  return {
+    'checked': len(images),
+    'dirty': len([path for path in images if path in stored and stored[path][1]]),
+    'mismatched': mismatched,
+    'missing': missing,
+    'orphaned': orphaned,
+  }
+
+
+@api_caption.post('/flush')
+async def flush_captions():
+  results = await job.run('flush captions', flush)
+  return {
+    'written': len([error for error in results.values() if error is None]),
+    'failed': { path: error for path, error in results.items() if error is not None },
+  }
+
+@api_caption.post('/migrate')
+async def migrate_captions(imageset_name: str, force: bool = False, background: bool = False):
+  return await job.run('migrate captions', migrate, imageset_name, force, background=background)
+
+@api_caption.get('/check')
+async def check_captions(imageset_name: str, repair: bool = False, background: bool = False):
+  return await job.run('check captions', check, imageset_name, repair, background=background)
+
+@api_caption.get('/status')
+async def caption_status():
+  return { 'dirty': catalog.count_dirty() }
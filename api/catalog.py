@@ -0,0 +1,451 @@
+'''
+  图片元信息索引
+
+  将每张图片的宽高, 文件大小, 标签以及 hash 持久化到 repo_dir/.index.db 中
+  - image 表以 path + mtime + size 作为键, 只有文件的 stat 发生变化时才会重新读取图片的文件头(见 probe)
+  - content_mtime + content_size 为图片内容(像素)的版本, 缩略图, 解码缓存与 url 中的 v 都以它为准
+    写回标签只修改 exif, 不改变内容的版本; 变换(invalidate_images)与外部修改时才更新为文件当前的 stat
+  - cover 表记录每个概念目录的封面(dir 以 / 结尾), 封面保持不变, 直到主动刷新或者封面图片已经不在目录中
+  - caption 表是标签的唯一来源, 与文件的 stat 无关, 读取时不再打开 exif
+    dirty 表示还没有写回图片 exif 与 txt 文件, 写回由 caption 模块在后台批量完成
+    还没有标签记录的图片在第一次读取时从 exif(或者 txt)中导入
+  path 与其他接口一致, 都从 imageset-xxx 开始
+'''
+
+import os, json
+import random
+import sqlite3
+import threading
+from .config import CONF_REPO_DIR
+from . import probe
+
+
+INDEX_PATH = os.path.join(CONF_REPO_DIR, '.index.db')
+
+_local = threading.local()
+
+
+def _key(path: str) -> str:
+  # 统一使用从 imageset-xxx 开始, 以 / 分隔的路径作为键
+  if os.path.isabs(path):
+    path = os.path.relpath(path, CONF_REPO_DIR)
+  return os.path.normpath(path).replace('\\', '/')
+
+
+def _connect() -> sqlite3.Connection:
+  # sqlite 连接不能跨线程使用, 每个线程各自持有一个
+  conn = getattr(_local, 'conn', None)
+  if conn is None:
+    conn = sqlite3.connect(INDEX_PATH, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''
+      CREATE TABLE IF NOT EXISTS image (
+        path     TEXT PRIMARY KEY,
+        mtime    INTEGER NOT NULL,
+        size     INTEGER NOT NULL,
+        width    INTEGER,
+        height   INTEGER,
+        captions TEXT,
+        hashes   TEXT,
+        hash_version  INTEGER,
+        content_mtime INTEGER,
+        content_size  INTEGER
+      )''')
+    # 旧版本的索引中的 hash 使用原图计算, 没有版本号, 不会与新的 hash 混用
+    # 没有内容版本的记录以 mtime + size 作为内容的版本
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(image)')]
+    for column in ['hash_version', 'content_mtime', 'content_size']:
+      if column not in columns:
+        with conn:
+          conn.execute(f'ALTER TABLE image ADD COLUMN {column} INTEGER')
+    created = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'caption'").fetchone() is None
+    conn.execute('''
+      CREATE TABLE IF NOT EXISTS caption (
+        path     TEXT PRIMARY KEY,
+        captions TEXT NOT NULL,
+        dirty    INTEGER NOT NULL DEFAULT 0
+      )''')
+    conn.execute('''
+      CREATE TABLE IF NOT EXISTS cover (
+        dir      TEXT PRIMARY KEY,
+        path     TEXT NOT NULL
+      )''')
+    if created:
+      # 旧版本的索引将标签保存在 image 表中, 直接导入, 避免重新读取 exif
+      with conn:
+        conn.execute('INSERT OR IGNORE INTO caption SELECT path, captions, 0 FROM image WHERE captions IS NOT NULL')
+    _local.conn = conn
+  return conn
+
+
+def _query(conn: sqlite3.Connection, sql: str, keys: list[str]) -> list:
+  # sqlite 对参数个数有限制, 分批查询, sql 中的 {} 替换为占位符
+  rows = []
+  for i in range(0, len(keys), 500):
+    chunk = keys[i:i+500]
+    rows.extend(conn.execute(sql.format(','.join('?' * len(chunk))), chunk))
+  return rows
+
+
+# image 表读取的列, 下面的 row[i] 按照这个顺序
+_IMAGE_COLUMNS = 'path, mtime, size, width, height, hashes, hash_version, content_mtime, content_size'
+
+
+def _content(row) -> tuple[int, int]:
+  return (row[7], row[8]) if row[7] is not None else (row[1], row[2])
+
+
+def _read_images(paths: list[str], stats: list[tuple[int, int]], rows: dict[str, tuple], dirty: set[str]) -> list[tuple]:
+  '''
+    只读取文件头获取宽高, 无法读取的图片宽高为 None, stats 为 [(mtime_ns, size)], rows 为已有的记录
+    标签还在等待(或者正在)写回时, 宽高不变的变化视为写回 exif 导致的, 保留内容的版本与 hash
+  '''
+  sizes = probe.image_sizes([os.path.join(CONF_REPO_DIR, path) for path in paths])
+  result = []
+  for path, (mtime, file_size), size in zip(paths, stats, sizes):
+    width, height = size[:2] if size is not None else (None, None)
+    row = rows.get(path)
+    if row is not None and path in dirty and (width, height) == (row[3], row[4]):
+      result.append((path, mtime, file_size, width, height, row[5], row[6], *_content(row)))
+    else:
+      result.append((path, mtime, file_size, width, height, None, None, mtime, file_size))
+  return result
+
+
+def version(content: tuple[int, int]) -> str:
+  '''
+    内容版本的字符串形式, 用于缩略图的 url 与 ETag
+  '''
+  return f'{content[0]:x}{content[1]:x}'
+
+
+def _row_to_info(row) -> dict:
+  return {
+    'width': row[3],
+    'height': row[4],
+    'size': row[2],
+    'version': version(_content(row)), # 图片内容变化之后缩略图的 url 随之变化, 只写回标签时不变
+  }
+
+
+def _sync_images(paths: list[str], stats: dict[str, tuple[int, int]] | None) -> tuple[list[tuple[str, str]], dict[str, tuple]]:
+  '''
+    将 paths 的记录与文件同步, return ([(path, key)] 存在的图片, { key: row })
+  '''
+  keys = [_key(path) for path in paths]
+  conn = _connect()
+  rows = { row[0]: row for row in _query(conn, f'SELECT {_IMAGE_COLUMNS} FROM image WHERE path IN ({{}})', keys) }
+
+  found = []
+  changed = {}
+  for path, key in zip(paths, keys):
+    row = rows.get(key)
+    if stats is not None:
+      if path not in stats:
+        continue
+      mtime, size = stats[path]
+    if stats is None or (row is not None and (row[1] != mtime or row[2] != size)):
+      # 目录列表中的 stat 最多缓存 listing_ttl 秒, 原地写回标签之后可能比记录更旧, 与记录不一致时重新 stat
+      try:
+        st = os.stat(os.path.join(CONF_REPO_DIR, key))
+      except OSError:
+        continue
+      mtime, size = st.st_mtime_ns, st.st_size
+    found.append((path, key))
+    if row is None or row[1] != mtime or row[2] != size:
+      changed[key] = (mtime, size)
+  if len(changed) > 0:
+    dirty = { row[0] for row in _query(conn, 'SELECT path FROM caption WHERE dirty = 1 AND path IN ({})', list(changed.keys())) }
+    changed = _read_images(list(changed.keys()), list(changed.values()), rows, dirty)
+    rows.update((row[0], row) for row in changed)
+    with conn:
+      conn.executemany(f'INSERT OR REPLACE INTO image ({_IMAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', changed)
+  return found, rows
+
+
+def get_images_info(paths: list[str], stats: dict[str, tuple[int, int]] | None = None) -> dict[str, dict]:
+  '''
+    批量获取图片元信息, 只有 stat 变化(或者没有索引)的图片才会被重新读取
+    stats 为已知的 { path: (mtime_ns, size) }(例如目录列表中的 Entry), 其中的图片不再逐个 stat, 不在其中的视为不存在
+    stats 与索引不一致时重新 stat 文件, 以文件当前的状态为准, 不会用过期的列表覆盖较新的记录
+    return { 'imageset-xxx/src/8_katana/000001.png': { width, height, size, version, captions }, ... }, 键与传入的 path 一致
+  '''
+  found, rows = _sync_images(paths, stats)
+  result = { path: _row_to_info(rows[key]) for path, key in found }
+  captions = get_captions(list(result.keys()))
+  for path, info in result.items():
+    info['captions'] = captions.get(path, [])
+  return result
+
+
+def get_image_info(path: str) -> dict | None:
+  return get_images_info([path]).get(path)
+
+
+def get_content_versions(paths: list[str]) -> dict[str, tuple[int, int]]:
+  '''
+    图片内容的版本 { path: (content_mtime, content_size) }, 不读取标签, 图片不存在时不会出现在返回值中
+    path 可以是绝对路径
+  '''
+  found, rows = _sync_images(paths, None)
+  return { path: _content(rows[key]) for path, key in found }
+
+
+def get_captions(paths: list[str]) -> dict[str, list[str]]:
+  '''
+    批量读取标签, 还没有记录的图片从文件中导入(exif 优先, 其次是 txt)
+    return { path: [caption, ...] }, 键与传入的 path 一致, 图片不存在并且没有记录时不会出现在返回值中
+  '''
+  from .caption import read_file_caption
+  keys = [_key(path) for path in paths]
+  conn = _connect()
+  stored = { row[0]: json.loads(row[1]) for row in _query(conn, 'SELECT path, captions FROM caption WHERE path IN ({})', keys) }
+  imported = []
+  for key in dict.fromkeys(keys):
+    if key in stored:
+      continue
+    abs_path = os.path.join(CONF_REPO_DIR, key)
+    if not os.path.isfile(abs_path):
+      continue
+    stored[key] = read_file_caption(abs_path)
+    imported.append((key, json.dumps(stored[key])))
+  if len(imported) > 0:
+    with conn:
+      conn.executemany('INSERT OR IGNORE INTO caption VALUES (?, ?, 0)', imported)
+  return { path: stored[key] for path, key in zip(paths, keys) if key in stored }
+
+
+def set_captions(captions: dict[str, list[str]]) -> list[str]:
+  '''
+    保存标签并标记为需要写回文件, 与已有记录相同的标签会被跳过
+    return 实际发生变化的 path
+  '''
+  conn = _connect()
+  keys = { path: _key(path) for path in captions }
+  stored = { row[0]: row[1] for row in _query(conn, 'SELECT path, captions FROM caption WHERE path IN ({})', list(keys.values())) }
+  changed = []
+  for path, value in captions.items():
+    value = json.dumps(value)
+    if stored.get(keys[path]) != value:
+      changed.append((path, keys[path], value))
+  if len(changed) > 0:
+    with conn:
+      conn.executemany('INSERT OR REPLACE INTO caption VALUES (?, ?, 1)', [(key, value) for _, key, value in changed])
+  return [path for path, _, _ in changed]
+
+
+def import_captions(captions: dict[str, list[str]], force: bool = False) -> int:
+  '''
+    从文件导入标签, force 为 False 时只导入还没有记录的图片, 为 True 时覆盖所有没有等待写回的记录
+    return 导入的数量
+  '''
+  conn = _connect()
+  rows = [(_key(path), json.dumps(value)) for path, value in captions.items()]
+  with conn:
+    if force:
+      cursor = conn.executemany('''
+        INSERT INTO caption VALUES (?, ?, 0)
+        ON CONFLICT(path) DO UPDATE SET captions = excluded.captions WHERE dirty = 0''', rows)
+    else:
+      cursor = conn.executemany('INSERT OR IGNORE INTO caption VALUES (?, ?, 0)', rows)
+  return cursor.rowcount
+
+
+def get_dirty(paths: list[str] | None = None) -> list[tuple[str, str]]:
+  '''
+    返回等待写回文件的 [(path, captions json)], paths 为 None 时返回所有
+  '''
+  conn = _connect()
+  if paths is None:
+    return list(conn.execute('SELECT path, captions FROM caption WHERE dirty = 1'))
+  return _query(conn, 'SELECT path, captions FROM caption WHERE dirty = 1 AND path IN ({})', [_key(path) for path in paths])
+
+
+def count_dirty() -> int:
+  return _connect().execute('SELECT COUNT(*) FROM caption WHERE dirty = 1').fetchone()[0]
+
+
+def mark_dirty(paths: list[str]):
+  conn = _connect()
+  with conn:
+    conn.executemany('UPDATE caption SET dirty = 1 WHERE path = ?', [(_key(path),) for path in paths])
+
+
+def mark_clean(written: list[tuple[str, str]]):
+  '''
+    标签写回文件之后调用, written 为 [(path, captions json)]
+    写回期间标签又被修改时保持 dirty; 文件的 mtime 已经变化, 同步刷新 image 表, 避免下次重新读取宽高与 hash
+  '''
+  conn = _connect()
+  stats = []
+  for path, _ in written:
+    try:
+      st = os.stat(os.path.join(CONF_REPO_DIR, path))
+    except OSError:
+      continue
+    stats.append((st.st_mtime_ns, st.st_size, path))
+  with conn:
+    conn.executemany('UPDATE caption SET dirty = 0 WHERE path = ? AND captions = ?', written)
+    # 只修改了 exif, 内容的版本保持不变, 缩略图与解码缓存继续有效
+    conn.executemany('''
+      UPDATE image SET content_mtime = COALESCE(content_mtime, mtime), content_size = COALESCE(content_size, size), mtime = ?, size = ?
+      WHERE path = ?''', stats)
+
+
+def get_hashes(paths: list[str], version: int) -> dict[str, dict]:
+  '''
+    批量获取与当前文件 stat 一致, 并且由 version 版本的方法计算的 hash
+    没有 hash, 文件已经变化或者版本不一致的图片不会出现在返回值中
+  '''
+  keys = [_key(path) for path in paths]
+  conn = _connect()
+  rows = {
+    row[0]: row for row in
+    _query(conn, f'SELECT path, mtime, size, hashes FROM image WHERE path IN ({{}}) AND hashes IS NOT NULL AND hash_version = {int(version)}', keys)
+  }
+  result = {}
+  for path, key in zip(paths, keys):
+    row = rows.get(key)
+    if row is None:
+      continue
+    try:
+      st = os.stat(os.path.join(CONF_REPO_DIR, key))
+    except OSError:
+      continue
+    if row[1] == st.st_mtime_ns and row[2] == st.st_size:
+      result[path] = json.loads(row[3])
+  return result
+
+
+def set_hashes(hashes: dict[str, dict], version: int):
+  '''
+    hashes: { path: { 'phash': str, ... } }, version 为计算 hash 的方法的版本
+  '''
+  conn = _connect()
+  # 先确保索引存在且是最新的
+  get_images_info(list(hashes.keys()))
+  with conn:
+    conn.executemany('UPDATE image SET hashes = ?, hash_version = ? WHERE path = ?',
+      [(json.dumps(value), version, _key(path)) for path, value in hashes.items()])
+
+
+def remove_images(paths: list[str]):
+  '''
+    删除图片的索引与标签, 图片文件被删除之后调用
+  '''
+  conn = _connect()
+  rows = [(_key(path),) for path in paths]
+  with conn:
+    conn.executemany('DELETE FROM image WHERE path = ?', rows)
+    conn.executemany('DELETE FROM caption WHERE path = ?', rows)
+
+
+def invalidate_images(paths: list[str]):
+  '''
+    图片内容被修改(翻转, 裁剪, 放大)之后调用, 删除宽高与 hash, 保留标签, 下次读取时重新打开图片
+  '''
+  conn = _connect()
+  with conn:
+    conn.executemany('DELETE FROM image WHERE path = ?', [(_key(path),) for path in paths])
+
+
+def remove_dir(dir: str):
+  '''
+    删除 dir(imageset-xxx 或者 imageset-xxx/src/8_katana) 下所有图片的索引与标签
+  '''
+  dir = _key(dir).rstrip('/') + '/'
+  conn = _connect()
+  with conn:
+    conn.execute("DELETE FROM image WHERE substr(path, 1, ?) = ?", (len(dir), dir))
+    conn.execute("DELETE FROM caption WHERE substr(path, 1, ?) = ?", (len(dir), dir))
+    conn.execute("DELETE FROM cover WHERE substr(dir, 1, ?) = ?", (len(dir), dir))
+
+
+def move_images(moved: dict[str, str]):
+  '''
+    图片移动或者重命名之后调用, moved 为 { 原 path: 新 path }, 标签(包括等待写回的)跟随图片移动
+    移动不会改变文件的 stat, image 表中的记录同样保留
+  '''
+  rows = [(_key(new), _key(old)) for old, new in moved.items()]
+  conn = _connect()
+  with conn:
+    conn.executemany('UPDATE OR REPLACE image SET path = ? WHERE path = ?', rows)
+    conn.executemany('UPDATE OR REPLACE caption SET path = ? WHERE path = ?', rows)
+
+
+def rename_dir(old_dir: str, new_dir: str):
+  '''
+    目录重命名之后调用, 将 old_dir 下所有的记录移动到 new_dir 下
+  '''
+  old_dir = _key(old_dir).rstrip('/') + '/'
+  new_dir = _key(new_dir).rstrip('/') + '/'
+  conn = _connect()
+  with conn:
+    for table in ['image', 'caption']:
+      conn.execute(f"DELETE FROM {table} WHERE substr(path, 1, ?) = ?", (len(new_dir), new_dir))
+      conn.execute(f"UPDATE {table} SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?",
+        (new_dir, len(old_dir) + 1, len(old_dir), old_dir))
+    conn.execute("DELETE FROM cover WHERE substr(dir, 1, ?) = ?", (len(new_dir), new_dir))
+    conn.execute("UPDATE cover SET dir = ? || substr(dir, ?), path = ? || substr(path, ?) WHERE substr(dir, 1, ?) = ?",
+      (new_dir, len(old_dir) + 1, new_dir, len(old_dir) + 1, len(old_dir), old_dir))
+
+
+def get_covers(images: dict[str, list[str]], refresh: bool = False) -> dict[str, str | None]:
+  '''
+    概念目录的封面, images 为 { dir: [dir 下的所有 path] }
+    第一次读取(或者 refresh, 或者原来的封面已经不在目录中)时随机选择一张并保存
+    return { dir: path }, 目录中没有图片时为 None
+  '''
+  keys = { dir: _key(dir).rstrip('/') + '/' for dir in images }
+  conn = _connect()
+  stored = { row[0]: row[1] for row in _query(conn, 'SELECT dir, path FROM cover WHERE dir IN ({})', list(keys.values())) }
+  result = {}
+  changed = []
+  for dir, paths in images.items():
+    paths = { _key(path): path for path in paths }
+    cover = stored.get(keys[dir])
+    if not refresh and cover in paths:
+      result[dir] = paths[cover]
+      continue
+    if len(paths) <= 0:
+      result[dir] = None
+      continue
+    cover = random.choice(sorted(paths))
+    changed.append((keys[dir], cover))
+    result[dir] = paths[cover]
+  if len(changed) > 0:
+    with conn:
+      conn.executemany('INSERT OR REPLACE INTO cover VALUES (?, ?)', changed)
+  return result
+
+
+def list_captions(dir: str) -> dict[str, tuple[list[str], bool]]:
+  '''
+    返回 dir 下所有标签记录 { path: (captions, dirty) }, 用于一致性检查
+  '''
+  dir = _key(dir).rstrip('/') + '/'
+  conn = _connect()
+  return {
+    row[0]: (json.loads(row[1]), bool(row[2]))
+    for row in conn.execute("SELECT path, captions, dirty FROM caption WHERE substr(path, 1, ?) = ?", (len(dir), dir))
+  }
+
+
+def prune_dir(dir: str, paths: list[str]):
+  '''
+    删除 dir 目录下已经不存在的图片的索引与标签, paths 为当前目录下的所有图片
+  '''
+  dir = _key(dir).rstrip('/') + '/'
+  conn = _connect()
+  existing = set(_key(path) for path in paths)
+  stale = [
+    (row[0],) for row in conn.execute('''
+      SELECT path FROM image WHERE substr(path, 1, ?) = ?
+      UNION SELECT path FROM caption WHERE substr(path, 1, ?) = ?''', (len(dir), dir, len(dir), dir))
+    if row[0] not in existing and '/' not in row[0][len(dir):]
+  ]
+  if len(stale) > 0:
+    with conn:
+      conn.executemany('DELETE FROM image WHERE path = ?', stale)
+      conn.executemany('DELETE FROM caption WHERE path = ?', stale)
@@ -0,0 +1,194 @@
+'''
+  打标置信度存储
+
+  批量打标时保存每张图片完整的置信度向量, 之后修改阈值或者排除标签时不需要重新推理
+  - 每个概念目录的每个模型一个 float16 文件 .confidence/{concept_dir}/{model}.f16, 每行一张图片, 使用 memmap 读取
+    同名的 {model}.json 记录列数以及 { 图片文件名: 行号 }
+  - .confidence/{model}.tags.json 保存模型的标签名与 rating 数量, 重新过滤时不需要加载模型
+  - 图片被修改, 移动或者删除之后对应的行失效, 失效的行超过一半时压缩文件
+  置信度以 float16 保存, 与阈值非常接近的标签结果可能与重新推理略有不同
+'''
+
+from .config import CONF_REPO_DIR
+import numpy as np
+import threading
+import shutil
+import json
+import os
+
+
+CONFIDENCE_DIR = os.path.join(CONF_REPO_DIR, '.confidence')
+DTYPE = np.float16
+
+_locks: dict[tuple[str, str], threading.Lock] = {}
+_locks_lock = threading.Lock()
+
+
+def _lock(concept_dir: str, model: str) -> threading.Lock:
+  with _locks_lock:
+    return _locks.setdefault((concept_dir, model), threading.Lock())
+
+def _files(concept_dir: str, model: str) -> tuple[str, str]:
+  base = os.path.join(CONFIDENCE_DIR, concept_dir, model)
+  return f'{base}.f16', f'{base}.json'
+
+def _write_json(path: str, value):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  temp_path = f'{path}.{threading.get_ident()}.tmp'
+  with open(temp_path, 'w', encoding='utf-8') as f:
+    json.dump(value, f)
+  os.replace(temp_path, path)
+
+def _read_json(path: str):
+  try:
+    with open(path, 'r', encoding='utf-8') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def _group(image_paths: list[str]) -> dict[str, list[tuple[int, str]]]:
+  '''
+    按照概念目录分组, 返回 { concept_dir: [(原下标, 文件名)] }
+  '''
+  groups = {}
+  for i, path in enumerate(image_paths):
+    path = os.path.normpath(path).replace('\\', '/')
+    concept_dir, name = os.path.split(path)
+    groups.setdefault(concept_dir, []).append((i, name))
+  return groups
+
+
+def save_tag_names(model: str, names: np.ndarray, rating_count: int):
+  path = os.path.join(CONFIDENCE_DIR, f'{model}.tags.json')
+  value = { 'names': [str(name) for name in names], 'rating_count': rating_count }
+  if _read_json(path) != value:
+    _write_json(path, value)
+
+def load_tag_names(model: str) -> tuple[np.ndarray, int] | None:
+  value = _read_json(os.path.join(CONFIDENCE_DIR, f'{model}.tags.json'))
+  if value is None:
+    return None
+  return np.array(value['names'], dtype=object), value['rating_count']
+
+
+def save(model: str, image_paths: list[str], confidents: np.ndarray):
+  '''
+    保存 image_paths 对应的置信度矩阵 (N, 标签数量), 已经存在的行原地覆盖, 新的图片追加到文件末尾
+  '''
+  confidents = confidents.reshape(len(image_paths), -1).astype(DTYPE)
+  columns = confidents.shape[1]
+  for concept_dir, items in _group(image_paths).items():
+    data_path, index_path = _files(concept_dir, model)
+    with _lock(concept_dir, model):
+      index = _read_json(index_path)
+      if index is None or index['columns'] != columns or not os.path.exists(data_path):
+        # 模型的输出发生变化, 重新开始
+        index = { 'columns': columns, 'count': 0, 'rows': {} }
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        open(data_path, 'wb').close()
+      row_bytes = columns * np.dtype(DTYPE).itemsize
+      with open(data_path, 'r+b') as f:
+        appended = []
+        for i, name in items:
+          row = index['rows'].get(name)
+          if row is None:
+            appended.append((i, name))
+            continue
+          f.seek(row * row_bytes)
+          f.write(confidents[i].tobytes())
+        f.seek(index['count'] * row_bytes)
+        f.write(confidents[[i for i, _ in appended]].tobytes())
+      for i, name in appended:
+        index['rows'][name] = index['count']
+        index['count'] += 1
+      _write_json(index_path, index)
+
+
+def load(model: str, image_paths: list[str]) -> tuple[list[str], np.ndarray | None]:
+  '''
+    读取 image_paths 的置信度, 返回 (有记录的图片, (N, 标签数量) float16 矩阵), 顺序与 image_paths 一致
+  '''
+  indices, blocks = [], []
+  columns = None
+  for concept_dir, items in _group(image_paths).items():
+    data_path, index_path = _files(concept_dir, model)
+    with _lock(concept_dir, model):
+      index = _read_json(index_path)
+      if index is None or index['count'] <= 0:
+        continue
+      if columns is not None and index['columns'] != columns:
+        continue
+      columns = index['columns']
+      items = [(i, index['rows'][name]) for i, name in items if name in index['rows']]
+      if len(items) <= 0:
+        continue
+      data = np.memmap(data_path, dtype=DTYPE, mode='r', shape=(index['count'], columns))
+      blocks.append(np.asarray(data[[row for _, row in items]]))
+      del data
+    indices.extend(i for i, _ in items)
+  if len(indices) <= 0:
+    return [], None
+  order = np.argsort(indices, kind='stable')
+  return [image_paths[indices[i]] for i in order], np.concatenate(blocks)[order]
+
+
+def _compact(data_path: str, index: dict):
+  columns = index['columns']
+  names = sorted(index['rows'], key=lambda name: index['rows'][name])
+  if len(names) > 0:
+    data = np.memmap(data_path, dtype=DTYPE, mode='r', shape=(index['count'], columns))
+    rows = np.asarray(data[[index['rows'][name] for name in names]])
+    del data
+  else:
+    rows = np.zeros((0, columns), dtype=DTYPE)
+  temp_path = f'{data_path}.{threading.get_ident()}.tmp'
+  with open(temp_path, 'wb') as f:
+    f.write(rows.tobytes())
+  os.replace(temp_path, data_path)
+  index['rows'] = { name: i for i, name in enumerate(names) }
+  index['count'] = len(names)
+
+
+def remove(image_paths: list[str]):
+  '''
+    图片被修改, 移动或者删除之后调用, 删除所有模型中对应的行
+  '''
+  for concept_dir, items in _group(image_paths).items():
+    directory = os.path.join(CONFIDENCE_DIR, concept_dir)
+    if not os.path.isdir(directory):
+      continue
+    for filename in os.listdir(directory):
+      if not filename.endswith('.json'):
+        continue
+      model = filename[:-len('.json')]
+      data_path, index_path = _files(concept_dir, model)
+      with _lock(concept_dir, model):
+        index = _read_json(index_path)
+        if index is None:
+          continue
+        removed = [name for _, name in items if index['rows'].pop(name, None) is not None]
+        if len(removed) <= 0:
+          continue
+        if index['count'] - len(index['rows']) > len(index['rows']):
+          _compact(data_path, index)
+        _write_json(index_path, index)
+
+
+def remove_dir(dir: str):
+  '''
+    删除 dir(imageset-xxx, imageset-xxx/src 或者 imageset-xxx/src/8_katana) 下的所有置信度
+  '''
+  directory = os.path.join(CONFIDENCE_DIR, dir)
+  if os.path.exists(directory):
+    shutil.rmtree(directory)
+
+
+def rename_dir(old_dir: str, new_dir: str):
+  old_directory = os.path.join(CONFIDENCE_DIR, old_dir)
+  new_directory = os.path.join(CONFIDENCE_DIR, new_dir)
+  if not os.path.exists(old_directory):
+    return
+  if os.path.exists(new_directory):
+    shutil.rmtree(new_directory)
+  os.makedirs(os.path.dirname(new_directory), exist_ok=True)
+  os.rename(old_directory, new_directory)
@@ -20,6 +20,38 @@ CONFIG = {
   'repo_dir': os.path.join(os.getcwd(), 'repo'), 
   'image_ext': 'JPEG', # 将图片保存为 jpeg 还是 png
   'web_dir': os.path.join(base_path, 'build'), # 定义为这个路径再来尝试一下
+  'tagger_batch_size': 8, # 批量打标时每次送入模型的图片数量
+  'tagger_workers': min(8, os.cpu_count() or 1), # 解码与预处理图片的线程数
+  'tagger_intra_op_threads': 0, # onnxruntime 单个算子使用的线程数, 0 表示由 onnxruntime 决定
+  'tagger_inter_op_threads': 0, # onnxruntime 算子之间并行的线程数, 0 表示由 onnxruntime 决定
+  'tagger_memory_budget': 4096, # 同时加载的打标模型的内存上限(MB), 超过时卸载最久没有使用的模型, 0 表示不限制
+  'tagger_preload': [], # 启动时在后台预先加载的模型, 例如 ['wd-v1-4-vit-tagger.v3']
+  'job_workers': 2, # 同时执行的后台任务数量
+  'hash_workers': os.cpu_count() or 1, # 计算图片 hash 的进程数
+  'thumbnail_workers': min(8, os.cpu_count() or 1), # 生成缩略图的线程数
+  'thumbnail_sizes': { # 缩略图尺寸, 通过 /image/thumbnail/{path}?size=xxx 选择, 默认为 grid
+    'grid': [256, 512],
+    'preview': [1024, 1024],
+    'cover': [512, 512],
+  },
+  'thumbnail_format': None, # 缩略图格式, WEBP 或者 AVIF, None 表示与原图一致
+  'thumbnail_quality': 80,
+  'thumbnail_cache_size': 128, # 内存中缓存的缩略图的总大小(MB), 0 表示不缓存
+  'decode_cache_size': 512, # 内存中缓存的解码图片(短边 448 的 RGB 数组)的总大小(MB), 打标与计算 hash 共用, 0 表示不缓存
+  'serve_workers': 16, # /image 接口中 stat 文件的线程数
+  'serve_max_pending': 256, # /image 接口同时等待中的请求上限, 超过时返回 503
+  'probe_workers': 16, # 建立索引时读取图片宽高的线程数, 主要为等待 io, repo_dir 位于网络存储上时可以适当调大
+  'import_workers': os.cpu_count() or 1, # 导入图片时转换格式的进程数
+  'upload_workers': os.cpu_count() or 1, # 上传图片时转换格式的进程数, 与上传并行
+  'watcher': None, # 监视 repo_dir 的外部修改, auto, inotify 或者 polling, None 表示不监视
+  'watch_interval': 5.0, # polling 模式下检查目录变化的间隔(秒)
+  'listing_ttl': 2.0, # 目录列表中文件大小与 mtime 的有效时间(秒), 超过之后重新 stat
+  'caption_flush_delay': 2.0, # 保存标签之后延迟多少秒写回图片 exif 与 txt 文件, 期间的多次保存只写一次
+  'caption_workers': os.cpu_count() or 1, # 批量导入, 检查标签时读取 exif 的进程数
+  'transform_workers': os.cpu_count() or 1, # 批量翻转, 裁剪, 放大图片的进程数
+  'jpegtran': 'jpegtran', # jpegtran 的路径, 用于无损地翻转, 旋转与裁剪 JPEG, None 表示总是重新编码
+  'jpeg_quality': 'keep', # 重新编码 JPEG 时的质量(1-95), keep 表示沿用原图的量化表
+  'jpeg_subsampling': 'keep', # 重新编码 JPEG 时的色度抽样 4:4:4, 4:2:2 或者 4:2:0, keep 表示与原图一致
 }
 
 
@@ -42,6 +74,34 @@ CONF_HOST = CONFIG['host']
 CONF_REPO_DIR = CONFIG['repo_dir']
 CONF_IMAGE_EXT = CONFIG['image_ext']
 CONF_WEB_DIR = CONFIG['web_dir']
+CONF_TAGGER_BATCH_SIZE = CONFIG['tagger_batch_size']
+CONF_TAGGER_WORKERS = CONFIG['tagger_workers']
+CONF_TAGGER_INTRA_OP_THREADS = CONFIG['tagger_intra_op_threads']
+CONF_TAGGER_INTER_OP_THREADS = CONFIG['tagger_inter_op_threads']
+CONF_TAGGER_MEMORY_BUDGET = CONFIG['tagger_memory_budget']
+CONF_TAGGER_PRELOAD = CONFIG['tagger_preload']
+CONF_JOB_WORKERS = CONFIG['job_workers']
+CONF_HASH_WORKERS = CONFIG['hash_workers']
+CONF_THUMBNAIL_WORKERS = CONFIG['thumbnail_workers']
+CONF_THUMBNAIL_SIZES = CONFIG['thumbnail_sizes']
+CONF_THUMBNAIL_FORMAT = CONFIG['thumbnail_format']
+CONF_THUMBNAIL_QUALITY = CONFIG['thumbnail_quality']
+CONF_THUMBNAIL_CACHE_SIZE = CONFIG['thumbnail_cache_size']
+CONF_DECODE_CACHE_SIZE = CONFIG['decode_cache_size']
+CONF_PROBE_WORKERS = CONFIG['probe_workers']
+CONF_SERVE_WORKERS = CONFIG['serve_workers']
+CONF_SERVE_MAX_PENDING = CONFIG['serve_max_pending']
+CONF_IMPORT_WORKERS = CONFIG['import_workers']
+CONF_UPLOAD_WORKERS = CONFIG['upload_workers']
+CONF_CAPTION_FLUSH_DELAY = CONFIG['caption_flush_delay']
+CONF_WATCHER = CONFIG['watcher']
+CONF_WATCH_INTERVAL = CONFIG['watch_interval']
+CONF_LISTING_TTL = CONFIG['listing_ttl']
+CONF_CAPTION_WORKERS = CONFIG['caption_workers']
+CONF_TRANSFORM_WORKERS = CONFIG['transform_workers']
+CONF_JPEGTRAN = CONFIG['jpegtran']
+CONF_JPEG_QUALITY = CONFIG['jpeg_quality']
+CONF_JPEG_SUBSAMPLING = CONFIG['jpeg_subsampling']
 
 if not os.path.exists(CONF_REPO_DIR):
   os.makedirs(CONF_REPO_DIR, exist_ok=True)
@@ -0,0 +1,101 @@
+'''
+  解码图片缓存
+
+  打标, 计算 hash 等批量操作经常对同一批图片依次执行, 每次都完整解码原图
+  这里将图片解码为较小的 RGB 数组(透明部分填充为白色, 短边缩小到 PREVIEW_SIZE, 不放大)缓存在内存中
+  - 打标模型的输入为 448, hash 最大使用 128, 都可以直接从缓存的数组得到
+  - JPEG 使用 draft 在解码时直接按 1/2, 1/4, 1/8 缩小, 未命中时也比完整解码快
+  - 以 catalog 中图片内容的版本校验, 图片变化之后不会读到旧的数组, 写回标签(只修改 exif)不会让缓存失效
+    修改, 移动与删除图片的接口同时调用 remove 释放内存
+  - 总大小不超过 decode_cache_size(MB)
+'''
+
+from PIL import Image
+from .config import CONF_REPO_DIR, CONF_DECODE_CACHE_SIZE
+from .cache import LRUCache
+from . import catalog
+import numpy as np
+import os
+
+
+PREVIEW_SIZE = 448
+
+cache = LRUCache(CONF_DECODE_CACHE_SIZE * 1024 * 1024)
+
+
+def _key(abs_path: str) -> str:
+  return os.path.normpath(os.path.join(CONF_REPO_DIR, abs_path)).replace('\\', '/')
+
+def _version(abs_path: str) -> tuple[int, int] | None:
+  return catalog.get_content_versions([abs_path]).get(abs_path)
+
+
+def decode(abs_path: str) -> np.ndarray:
+  '''
+    解码为 (H, W, 3) uint8 数组, 短边不超过 PREVIEW_SIZE, 可以在子进程中执行
+  '''
+  with Image.open(abs_path) as img:
+    # draft 保证缩小之后两边都不小于 PREVIEW_SIZE
+    img.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+      img = img.convert('RGBA')
+      background = Image.new('RGBA', img.size, 'WHITE')
+      background.paste(img, mask=img)
+      img = background
+    img = img.convert('RGB')
+    scale = PREVIEW_SIZE / min(img.size)
+    if scale < 1:
+      img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    return np.asarray(img)
+
+
+def get(abs_path: str) -> np.ndarray | None:
+  version = _version(abs_path)
+  if version is None:
+    return None
+  return cache.get(_key(abs_path), version)
+
+
+def put(abs_path: str, array: np.ndarray, st: os.stat_result | None = None):
+  '''
+    st 为解码之前的 stat, 解码期间文件被修改时不放入缓存
+  '''
+  try:
+    current = os.stat(abs_path)
+    if st is not None and (current.st_mtime_ns, current.st_size) != (st.st_mtime_ns, st.st_size):
+      return
+  except OSError:
+    return
+  version = _version(abs_path)
+  if version is None:
+    return
+  array.setflags(write=False)
+  cache.put(_key(abs_path), array, array.nbytes, version)
+
+
+def load(abs_path: str) -> np.ndarray:
+  '''
+    优先从缓存中读取, 未命中时解码并缓存, 图片无法读取时抛出异常
+  '''
+  array = get(abs_path)
+  if array is None:
+    st = os.stat(abs_path)
+    array = decode(abs_path)
+    put(abs_path, array, st)
+  return array
+
+
+def load_image(abs_path: str) -> Image.Image:
+  return Image.fromarray(load(abs_path))
+
+
+def remove(paths: list[str]):
+  '''
+    图片被修改, 移动或者删除之后调用, paths 从 imageset-xxx 开始或者为绝对路径
+  '''
+  for path in paths:
+    cache.pop(_key(path))
+
+def remove_dir(dir: str):
+  prefix = _key(dir).rstrip('/') + '/'
+  cache.discard(lambda key: key.startswith(prefix))
@@ -1,10 +1,13 @@
-from fastapi import APIRouter, HTTPException
-from PIL import Image
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
 from .config import CONF_REPO_DIR
-from tqdm import tqdm
+from . import job
+from . import thumbnail
+from . import decode
+from . import transform
+from . import serving
 import os
-from fastapi.responses import FileResponse
+from fastapi.responses import Response
 from typing import List
 
 
@@ -13,60 +16,101 @@ api_image = APIRouter()
 
 
 
+@api_image.get("/cache")
+async def get_cache_stats(name: str = 'thumbnail'):
+  '''
+    内存缓存的命中率, name 为 thumbnail(缩略图) 或者 decode(打标与计算 hash 共用的解码图片)
+    { entries, size, capacity, hits, misses, evictions, hit_rate }, size 与 capacity 为字节
+  '''
+  caches = { 'thumbnail': thumbnail.cache, 'decode': decode.cache }
+  if name not in caches:
+    raise HTTPException(status_code=400, detail=f"Unknown cache {name}")
+  return caches[name].stats()
+
 # 注意将这个放在前面, 直接通过路径获取缩略图
 @api_image.get("/thumbnail/{image_name:path}")
-async def get_thumbnail(image_name: str):
-  
-  
-  image_path = os.path.join(CONF_REPO_DIR, image_name)
-  thumbnail_path = os.path.join(CONF_REPO_DIR, './.thumbnail', image_name)
-  
-  # 检查缩略图是否存在, 存在就直接返回即可
-  if os.path.exists(thumbnail_path) and os.path.isfile(thumbnail_path):
-    return FileResponse(thumbnail_path)
-  elif os.path.exists(image_path) and os.path.isfile(image_path):
-    with Image.open(image_path) as img:
-      img: Image = img.convert('RGB')
-      img.thumbnail(size=(256, 512))
-      parent_dir = os.path.dirname(thumbnail_path)
-      if not os.path.exists(parent_dir):
-        os.makedirs(parent_dir)
-      img.save(thumbnail_path)
-      return FileResponse(thumbnail_path)
-  raise HTTPException(status_code=404, detail="Image not found")
+async def get_thumbnail(image_name: str, request: Request, size: str = thumbnail.DEFAULT_SIZE, v: str | None = None):
+  '''
+    size 为 thumbnail_sizes 中的名称, v 为图片内容的版本号(load_concept 返回的 thumbnail url 中已经带上)
+    版本号与当前图片一致时返回 immutable, 浏览器不会再次请求; 否则需要通过 ETag 重新验证, 未变化时返回 304
+    版本号只在图片内容变化时改变, 写回标签(修改 exif)不会让缩略图失效
+    缩略图内容缓存在内存中, 只有 Range 请求才直接读取文件
+  '''
+  if size not in thumbnail.THUMBNAIL_SIZES:
+    raise HTTPException(status_code=400, detail=f"unknown thumbnail size {size}")
+  async with serving.admit():
+    content = await serving.run(thumbnail.content_version, image_name)
+    if content is None:
+      raise HTTPException(status_code=404, detail="Image not found")
+    image_version = thumbnail.version(content)
+    etag = thumbnail.etag(image_version, size)
+    headers = {
+      'ETag': etag,
+      'Last-Modified': serving.last_modified(content[0] / 1e9),
+      'Cache-Control': 'public, max-age=31536000, immutable' if v == image_version else 'no-cache',
+    }
+    if serving.not_modified(request, etag, content[0] / 1e9):
+      return Response(status_code=304, headers=headers)
+    if 'range' not in request.headers:
+      data = await thumbnail.get_thumbnail_data(image_name, size, image_version)
+      if data is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+      return Response(content=data, headers=headers, media_type=thumbnail.media_type(image_name))
+    # 缩略图不存在时在线程池中生成, 并发请求同一张缩略图只会生成一次
+    thumbnail_path = await thumbnail.get_thumbnail(image_name, size)
+    thumbnail_st = await serving.stat_file(thumbnail_path) if thumbnail_path is not None else None
+  if thumbnail_st is None:
+    raise HTTPException(status_code=404, detail="Image not found")
+  return serving.ImageResponse(thumbnail_path, headers=headers, media_type=thumbnail.media_type(image_name), stat_result=thumbnail_st)
   
 # 直接通过路径获取原图
 @api_image.get("/{image_name:path}")
-async def get_image(image_name: str):
-
+async def get_image(image_name: str, request: Request):
+  '''
+    原图可能被翻转, 裁剪等修改, 每次都需要通过 ETag 重新验证, 支持 Range
+  '''
   # 结合基础路径和用户传入的图像名称, repo_dir (将所有图片都保存在repo_dir中)
   image_path = os.path.join(CONF_REPO_DIR, image_name)
-  
-  # 检查文件是否存在
-  if os.path.exists(image_path) and os.path.isfile(image_path):
-    return FileResponse(image_path)
-  raise HTTPException(status_code=404, detail="Image not found")
+  async with serving.admit():
+    st = await serving.stat_file(image_path)
+  if st is None:
+    raise HTTPException(status_code=404, detail="Image not found")
+  # 原图的内容包括 exif, 以文件的 stat 作为版本
+  etag = f'"{st.st_mtime_ns:x}{st.st_size:x}"'
+  headers = {
+    'ETag': etag,
+    'Last-Modified': serving.last_modified(st.st_mtime),
+    'Cache-Control': 'no-cache',
+  }
+  if serving.not_modified(request, etag, st.st_mtime):
+    return Response(status_code=304, headers=headers)
+  return serving.ImageResponse(image_path, headers=headers, stat_result=st)
   
 class FlipRequest(BaseModel):
   images: List[str]
   horizontal: bool
   
 @api_image.put("/flip")
-async def flip_images(request: FlipRequest):
-  for image in tqdm(request.images):
-    image_path = os.path.join(CONF_REPO_DIR, image)
-    thumbnail_path = os.path.join(CONF_REPO_DIR, '.thumbnail', image)
-    
-    image = Image.open(image_path)
-    if request.horizontal:
-      image = image.transpose(Image.FLIP_LEFT_RIGHT)
-    else:
-      image = image.transpose(Image.FLIP_TOP_BOTTOM)
-    image.save(image_path)
-    image.close()
-    # 记得删除对应的缩略图
-    if os.path.exists(thumbnail_path):
-      os.remove(thumbnail_path)
+async def flip_images(request: FlipRequest, background: bool = False):
+  '''
+    return { path: { status: 'transformed' | 'failed', error: string | null, lossless: boolean } }
+  '''
+  items = [(image, { 'horizontal': request.horizontal }) for image in request.images]
+  return await job.run('flip', transform.run, 'flip', items, background=background)
+
+class RotateRequest(BaseModel):
+  images: List[str]
+  degrees: int  # 顺时针旋转的角度, 90, 180 或者 270
+
+@api_image.put("/rotate")
+async def rotate_images(request: RotateRequest, background: bool = False):
+  '''
+    return { path: { status: 'transformed' | 'failed', error: string | null, lossless: boolean } }
+  '''
+  if request.degrees not in (90, 180, 270):
+    raise HTTPException(status_code=400, detail="degrees should be 90, 180 or 270")
+  items = [(image, { 'degrees': request.degrees }) for image in request.images]
+  return await job.run('rotate', transform.run, 'rotate', items, background=background)
 
 class CropperImage(BaseModel):
   path: str 
@@ -75,23 +119,13 @@ class CropperImage(BaseModel):
   width: float
   height: float  
 @api_image.put("/cut")    
-async def cut_images(images: List[CropperImage]):
-  for item in tqdm(images):
-    img_path = os.path.join(CONF_REPO_DIR, item.path)
-    thumbnail_path = os.path.join(CONF_REPO_DIR, '.thumbnail', item.path)
-    image = Image.open(img_path)
-    left = item.x * image.width / 100
-    right = left + item.width * image.width / 100
-    top = item.y * image.height / 100
-    bottom = top + item.height * image.height / 100
-    crop_area = (left, top, right, bottom,)
-    try:
-      cropped_image = image.crop(crop_area)
-      cropped_image.save(img_path)
-    except:
-      image.close()
-    if os.path.exists(thumbnail_path):
-      os.remove(thumbnail_path)
+async def cut_images(images: List[CropperImage], background: bool = False):
+  '''
+    x, y, width, height 为百分比
+    return { path: { status: 'transformed' | 'failed', error: string | null, lossless: boolean } }
+  '''
+  items = [(item.path, { 'x': item.x, 'y': item.y, 'width': item.width, 'height': item.height }) for item in images]
+  return await job.run('cut', transform.run, 'cut', items, background=background)
 
 class UpscaleImage(BaseModel):
   filenames: List[str]
@@ -99,15 +133,10 @@ class UpscaleImage(BaseModel):
   height: int
 
 @api_image.put("/upscale")    
-async def upscale_images(request: UpscaleImage):
-  for filename in tqdm(request.filenames):
-    imagefilename = os.path.join(CONF_REPO_DIR, filename) 
-    image = Image.open(imagefilename)
-    width, height = image.size # 原始尺寸
-    if width >= request.width and height >= request.height:
-      continue
-    scale = max(request.width / width, request.height / height)
-    image = image.resize((int(width * scale + 0.001), int(height * scale + 0.001)), Image.Resampling.LANCZOS)
-    image.save(imagefilename)
-
-
+async def upscale_images(request: UpscaleImage, background: bool = False):
+  '''
+    放大到不小于 width x height, 已经足够大的图片为 skipped
+    return { path: { status: 'transformed' | 'skipped' | 'failed', error: string | null, lossless: boolean } }
+  '''
+  items = [(filename, { 'width': request.width, 'height': request.height }) for filename in request.filenames]
+  return await job.run('upscale', transform.run, 'upscale', items, background=background)
@@ -1,16 +1,26 @@
-from fastapi import APIRouter, HTTPException,  File, UploadFile, Form
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, HTTPException,  File, UploadFile, Form, Request
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from .config import CONF_REPO_DIR, CONF_HOST, CONF_PORT, CONF_IMAGE_EXT
-import os,io
+import os,io,json
 from typing import List
-from tqdm import tqdm
+from .job import progress
+from . import job
+from . import thumbnail
+from . import decode
+from . import importer
+from . import archive
 from PIL import Image
 import shutil
 import re
-import random
 import platform, subprocess
-import glob
+import bisect
+from . import catalog
+from . import caption
+from . import confidence
+from . import watcher
+from . import naming
 
 
 api_imageset = APIRouter()
@@ -20,30 +30,9 @@ api_imageset = APIRouter()
   所有的 path 都从 imageset-xxx/src/8_xxx 开始
   绝对路径直接使用 repo_dir/{path} 即可
   图片的url则直接 http://{config.host}:{config.port}/image/{path}即可
-  图片的缩略图url则直接 http://{config.host}:{config.port}/image/thumbnail/{path}即可
+  图片的缩略图url则直接 http://{config.host}:{config.port}/image/thumbnail/{path}即可, 可以通过 size 参数选择缩略图尺寸
 '''
 
-def get_next_image_count(target_dir: str, image_count: int) -> int:
-  '''
-    path 应该从 imageset-xxx 开始
-  '''
-  max_number = 0
-  min_number = 918932490718831499 # 随便初始化一个很大的数字
-  # 列出目标目录中的所有文件
-  for file_name in os.listdir(os.path.join(CONF_REPO_DIR, target_dir)):
-    name, _ = os.path.splitext(file_name)
-    try:
-      number = int(name)
-      if number > max_number:
-        max_number = number
-      elif number < min_number:
-        min_number = number
-    except:
-      continue
-  if image_count < min_number:
-    return 0
-  return max_number + 1  # 返回下一个可用的序号
-
 def get_concept_folder_list(train_or_regular_dir: str) -> list[dict]:
   '''
     从 imageset-xxx/src 目录下获取所有的概念列表
@@ -52,7 +41,9 @@ def get_concept_folder_list(train_or_regular_dir: str) -> list[dict]:
   pattern = r'^(?P<repeat>\d+)_(?P<concept>.+)$'
 
   result = []
-  for name in os.listdir(os.path.join(CONF_REPO_DIR, train_or_regular_dir)):
+  for name, is_dir in watcher.listdir(train_or_regular_dir).items():
+    if not is_dir:
+      continue
     match = re.match(pattern, name)
     if not match:
       continue
@@ -72,94 +63,58 @@ def get_image_list(concept_dir: str) -> list[str]:
     return ['imageset-xxx/src/8_katana/katana_000001.jpg', ...]
   '''
   image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
-  imagefilenames = [os.path.join(concept_dir, imagefilename) for imagefilename in os.listdir(os.path.join(CONF_REPO_DIR, concept_dir))
-    if os.path.isfile(os.path.join(CONF_REPO_DIR, concept_dir, imagefilename)) and os.path.splitext(imagefilename)[1].lower() in image_extensions]
+  # 目录列表按照目录的 mtime 缓存, 不需要逐个 stat 文件
+  imagefilenames = [os.path.join(concept_dir, imagefilename) for imagefilename, is_dir in watcher.listdir(concept_dir).items()
+    if not is_dir and os.path.splitext(imagefilename)[1].lower() in image_extensions]
   imagefilenames = [os.path.normpath(imagefilename).replace('\\', '/') for imagefilename in imagefilenames]
   return imagefilenames
 
-def convert_and_copy_images(source_dir: str, target_dir: str) -> int:  
+def get_image_stats(concept_dir: str) -> dict[str, tuple[int, int]]:
+  '''
+    concept_dir 下所有文件的 { path: (mtime_ns, size) }, path 与 get_image_list 一致
+    来自扫描目录时的 stat, 传给 catalog.get_images_info 之后不需要再逐个 stat
+  '''
+  concept_dir = os.path.normpath(concept_dir).replace('\\', '/')
+  return {
+    f'{concept_dir}/{name}': (entry.mtime_ns, entry.size)
+    for name, entry in watcher.scandir(concept_dir).items() if not entry.is_dir
+  }
+
+def convert_and_copy_images(source_dir: str, target_dir: str, reencode: bool = True) -> dict:  
   '''
     source_dir 为绝对路径
     target_dir imageset-xxx 的相对路径
+    返回每个文件的导入结果, 见 importer.import_images
   '''
-  valid_image_extensions = {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'webp', '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
-  
-  # 获取源目录下的所有图片文件
-  files = [os.path.join(source_dir, filename) for filename in os.listdir(source_dir)]
-  files = [filename for filename in files if os.path.isfile(filename) and os.path.splitext(filename)[1].lower() in valid_image_extensions]
-  
-  # 我需要将 len(files) 张图片移动到 target_dir 中
-  index = get_next_image_count(target_dir, len(files))
-  image_count = 0
-  
-  for file_name in tqdm(files):
-    source_path = os.path.join(source_dir, file_name)
-    try:
-      with Image.open(source_path) as img:
-        if CONF_IMAGE_EXT == "JPEG":
-          img = img.convert("RGB")
-        # 生成新的文件名
-        new_file_name = f"{index:06d}.{CONF_IMAGE_EXT.lower()}"
-        target_path = os.path.join(CONF_REPO_DIR, target_dir, new_file_name)
-        # 保存为 JPG 格式
-        img.save(target_path, CONF_IMAGE_EXT)
-        # 增加计数器
-        index += 1
-        image_count += 1
-    except Exception:
-      continue
-  return image_count
+  # 我需要将 source_dir 中的图片移动到 target_dir 中, 在进程池中并行转换, 按照文件名顺序编号
+  report = importer.import_images(source_dir, target_dir, reencode=reencode)
+  # 在后台预先生成缩略图
+  thumbnail.prewarm([item['target'] for item in report['files'] if item['target'] is not None])
+  return report
 
 def load_caption(image_path: str) -> list[str]:
   '''
     image_path 从 imageset-xxx 开始
+    标签从索引中读取, 没有记录时才会从 exif 导入
   '''
-  import pyexiv2, json
-  image_path = os.path.join(CONF_REPO_DIR, image_path)
-  try:
-    metadata = pyexiv2.Image(image_path)
-    tags = metadata.read_comment()
-    metadata.close()
-  except Exception as e:
-    # 这里会报异常 XMP Toolkit error 203: Duplicate property or field node
-    # 是否应该 clear, 目前只能够使用 exiftool 手动删除
-    print(image_path)
-    print('exception', e)
-    return []
-  try: 
-    tags = json.loads(tags)
-  except:
-    tags = []
-  return tags
+  return caption.load_captions([image_path]).get(image_path, [])
 
 def save_caption(image_path: str, tags: list[str]):
-  import pyexiv2, json
-  image_path = os.path.join(CONF_REPO_DIR, image_path)
-  try:
-    metadata = pyexiv2.Image(image_path)
-    metadata.modify_comment(json.dumps(tags))
-    metadata.close()  
-  except Exception as e:
-    print(str(e))
-  
-  # 同时保存到文本文件中
-  file_name_with_extension = os.path.basename(image_path)
-  dirname = os.path.dirname(image_path)
-  name, _ = os.path.splitext(file_name_with_extension)
-  s = ", ".join(tags)
-  with open(os.path.join(dirname, f"{name}.txt"), "w") as f:
-    f.write(s)
-  
+  '''
+    标签先保存到索引, exif 与 txt 文件在后台写回
+  '''
+  caption.save_captions({image_path: tags})
   
 
 def dump_caption(concept_path):
   # imageset-xx/src/8_katana
   imagefiles = get_image_list(concept_path)
-  for imagefile in tqdm(imagefiles):
+  infos = catalog.get_images_info(imagefiles)
+  for imagefile in progress(imagefiles, desc='dump caption'):
     file_name_with_extension = os.path.basename(imagefile)
     dirname = os.path.dirname(imagefile)
     name, _ = os.path.splitext(file_name_with_extension)
-    tags = load_caption(imagefile)
+    tags = infos[imagefile]['captions'] if imagefile in infos else []
     s = ", ".join(tags)
     with open(os.path.join(CONF_REPO_DIR, dirname, f"{name}.txt"), "w") as f:
       f.write(s)
@@ -167,8 +122,9 @@ def dump_caption(concept_path):
 
 
 @api_imageset.get('/metadata')
-async def get_imageset_metadata(name: str):
+async def get_imageset_metadata(name: str, refresh_cover: bool = False):
   '''
+    每个概念的封面在第一次读取时随机选择, 之后保持不变(浏览器可以缓存), refresh_cover 为 true 时重新选择
     {
       'train': {
         'total_repeat': int, 
@@ -190,13 +146,14 @@ async def get_imageset_metadata(name: str):
   reg_dir = os.path.join('imageset-'+name, 'reg')
   
   
-  # 拼接出缩略图的url
-  # http://localhost:1420/image/imageset-mikasa/src/8_cloak/cloak___1.jpg
-  def load_cover(concept_image_filenames: list[str]) -> str | None:
-    if len(concept_image_filenames) <= 0:
+  # 拼接出缩略图的url, 带上封面图片的版本号, 图片没有变化时浏览器直接使用缓存
+  # http://localhost:1420/image/thumbnail/imageset-mikasa/src/8_cloak/cloak___1.jpg?size=cover&v=xxx
+  def cover_url(cover: str | None, infos: dict) -> str | None:
+    if cover is None:
       return None
-    random_element = random.choice(concept_image_filenames)
-    return random_element
+    if cover not in infos:
+      return f"http://{CONF_HOST}:{CONF_PORT}/image/thumbnail/{cover}?size=cover"
+    return f"http://{CONF_HOST}:{CONF_PORT}/image/thumbnail/{cover}?size=cover&v={infos[cover]['version']}"
   
   def get_metadata(train_or_regular_dir: str) -> dict:
     ret = {
@@ -206,15 +163,17 @@ async def get_imageset_metadata(name: str):
     }
 
     concepts = get_concept_folder_list(train_or_regular_dir)
+    images = { concept['path']: get_image_list(concept['path']) for concept in concepts }
+    covers = catalog.get_covers(images, refresh=refresh_cover)
+    infos = catalog.get_images_info([cover for cover in covers.values() if cover is not None])
 
     for concept in concepts:      
-      concept_image_filenames = get_image_list(concept['path'])
+      concept_image_filenames = images[concept['path']]
       
-      cover = load_cover(concept_image_filenames)
       count = len(concept_image_filenames)
       ret['concepts'].append({
         'name': concept['name'], 
-        'cover': f"http://{CONF_HOST}:{CONF_PORT}/image/{cover}" if cover is not None else None ,
+        'cover': cover_url(covers[concept['path']], infos),
         'repeat': concept['repeat'], 
         'image_count': count,
       })
@@ -275,23 +234,28 @@ async def load(imageset_name: str, is_regular: bool):
       'images': [],
     })
     imagefilenames = get_image_list(concept['path'])
+    infos = catalog.get_images_info(imagefilenames, get_image_stats(concept['path']))
     for imagefilename in imagefilenames:
       basename = os.path.basename(imagefilename)
       filename, _ = os.path.splitext(basename)
+      info = infos.get(imagefilename)
       result['images'].append({
         'src': f'http://{CONF_HOST}:{CONF_PORT}/image/{imagefilename}',
-        'thumbnail': f'http://{CONF_HOST}:{CONF_PORT}/image/thumbnail/{imagefilename}', # 缩略图都保存为 jpg 格式
+        'thumbnail': f'http://{CONF_HOST}:{CONF_PORT}/image/thumbnail/{imagefilename}' + (f'?v={info["version"]}' if info is not None else ''),
         'filename': filename,
         'basename': basename,
-        'captions': load_caption(imagefilename),
+        'captions': info['captions'] if info is not None else [],
         'concept': concept['name'], 
         'repeat': concept['repeat'],
         'path': imagefilename,
       })
   return result
 
+LOAD_CONCEPT_BATCH_SIZE = 256 # 流式返回时每次从索引中读取的图片数量
+
 @api_imageset.get("/load_concept")
-async def load_concept(imageset_name: str, is_regular: bool, concept_name: str, repeat: int):
+async def load_concept(imageset_name: str, is_regular: bool, concept_name: str, repeat: int,
+                       offset: int = 0, limit: int | None = None, cursor: str | None = None, stream: bool = False):
   '''
     {
       name : string, 
@@ -299,17 +263,12 @@ async def load_concept(imageset_name: str, is_regular: bool, concept_name: str,
       is_regular: boolean,
       imageset_name: string,
       images: ImageState[],
+      total: number,              // concept 中的图片总数
+      next_cursor: string | null, // 下一页的 cursor, 为 null 时表示已经加载完毕
     }
+    分页: 图片按照路径排序, 使用 offset 或者 cursor(上一页返回的 next_cursor) 指定起点, limit 指定数量
+    stream=true 时返回 application/x-ndjson, 第一行为不包含 images 的 concept 信息, 之后每一行为一个 ImageState
   '''
-  result = {
-    "name": concept_name, 
-    "repeat": repeat,
-    "is_regular": is_regular,
-    "imageset_name": imageset_name,
-    
-    "images": [],
-  }
-  
   imageset_dir = os.path.join("imageset-"+imageset_name)
   if is_regular:
     imageset_dir = os.path.join(imageset_dir, 'reg')
@@ -318,27 +277,60 @@ async def load_concept(imageset_name: str, is_regular: bool, concept_name: str,
   concept_dir = os.path.join(imageset_dir, f"{repeat}_{concept_name}")
   if not os.path.exists(os.path.join(CONF_REPO_DIR, concept_dir)):
     raise HTTPException(status_code=404, detail=f"{concept_dir} is not found")
-  # 加载 concept_dir 下面的所有图片
-  imagefilenames = get_image_list(concept_dir)
-  for imagefilename in imagefilenames:
-    basename = os.path.basename(imagefilename)
-    filename, _ = os.path.splitext(basename)
-    abs_path = os.path.join(CONF_REPO_DIR, imagefilename)
-    with Image.open(abs_path) as img:
-      width, height = img.size
-    result['images'].append({
-      'src': f'http://{CONF_HOST}:{CONF_PORT}/image/{imagefilename}',
-      'thumbnail': f'http://{CONF_HOST}:{CONF_PORT}/image/thumbnail/{imagefilename}',
-      'filename': filename,
-      'basename': basename,
-      'captions': load_caption(imagefilename),
-      'concept': concept_name, 
-      'repeat': repeat,
-      'path': imagefilename,
-      'width': width,
-      'height': height,
-      'size': os.path.getsize(abs_path),
-    })
+  # 加载 concept_dir 下面的所有图片, 排序之后分页才是稳定的
+  imagefilenames = sorted(get_image_list(concept_dir))
+  stats = get_image_stats(concept_dir)
+  total = len(imagefilenames)
+  if offset == 0 and cursor is None and limit is None:
+    catalog.prune_dir(concept_dir, imagefilenames)
+  if cursor is not None:
+    offset = bisect.bisect_right(imagefilenames, cursor)
+  end = total if limit is None else min(total, offset + limit)
+  imagefilenames = imagefilenames[offset:end]
+  next_cursor = imagefilenames[-1] if end < total and len(imagefilenames) > 0 else None
+  
+  result = {
+    "name": concept_name, 
+    "repeat": repeat,
+    "is_regular": is_regular,
+    "imageset_name": imageset_name,
+    "total": total,
+    "next_cursor": next_cursor,
+  }
+  
+  def load_images(imagefilenames: list[str]):
+    # 宽高, 大小以及标签都从索引中读取, 只有发生变化的图片才会重新打开
+    infos = catalog.get_images_info(imagefilenames, stats)
+    for imagefilename in imagefilenames:
+      info = infos.get(imagefilename)
+      if info is None:
+        continue
+      basename = os.path.basename(imagefilename)
+      filename, _ = os.path.splitext(basename)
+      yield {
+        'src': f'http://{CONF_HOST}:{CONF_PORT}/image/{imagefilename}',
+        'thumbnail': f'http://{CONF_HOST}:{CONF_PORT}/image/thumbnail/{imagefilename}?v={info["version"]}',
+        'filename': filename,
+        'basename': basename,
+        'captions': info['captions'],
+        'concept': concept_name, 
+        'repeat': repeat,
+        'path': imagefilename,
+        'width': info['width'],
+        'height': info['height'],
+        'size': info['size'],
+      }
+  
+  if stream:
+    def generate():
+      yield json.dumps(result) + '\n'
+      for i in range(0, len(imagefilenames), LOAD_CONCEPT_BATCH_SIZE):
+        batch = imagefilenames[i:i+LOAD_CONCEPT_BATCH_SIZE]
+        yield ''.join(json.dumps(image) + '\n' for image in load_images(batch))
+    # 同步生成器会被放到线程池中迭代, 不会阻塞事件循环
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+  
+  result['images'] = list(load_images(imagefilenames))
   return result
 
 @api_imageset.get("/open_in_file_explore")
@@ -357,8 +349,7 @@ async def get_imageset_list():
   '''
     查找已经创建的所有数据集
   '''
-  imageset_names = os.listdir(CONF_REPO_DIR)
-  imageset_names = [name[9:] for name in imageset_names if name.startswith('imageset-')]
+  imageset_names = [name[9:] for name, is_dir in watcher.listdir('').items() if is_dir and name.startswith('imageset-')]
   return imageset_names
 
 
@@ -381,7 +372,9 @@ async def add_concept(
   concept_name: str, 
   repeat: int, 
   type: str, 
-  load_directory: str):
+  load_directory: str,
+  reencode: bool = True,
+  background: bool = False):
   # load_directory 需要是绝对路径
   dir = 'imageset-' + imageset_name
   if type == 'train':
@@ -397,11 +390,11 @@ async def add_concept(
   if not os.path.exists(abs_concept_dir):
     os.makedirs(abs_concept_dir, exist_ok=True)
   if not os.path.exists(load_directory):
-    return 0
+    return { 'imported': 0, 'skipped': 0, 'failed': 0, 'files': [] }
   
   # 将 load_directory 目录下的所有图片全部复制到concept目录下, 并全部转换为统一格式, 统一命名
-  image_count = convert_and_copy_images(load_directory, concept_dir)
-  return image_count
+  # reencode 为 false 时, 已经是 CONF_IMAGE_EXT 格式的图片直接复制
+  return await job.run('add_concept', convert_and_copy_images, load_directory, concept_dir, reencode, background=background)
 
 @api_imageset.post("/uploadimages")
 async def upload_images(files: List[UploadFile] = File(...), 
@@ -415,66 +408,142 @@ async def upload_images(files: List[UploadFile] = File(...),
   if not os.path.exists(abs_dest_dir):
     os.makedirs(abs_dest_dir, exist_ok=True)
   
-  index = get_next_image_count(dest_dir, len(files))
-  
-  for file in tqdm(files):
-    contents = await file.read()
-    image = Image.open(io.BytesIO(contents))
-    if CONF_IMAGE_EXT == "JPEG":
-      image = image.convert("RGB")
-    file_path = os.path.join(CONF_REPO_DIR, dest_dir, f'{index:06d}.{CONF_IMAGE_EXT.lower()}')
-    index += 1
-    image.save(file_path, CONF_IMAGE_EXT)
+  uploaded = []
+  # 先写入临时文件再发布为分配的编号, 同时上传到同一个概念也不会相互覆盖
+  with naming.allocate(dest_dir, len(files)) as allocation:
+    for file in progress(files):
+      contents = await file.read()
+      image = Image.open(io.BytesIO(contents))
+      if CONF_IMAGE_EXT == "JPEG":
+        image = image.convert("RGB")
+      temp_path = naming.temp_path(dest_dir, 'upload')
+      try:
+        image.save(temp_path, CONF_IMAGE_EXT)
+        uploaded.append(allocation.publish(temp_path))
+      finally:
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+    index = allocation.next
+  thumbnail.prewarm(uploaded)
   return index
 
-@api_imageset.post("/explore")
-async def explore(imageset_name: str):
-  zip_files = glob.glob(os.path.join(CONF_REPO_DIR, '*.zip'))
-  for zip_file in zip_files:
-    os.remove(zip_file)
-  # 创建临时目录
-  temp_dir = os.path.join(CONF_REPO_DIR, ".temp")
-  if os.path.exists(temp_dir):
-    shutil.rmtree(temp_dir)
-  os.makedirs(temp_dir, exist_ok=True)
-  
-  # 导出数据集
-  train_dir = os.path.join('imageset-'+imageset_name, 'src')
-  reg_dir = os.path.join('imageset-'+imageset_name, 'reg')
-  if os.path.exists(os.path.join(CONF_REPO_DIR, train_dir)):
-    temp_train_dir = os.path.join(temp_dir, 'src')
-    os.makedirs(temp_train_dir, exist_ok=True)
-    concepts = get_concept_folder_list(train_dir)
-    for concept in concepts:
-      # 对每个概念，首先将标签导出为 txt 文件
-      dump_caption(concept['path'])
-      shutil.copytree(os.path.join(CONF_REPO_DIR, concept['path']), os.path.join(temp_train_dir, f"{concept['repeat']}_{concept['name']}"))
-  if os.path.exists(os.path.join(CONF_REPO_DIR, reg_dir)):
-    temp_reg_dir = os.path.join(temp_dir, 'reg')
-    os.makedirs(temp_reg_dir, exist_ok=True)
-    concepts = get_concept_folder_list(reg_dir)
+def export_entries(imageset_name: str) -> list[archive.Entry]:
+  '''
+    导出数据集的 zip 条目, 目录结构为 src/8_katana/000000.png, src/8_katana/000000.txt, reg/...
+    图片直接从源文件读取, 标签文本由索引中的 captions 在内存中生成, 不写入磁盘
+  '''
+  entries = []
+  for kind in ['src', 'reg']:
+    kind_dir = os.path.join('imageset-'+imageset_name, kind)
+    if not os.path.exists(os.path.join(CONF_REPO_DIR, kind_dir)):
+      continue
+    concepts = sorted(get_concept_folder_list(kind_dir), key=lambda concept: concept['path'])
     for concept in concepts:
-      # 对每个概念，首先将标签导出为 txt 文件
-      dump_caption(concept['path'])
-      shutil.copytree(os.path.join(CONF_REPO_DIR, concept['path']), os.path.join(temp_reg_dir, f"{concept['repeat']}_{concept['name']}"))
-  
-  shutil.make_archive(os.path.join(CONF_REPO_DIR, imageset_name), 'zip', temp_dir)
-  shutil.rmtree(temp_dir)
-  return FileResponse(os.path.join(CONF_REPO_DIR, f"{imageset_name}.zip"), media_type='application/zip', filename=f"{imageset_name}.zip")
+      folder = f"{kind}/{concept['repeat']}_{concept['name']}"
+      imagefiles = sorted(get_image_list(concept['path']))
+      infos = catalog.get_images_info(imagefiles)
+      for imagefile in imagefiles:
+        if imagefile not in infos:
+          continue
+        abs_path = os.path.join(CONF_REPO_DIR, imagefile)
+        try:
+          st = os.stat(abs_path)
+        except OSError:
+          continue
+        file_name_with_extension = os.path.basename(imagefile)
+        name, _ = os.path.splitext(file_name_with_extension)
+        caption = ", ".join(infos[imagefile]['captions']).encode('utf-8')
+        entries.append(archive.Entry(f'{folder}/{file_name_with_extension}', st.st_size, st.st_mtime, path=abs_path))
+        entries.append(archive.Entry(f'{folder}/{name}.txt', len(caption), st.st_mtime, data=caption))
+  return entries
+
+def parse_range(range_header: str | None, size: int) -> tuple[int, int] | None:
+  '''
+    解析 Range: bytes=start-end, 返回 [start, end), 没有 Range 或者包含多个范围时返回 None(返回完整内容)
+    范围无法满足时抛出 416
+  '''
+  if range_header is None:
+    return None
+  unit, _, ranges = range_header.partition('=')
+  if unit.strip() != 'bytes' or ',' in ranges:
+    return None
+  first, _, last = ranges.strip().partition('-')
+  try:
+    if first == '':
+      start, end = max(0, size - int(last)), size
+    else:
+      start = int(first)
+      end = min(size, int(last) + 1) if last != '' else size
+  except ValueError:
+    return None
+  if start >= end or start >= size:
+    raise HTTPException(status_code=416, detail='range not satisfiable', headers={'Content-Range': f'bytes */{size}'})
+  return start, end
+
+@api_imageset.get("/explore")
+@api_imageset.post("/explore")
+async def explore(imageset_name: str, request: Request):
+  '''
+    以 zip 流的形式导出数据集, 不生成临时文件
+    内容是确定的, 支持 Range 与 If-Range, 下载中断之后可以从断点继续
+  '''
+  if not os.path.exists(os.path.join(CONF_REPO_DIR, 'imageset-'+imageset_name)):
+    raise HTTPException(status_code=404, detail=f'imageset {imageset_name} is not found')
+  entries = await run_in_threadpool(export_entries, imageset_name)
+  stream = archive.ZipStream(entries)
+  etag = stream.etag()
+  headers = {
+    'Accept-Ranges': 'bytes',
+    'ETag': etag,
+    'Content-Disposition': f'attachment; filename="{imageset_name}.zip"',
+  }
+  byte_range = parse_range(request.headers.get('range'), stream.size)
+  if_range = request.headers.get('if-range')
+  if byte_range is not None and if_range is not None and if_range != etag:
+    # 数据集在两次下载之间发生了变化, 重新下载完整内容
+    byte_range = None
+  if byte_range is None:
+    headers['Content-Length'] = str(stream.size)
+    return StreamingResponse(stream.iter_bytes(), media_type='application/zip', headers=headers)
+  start, end = byte_range
+  headers['Content-Length'] = str(end - start)
+  headers['Content-Range'] = f'bytes {start}-{end - 1}/{stream.size}'
+  return StreamingResponse(stream.iter_bytes(start, end), status_code=206, media_type='application/zip', headers=headers)
   
 
 
+# 以下移动, 重命名与删除需要持有 caption.file_lock, 写回标签时会长时间持有, 在线程池中执行, 不阻塞事件循环
+def rename_dir(origin_name: str, new_name: str):
+  new_path = os.path.join(CONF_REPO_DIR, new_name)
+  origin_path = os.path.join(CONF_REPO_DIR, origin_name)
+  with caption.file_lock:
+    try:
+      os.rename(origin_path, new_path)  
+    except Exception as e:
+      print(str(e))
+      raise HTTPException(status_code=400, detail=str(e))
+    # 标签跟随目录移动, 缩略图按照路径保存, 直接删除
+    catalog.rename_dir(origin_name, new_name)
+  thumbnail.remove_dir(origin_name)
+  decode.remove_dir(origin_name)
+  confidence.rename_dir(origin_name, new_name)
+
+def rename_concept_dir(origin_dir: str, new_dir: str):
+  with caption.file_lock:
+    try:
+      thumbnail.remove_dir(origin_dir)
+      decode.remove_dir(origin_dir)
+      os.rename(os.path.join(CONF_REPO_DIR, origin_dir), os.path.join(CONF_REPO_DIR, new_dir))
+    except Exception as e:
+      raise HTTPException(status_code=400, detail=str(e))
+    catalog.rename_dir(origin_dir, new_dir)
+  confidence.rename_dir(origin_dir, new_dir)
+
 @api_imageset.put("/rename")  
 async def rename_imageset(origin_name: str, new_name: str): 
   new_name = 'imageset-' + new_name
   origin_name = 'imageset-' + origin_name
-  new_path = os.path.join(CONF_REPO_DIR, new_name)
-  origin_path = os.path.join(CONF_REPO_DIR, origin_name)
-  try:
-    os.rename(origin_path, new_path)  
-  except Exception as e:
-    print(str(e))
-    raise HTTPException(status_code=400, detail=str(e))
+  await run_in_threadpool(rename_dir, origin_name, new_name)
   return new_name
 
 @api_imageset.put("/rename_concept")
@@ -485,44 +554,53 @@ async def rename_concept(imageset_name: str, is_regular: bool, origin_name: str,
     dir = os.path.join('imageset-'+imageset_name, 'src')
   origin_dir = os.path.join(dir, f'{origin_repeat}_{origin_name}')
   new_dir = os.path.join(dir, f'{new_repeat}_{new_name}')
-  origin_thumbnail_dir = os.path.join(CONF_REPO_DIR, '.thumbnail', dir, f"{origin_repeat}_{origin_name}")
-  try:
-    if os.path.exists(origin_thumbnail_dir):
-      shutil.rmtree(origin_thumbnail_dir)
-    os.rename(os.path.join(CONF_REPO_DIR, origin_dir), os.path.join(CONF_REPO_DIR, new_dir))
-  except Exception as e:
-    raise HTTPException(status_code=400, detail=str(e))
+  await run_in_threadpool(rename_concept_dir, origin_dir, new_dir)
   return {
     'name': new_name, 
     'repeat': new_repeat,
   }
 
+def convert_concept_images(base_dir: str):
+  # 先删除缩略图
+  thumbnail.remove_dir(base_dir)
+  decode.remove_dir(base_dir)
+  
+  imagefilenames = get_image_list(base_dir)
+  with naming.allocate(base_dir, len(imagefilenames)) as allocation:
+    for imagefilename in progress(imagefilenames, desc='convert'):
+      convert_concept_image(allocation, imagefilename)
+
+def convert_concept_image(allocation: naming.Allocation, imagefilename: str):
+  # 注意不要把标签掉了
+  tags = load_caption(imagefilename)
+  temp_path = naming.temp_path(allocation.dir, 'convert')
+  try:
+    with Image.open(os.path.join(CONF_REPO_DIR, imagefilename)) as img:
+      if CONF_IMAGE_EXT == "JPEG":
+        img = img.convert('RGB')
+      img.save(temp_path, CONF_IMAGE_EXT)
+    newfilename = allocation.publish(temp_path)
+  finally:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+  # 删除原始图片
+  with caption.file_lock:
+    os.remove(os.path.join(CONF_REPO_DIR, imagefilename))
+    if os.path.exists(caption.txt_path(os.path.join(CONF_REPO_DIR, imagefilename))):
+      os.remove(caption.txt_path(os.path.join(CONF_REPO_DIR, imagefilename)))
+    catalog.remove_images([imagefilename])
+  confidence.remove([imagefilename])
+  # 重新编码之后 exif 已经丢失, 标记为需要写回
+  save_caption(newfilename, tags)
+  catalog.mark_dirty([newfilename])
+
 @api_imageset.put("/rename_and_convert")
-async def rename_and_convert(imageset_name: str, is_regular: bool, concept_folder: str):
+async def rename_and_convert(imageset_name: str, is_regular: bool, concept_folder: str, background: bool = False):
   if is_regular:
     base_dir = os.path.join('imageset-'+imageset_name, 'reg', concept_folder)
   else:
     base_dir = os.path.join('imageset-'+imageset_name, 'src', concept_folder)
-  # 先删除缩略图
-  thumbnail_dir = os.path.join(CONF_REPO_DIR, ".thumbnail", base_dir)
-  if os.path.exists(thumbnail_dir):
-    shutil.rmtree(thumbnail_dir)
-  
-  imagefilenames = get_image_list(base_dir)
-  index = get_next_image_count(base_dir, len(imagefilenames))
-  for imagefilename in tqdm(imagefilenames):
-    newfilename = os.path.join(base_dir, f"{index:06d}.{CONF_IMAGE_EXT.lower()}")
-    index += 1
-    # 注意不要把标签掉了
-    tags = load_caption(imagefilename)
-    img = Image.open(os.path.join(CONF_REPO_DIR, imagefilename))
-    if CONF_IMAGE_EXT == "JPEG":
-      img = img.convert('RGB')
-    img.save(os.path.join(CONF_REPO_DIR, newfilename), CONF_IMAGE_EXT)
-    img.close()
-    save_caption(newfilename, tags)
-    # 删除原始图片
-    os.remove(os.path.join(CONF_REPO_DIR, imagefilename))
+  return await job.run('rename_and_convert', convert_concept_images, base_dir, background=background)
 
 class MoveRequest(BaseModel):
   filenames: List[str]
@@ -530,6 +608,27 @@ class MoveRequest(BaseModel):
   is_regular: bool
   concept_name: str 
   repeat: int  
+def move_images(filenames: list[str], d: str):
+  dest_path = os.path.join(CONF_REPO_DIR, d)
+  if not os.path.exists(dest_path):
+    os.makedirs(dest_path, exist_ok=True)
+  # 将图片移动过去, 直接发布为分配的编号, 不会覆盖目标目录中已有的图片
+  moved = {}
+  with caption.file_lock, naming.allocate(d, len(filenames)) as allocation:
+    for filename in progress(filenames):
+      src_path = os.path.join(CONF_REPO_DIR, filename)
+      new_path = allocation.publish(src_path)
+      # 同名的 txt 标签文件一起移动
+      if os.path.exists(caption.txt_path(src_path)):
+        shutil.move(caption.txt_path(src_path), caption.txt_path(os.path.join(CONF_REPO_DIR, new_path)))
+      # 移动会保留原图的 mtime, 目标位置可能残留同名的旧缩略图, 一起删除
+      thumbnail.remove([filename, new_path])
+      decode.remove([filename, new_path])
+      moved[filename] = new_path
+    catalog.move_images(moved)
+  confidence.remove(list(moved.keys()))
+  thumbnail.prewarm(list(moved.values()))
+
 @api_imageset.put("/move")  
 async def move(request: MoveRequest):
   # 将 filenames 中的图片移动到对应的地址即可
@@ -538,19 +637,7 @@ async def move(request: MoveRequest):
   else:
     d = os.path.join("imageset-"+request.imageset_name, "src")
   d = os.path.join(d, f"{request.repeat}_{request.concept_name}")
-  dest_path = os.path.join(CONF_REPO_DIR, d)
-  if not os.path.exists(dest_path):
-    os.makedirs(dest_path, exist_ok=True)
-  # 将图片移动过去
-  id = get_next_image_count(d, len(request.filenames))
-  
-  for filename in tqdm(request.filenames):
-    src_path = os.path.join(CONF_REPO_DIR, filename)
-    thumbnail = os.path.join(CONF_REPO_DIR, '.thumbnail', filename)
-    shutil.move(src_path, os.path.join(dest_path, f"{id:06d}.{CONF_IMAGE_EXT.lower()}"))
-    if os.path.exists(thumbnail):
-      os.remove(thumbnail)
-    id += 1
+  await run_in_threadpool(move_images, request.filenames, d)
   
 
 
@@ -561,54 +648,60 @@ async def delete_imageset(name: str):
 
   imageset_dir = os.path.join(CONF_REPO_DIR, 'imageset-' + name)
   # 注意先删除缩略图再删除原图
-  thumbnail_dir = os.path.join(CONF_REPO_DIR, '.thumbnail', 'imageset-'+name)
-  if os.path.exists(thumbnail_dir):
-    shutil.rmtree(thumbnail_dir)
+  thumbnail.remove_dir('imageset-' + name)
+  decode.remove_dir('imageset-' + name)
   if os.path.exists(imageset_dir):
     shutil.rmtree(imageset_dir)
+  catalog.remove_dir(imageset_dir)
+  confidence.remove_dir('imageset-' + name)
   
 
 @api_imageset.delete("/delete/src")
 async def delete_train(name: str):
   imageset_dir = os.path.join(CONF_REPO_DIR, 'imageset-' + name, 'src')
-  thumbnail_dir = os.path.join(CONF_REPO_DIR, '.thumbnail', 'imageset-' + name, 'src')
-  if os.path.exists(thumbnail_dir):
-    shutil.rmtree(thumbnail_dir)
+  thumbnail.remove_dir(os.path.join('imageset-' + name, 'src'))
+  decode.remove_dir(os.path.join('imageset-' + name, 'src'))
   if os.path.exists(imageset_dir):
     shutil.rmtree(imageset_dir)
+  catalog.remove_dir(imageset_dir)
+  confidence.remove_dir(os.path.join('imageset-' + name, 'src'))
   
 @api_imageset.delete("/delete/reg")
 async def delete_regular(name: str):
   imageset_dir = os.path.join(CONF_REPO_DIR, 'imageset-' + name, 'reg')
-  thumbnail_dir = os.path.join(CONF_REPO_DIR, '.thumbnail', 'imageset-' + name, 'reg')
-  if os.path.exists(thumbnail_dir):
-    shutil.rmtree(thumbnail_dir)
+  thumbnail.remove_dir(os.path.join('imageset-' + name, 'reg'))
+  decode.remove_dir(os.path.join('imageset-' + name, 'reg'))
   if os.path.exists(imageset_dir):
     shutil.rmtree(imageset_dir)
+  catalog.remove_dir(imageset_dir)
+  confidence.remove_dir(os.path.join('imageset-' + name, 'reg'))
   
 class DeleteImageRequest(BaseModel):
   filenames: List[str]
 
-@api_imageset.delete("/delete/images")
-async def delete_images(request: DeleteImageRequest):
+def delete_image_files(filenames: list[str]) -> list[str]:
   deleted_names = []
-  for filename in tqdm(request.filenames):
-    abs_filename = os.path.join(CONF_REPO_DIR, filename)
-    thumbnail_filename = os.path.join(CONF_REPO_DIR, '.thumbnail', filename)
-    try:
-      if os.path.exists(thumbnail_filename):
-        os.remove(thumbnail_filename)
-    except Exception as e:
-      print(e)
-      continue
-    try:
-      if os.path.exists(abs_filename):
-        os.remove(abs_filename)
-    except Exception as e:
-      print(e)
-      continue
-    deleted_names.append(filename)
+  with caption.file_lock:
+    for filename in progress(filenames):
+      abs_filename = os.path.join(CONF_REPO_DIR, filename)
+      thumbnail.remove([filename])
+      decode.remove([filename])
+      try:
+        if os.path.exists(abs_filename):
+          os.remove(abs_filename)
+        if os.path.exists(caption.txt_path(abs_filename)):
+          os.remove(caption.txt_path(abs_filename))
+      except Exception as e:
+        print(e)
+        continue
+      deleted_names.append(filename)
+    catalog.remove_images(deleted_names)
+  confidence.remove(deleted_names)
   return deleted_names
+
+@api_imageset.delete("/delete/images")
+async def delete_images(request: DeleteImageRequest):
+  return await run_in_threadpool(delete_image_files, request.filenames)
   
 @api_imageset.delete("/delete_concept")
 async def delete_concept(imageset_name: str, is_regular: bool, concept_folder: str):
@@ -616,12 +709,13 @@ async def delete_concept(imageset_name: str, is_regular: bool, concept_folder: s
     dir = os.path.join('imageset-'+imageset_name, 'reg', concept_folder)
   else:
     dir = os.path.join('imageset-'+imageset_name, 'src', concept_folder)
-  thumbnail_dir = os.path.join(CONF_REPO_DIR, '.thumbnail', dir)
+  thumbnail.remove_dir(dir)
+  decode.remove_dir(dir)
+  confidence.remove_dir(dir)
   dir = os.path.join(CONF_REPO_DIR, dir)
-  if os.path.exists(thumbnail_dir):
-    shutil.rmtree(thumbnail_dir)
   if os.path.exists(dir):
     shutil.rmtree(dir)
+  catalog.remove_dir(dir)
   
 
 
@@ -0,0 +1,86 @@
+'''
+  并行导入图片
+
+  1. 源目录中的图片按文件名排序, 在进程池中并行地解码, 转换为 CONF_IMAGE_EXT 并写入目标目录下的临时文件
+     源图片已经是 CONF_IMAGE_EXT 格式并且 reencode=False 时直接复制, 不重新编码
+  2. 主进程按照源文件的顺序依次将成功的临时文件发布为 naming 分配的序号,
+     因此无论各个进程完成的先后顺序如何, 输出的编号都是连续并且有序的; 同时导入同一个概念也不会相互覆盖
+  3. 返回每个文件的导入结果 imported / copied / skipped / failed
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from .config import CONF_REPO_DIR, CONF_IMAGE_EXT, CONF_IMPORT_WORKERS
+from .job import progress
+from . import naming
+import shutil
+import os
+
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
+
+
+def convert_image(source_path: str, temp_path: str, reencode: bool = True) -> tuple[str, str | None]:
+  '''
+    在子进程中执行, 返回 (status, error), status 为 imported, copied 或者 failed
+  '''
+  try:
+    with Image.open(source_path) as img:
+      if not reencode and img.format == CONF_IMAGE_EXT:
+        shutil.copyfile(source_path, temp_path)
+        return 'copied', None
+      if CONF_IMAGE_EXT == "JPEG":
+        img = img.convert("RGB")
+      img.save(temp_path, CONF_IMAGE_EXT)
+    return 'imported', None
+  except Exception as e:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+    return 'failed', str(e)
+
+def import_images(source_dir: str, target_dir: str, reencode: bool = True) -> dict:
+  '''
+    source_dir 为绝对路径, target_dir 为 imageset-xxx 开始的相对路径
+    return {
+      imported: int, skipped: int, failed: int,
+      files: [{ source: str, target: str | None, status: str, error: str | None }],
+    }
+  '''
+  entries = sorted(os.listdir(source_dir))
+  files, report = [], []
+  for name in entries:
+    source_path = os.path.join(source_dir, name)
+    if not os.path.isfile(source_path):
+      continue
+    if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+      report.append({ 'source': source_path, 'target': None, 'status': 'skipped', 'error': 'unsupported extension' })
+      continue
+    files.append(source_path)
+
+  temp_paths = [naming.temp_path(target_dir, f'import-{i}') for i in range(len(files))]
+  imported = []
+  executor = ProcessPoolExecutor(max_workers=max(1, min(CONF_IMPORT_WORKERS, len(files)))) if len(files) > 0 else None
+  try:
+    with naming.allocate(target_dir, len(files)) as allocation:
+      results = executor.map(convert_image, files, temp_paths, [reencode] * len(files), chunksize=4) if executor is not None else []
+      # map 按照提交的顺序返回结果, 按顺序分配序号
+      for source_path, temp_path, (status, error) in progress(zip(files, temp_paths, results), total=len(files), desc='import'):
+        if status == 'failed':
+          report.append({ 'source': source_path, 'target': None, 'status': status, 'error': error })
+          continue
+        target = allocation.publish(temp_path)
+        imported.append(target)
+        report.append({ 'source': source_path, 'target': target, 'status': status, 'error': None })
+  finally:
+    if executor is not None:
+      executor.shutdown(wait=True, cancel_futures=True)
+    # 任务被取消或者出错时清理剩余的临时文件
+    for temp_path in temp_paths:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+  return {
+    'imported': len(imported),
+    'skipped': len([item for item in report if item['status'] == 'skipped']),
+    'failed': len([item for item in report if item['status'] == 'failed']),
+    'files': report,
+  }
@@ -0,0 +1,189 @@
+'''
+  后台任务
+
+  耗时较长的批量接口(打标, 相似图片检测, 导入等)放到工作线程中执行, 不阻塞 uvicorn 的事件循环
+  接口传入 background=true 时立即返回 { job_id }, 之后通过以下接口获取进度与结果
+    GET    /job/{job_id}          轮询任务状态
+    GET    /job/{job_id}/events   server-sent events, 每次进度变化推送一次
+    GET    /job/{job_id}/result   获取任务结果
+    DELETE /job/{job_id}          取消任务
+  任务内部使用 progress 代替 tqdm 汇报进度, 并在每次迭代时检查是否被取消
+'''
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from tqdm import tqdm
+from .config import CONF_JOB_WORKERS
+import threading
+import contextvars
+import asyncio
+import json
+import time
+import uuid
+
+
+api_job = APIRouter()
+
+MAX_FINISHED_JOBS = 100 # 最多保留的已结束任务数量
+
+
+class JobCancelled(Exception):
+  pass
+
+class Job:
+  def __init__(self, name: str):
+    self.id = uuid.uuid4().hex
+    self.name = name
+    self.status = 'pending' # pending, running, done, failed, cancelled
+    self.stage = None       # 当前阶段, 对应 progress 的 desc
+    self.progress = 0
+    self.total = 0
+    self.result = None
+    self.error = None
+    self.created_at = time.time()
+    self.finished_at = None
+    self.version = 0        # 每次状态变化加一, 用于 server-sent events
+    self._cancel_event = threading.Event()
+
+  @property
+  def cancelled(self) -> bool:
+    return self._cancel_event.is_set()
+
+  @property
+  def finished(self) -> bool:
+    return self.status in ('done', 'failed', 'cancelled')
+
+  def cancel(self):
+    self._cancel_event.set()
+
+  def update(self, **kwargs):
+    for key, value in kwargs.items():
+      setattr(self, key, value)
+    self.version += 1
+
+  def to_dict(self) -> dict:
+    return {
+      'job_id': self.id,
+      'name': self.name,
+      'status': self.status,
+      'stage': self.stage,
+      'progress': self.progress,
+      'total': self.total,
+      'error': self.error,
+      'created_at': self.created_at,
+      'finished_at': self.finished_at,
+    }
+
+
+_executor = ThreadPoolExecutor(max_workers=CONF_JOB_WORKERS, thread_name_prefix='job')
+_jobs: OrderedDict[str, Job] = OrderedDict()
+_jobs_lock = threading.Lock()
+_current_job: contextvars.ContextVar[Job | None] = contextvars.ContextVar('current_job', default=None)
+
+
+def current_job() -> Job | None:
+  return _current_job.get()
+
+def progress(iterable, total: int | None = None, desc: str | None = None):
+  '''
+    代替 tqdm, 在后台任务中运行时向任务汇报进度, 被取消时抛出 JobCancelled
+    不在后台任务中时退化为 tqdm
+  '''
+  job = _current_job.get()
+  if job is None:
+    yield from tqdm(iterable, total=total, desc=desc)
+    return
+  if total is None and hasattr(iterable, '__len__'):
+    total = len(iterable)
+  job.update(stage=desc, progress=0, total=total or 0)
+  for i, item in enumerate(iterable):
+    if job.cancelled:
+      raise JobCancelled()
+    yield item
+    job.update(progress=i + 1)
+
+def _run(job: Job, fn, args, kwargs):
+  token = _current_job.set(job)
+  job.update(status='running')
+  try:
+    result = fn(*args, **kwargs)
+    job.update(status='cancelled' if job.cancelled else 'done', result=result, finished_at=time.time())
+  except JobCancelled:
+    job.update(status='cancelled', finished_at=time.time())
+  except HTTPException as e:
+    job.update(status='failed', error=e.detail, finished_at=time.time())
+  except Exception as e:
+    print(f'job {job.name} failed', e)
+    job.update(status='failed', error=str(e), finished_at=time.time())
+  finally:
+    _current_job.reset(token)
+
+def submit(name: str, fn, *args, **kwargs) -> Job:
+  job = Job(name)
+  with _jobs_lock:
+    _jobs[job.id] = job
+    # 清理最早结束的任务
+    finished = [job_id for job_id, j in _jobs.items() if j.finished]
+    for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+      del _jobs[job_id]
+  _executor.submit(_run, job, fn, args, kwargs)
+  return job
+
+async def run(name: str, fn, *args, background: bool = False, **kwargs):
+  '''
+    background 为 True 时提交为后台任务并返回 { job_id, ... },
+    否则在线程池中执行 fn 并直接返回结果
+  '''
+  if background:
+    return submit(name, fn, *args, **kwargs).to_dict()
+  return await run_in_threadpool(fn, *args, **kwargs)
+
+def get_job(job_id: str) -> Job:
+  job = _jobs.get(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail=f'job {job_id} is not found')
+  return job
+
+
+@api_job.get('/')
+async def list_jobs():
+  return [job.to_dict() for job in list(_jobs.values())]
+
+@api_job.get('/{job_id}')
+async def get_job_status(job_id: str):
+  return get_job(job_id).to_dict()
+
+@api_job.get('/{job_id}/result')
+async def get_job_result(job_id: str):
+  job = get_job(job_id)
+  if job.status == 'failed':
+    raise HTTPException(status_code=500, detail=job.error)
+  if not job.finished:
+    raise HTTPException(status_code=409, detail=f'job {job_id} is {job.status}')
+  return job.result
+
+@api_job.delete('/{job_id}')
+async def cancel_job(job_id: str):
+  job = get_job(job_id)
+  job.cancel()
+  return job.to_dict()
+
+@api_job.get('/{job_id}/events')
+async def job_events(job_id: str):
+  job = get_job(job_id)
+
+  async def generate():
+    version = -1
+    while True:
+      if job.version != version:
+        version = job.version
+        event = 'end' if job.finished else 'progress'
+        yield f'event: {event}\ndata: {json.dumps(job.to_dict())}\n\n'
+        if job.finished:
+          return
+      await asyncio.sleep(0.2)
+
+  return StreamingResponse(generate(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
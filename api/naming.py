@@ -0,0 +1,195 @@
+'''
+  概念目录中图片编号的分配
+
+  导入, 上传, 移动与重新编号都把图片命名为 000123.png 这样的连续编号, 多个请求(包括多个 uvicorn worker)
+  同时写入同一个概念时不能得到相同的编号, 也不能覆盖已有的文件
+  - 分配: 在概念目录下的 .reservations.json 中记录已经分配但是还没有写完的编号范围,
+    读写时持有进程内的锁与文件锁(flock / msvcrt), 新的范围接在目录中已有的编号与所有预留的编号之后
+  - 写入: 调用方先写入同一目录下的临时文件, 再通过 publish 以硬链接的方式发布为最终的文件名,
+    目标已经存在(例如外部程序写入)时不会覆盖, 而是顺延到下一个编号; 文件系统不支持硬链接时退回 rename
+  - 释放: 写完之后删除预留记录, 进程崩溃残留的记录只会让编号出现空缺, 超过 RESERVATION_TIMEOUT 之后清理
+
+    with naming.allocate('imageset-xxx/src/8_katana', len(files)) as allocation:
+      for temp_path in temp_paths:
+        path = allocation.publish(temp_path)   # imageset-xxx/src/8_katana/000123.png
+'''
+
+from contextlib import contextmanager
+from .config import CONF_REPO_DIR, CONF_IMAGE_EXT
+from . import watcher
+import threading
+import shutil
+import json
+import time
+import uuid
+import os
+
+if os.name == 'nt':
+  import msvcrt
+
+  def _lock_file(f):
+    f.seek(0)
+    while True:
+      try:
+        # LK_LOCK 重试 10 秒之后仍然失败时抛出异常, 继续等待
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        return
+      except OSError:
+        continue
+
+  def _unlock_file(f):
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+  import fcntl
+
+  def _lock_file(f):
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+  def _unlock_file(f):
+    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+RESERVATIONS_FILE = '.reservations.json'
+RESERVATION_TIMEOUT = 24 * 3600 # 秒, 超过之后视为进程已经崩溃
+
+# 目录中已有的编号范围, 目录列表没有变化时不需要重新解析文件名
+_numbering: dict[str, tuple[dict, int | None, int]] = {} # dir: (listdir 的结果, 最小编号, 最大编号)
+_locks: dict[str, threading.Lock] = {}
+_locks_lock = threading.Lock()
+
+
+def _key(dir: str) -> str:
+  return os.path.normpath(dir).replace('\\', '/')
+
+
+def _dir_lock(key: str) -> threading.Lock:
+  with _locks_lock:
+    return _locks.setdefault(key, threading.Lock())
+
+
+def _disk_range(key: str) -> tuple[int | None, int]:
+  names = watcher.listdir(key)
+  cached = _numbering.get(key)
+  if cached is not None and cached[0] is names:
+    return cached[1], cached[2]
+  numbers = [int(stem) for stem in (os.path.splitext(name)[0] for name in names) if stem.isdecimal()]
+  low, high = (min(numbers), max(numbers)) if len(numbers) > 0 else (None, -1)
+  _numbering[key] = (names, low, high)
+  return low, high
+
+
+@contextmanager
+def _reservations(key: str):
+  '''
+    持有锁读写目录中的预留记录 [{ id, low, high, time }], 修改 yield 的 list 即可
+  '''
+  path = os.path.join(CONF_REPO_DIR, key, RESERVATIONS_FILE)
+  with _dir_lock(key), open(path, 'a+', encoding='utf-8') as f:
+    _lock_file(f)
+    try:
+      f.seek(0)
+      text = f.read()
+      try:
+        entries = json.loads(text) if text.strip() else []
+      except ValueError as e:
+        print(path, e)
+        entries = []
+      yield entries
+      f.seek(0)
+      f.truncate()
+      f.write(json.dumps(entries))
+      f.flush()
+    finally:
+      _unlock_file(f)
+
+
+def _reserve(key: str, id: str, count: int, after: bool) -> int:
+  '''
+    预留 count 个连续的编号, 返回第一个
+    after 为 False 时, 新的编号可以全部放在已有的最小编号之前则从 0 开始, 否则接在最大的编号之后
+  '''
+  with _reservations(key) as entries:
+    low, high = _disk_range(key)
+    now = time.time()
+    # 已经写入文件的范围与崩溃残留的记录不再需要
+    entries[:] = [
+      entry for entry in entries
+      if now - entry['time'] < RESERVATION_TIMEOUT and not (low is not None and low <= entry['low'] and entry['high'] <= high)
+    ]
+    for entry in entries:
+      low = entry['low'] if low is None else min(low, entry['low'])
+      high = max(high, entry['high'])
+    start = 0 if not after and (low is None or count < low) else high + 1
+    entries.append({ 'id': id, 'low': start, 'high': start + count - 1, 'time': now })
+  return start
+
+
+def _release(key: str, id: str):
+  with _reservations(key) as entries:
+    entries[:] = [entry for entry in entries if entry['id'] != id]
+
+
+def _publish(source: str, target: str) -> bool:
+  '''
+    将 source 移动为 target, target 已经存在时返回 False, 不会覆盖
+  '''
+  try:
+    os.link(source, target)
+  except FileExistsError:
+    return False
+  except OSError:
+    # 不支持硬链接(FAT, 部分网络存储)或者跨文件系统, 编号已经预留, 只需要避免覆盖外部写入的文件
+    if os.path.exists(target):
+      return False
+    shutil.move(source, target)
+    return True
+  os.remove(source)
+  return True
+
+
+class Allocation:
+  def __init__(self, dir: str, count: int):
+    self.dir = _key(dir)
+    self.id = uuid.uuid4().hex
+    self.next = _reserve(self.dir, self.id, max(1, count), after=False)
+    self._end = self.next + max(1, count)
+
+  def publish(self, source: str, ext: str | None = None) -> str:
+    '''
+      source 为绝对路径(通常是同一目录下的临时文件), 按顺序发布为下一个编号, 返回从 imageset-xxx 开始的路径
+      ext 默认为 CONF_IMAGE_EXT
+    '''
+    ext = (ext or CONF_IMAGE_EXT).lower()
+    while True:
+      if self.next >= self._end:
+        # 预留的编号已经用完(目标被占用或者文件比预计的多), 在所有编号之后继续预留
+        self.next = _reserve(self.dir, self.id, 1, after=True)
+        self._end = self.next + 1
+      name = f'{self.next:06d}.{ext}'
+      self.next += 1
+      if _publish(source, os.path.join(CONF_REPO_DIR, self.dir, name)):
+        return f'{self.dir}/{name}'
+
+  def close(self):
+    _release(self.dir, self.id)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def allocate(dir: str, count: int) -> Allocation:
+  '''
+    dir 从 imageset-xxx 开始, 目录需要已经存在; 预留 count 个编号, 使用完之后需要 close(或者使用 with)
+  '''
+  return Allocation(dir, count)
+
+
+def temp_path(dir: str, prefix: str) -> str:
+  '''
+    dir 中的临时文件的绝对路径, 以 . 开头并且不是图片的扩展名, 不会被当作图片读取
+  '''
+  return os.path.join(CONF_REPO_DIR, dir, f'.{prefix}-{uuid.uuid4().hex}.tmp')
@@ -0,0 +1,87 @@
+'''
+  图片文件服务
+
+  repo_dir 位于网络存储上时, 一次 stat 就可能阻塞数秒, 因此 /image 下的接口不在事件循环中访问文件系统
+  - stat 在单独的有界线程池中执行, 不占用 run_in_threadpool(后台任务)使用的线程
+  - 同时等待中的请求超过 serve_max_pending 时直接返回 503 与 Retry-After, 而不是无限地排队
+  - 响应带有 ETag 与 Last-Modified, 支持 If-None-Match / If-Modified-Since 返回 304;
+    Range 由 FileResponse 处理, 传入已经得到的 stat, 不会再次 stat
+'''
+
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from .config import CONF_SERVE_WORKERS, CONF_SERVE_MAX_PENDING
+import asyncio
+import stat
+import os
+
+
+_executor = ThreadPoolExecutor(max_workers=CONF_SERVE_WORKERS, thread_name_prefix='serve')
+_pending = 0
+
+
+@asynccontextmanager
+async def admit():
+  '''
+    请求进入时计数, 超过上限时返回 503, 浏览器稍后重试
+    计数只在事件循环中修改, 不需要加锁
+  '''
+  global _pending
+  if _pending >= CONF_SERVE_MAX_PENDING:
+    raise HTTPException(status_code=503, detail='server is busy', headers={ 'Retry-After': '1' })
+  _pending += 1
+  try:
+    yield
+  finally:
+    _pending -= 1
+
+
+def _stat_file(path: str) -> os.stat_result | None:
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return st if stat.S_ISREG(st.st_mode) else None
+
+async def stat_file(path: str) -> os.stat_result | None:
+  '''
+    在线程池中 stat, 不存在或者不是文件时返回 None
+  '''
+  return await run(_stat_file, path)
+
+async def run(fn, *args):
+  '''
+    在同一个线程池中执行其他需要访问文件系统的函数(例如读取缩略图对应的原图内容版本)
+  '''
+  return await asyncio.wrap_future(_executor.submit(fn, *args))
+
+
+def last_modified(mtime: float) -> str:
+  return formatdate(mtime, usegmt=True)
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+  '''
+    是否可以返回 304, If-None-Match 优先, 没有时再比较 If-Modified-Since
+  '''
+  if_none_match = request.headers.get('if-none-match')
+  if if_none_match is not None:
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+  if_modified_since = request.headers.get('if-modified-since')
+  if if_modified_since is not None:
+    try:
+      return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+      return False
+  return False
+
+
+class ImageResponse(FileResponse):
+  '''
+    FileResponse 比较 If-Range 时使用它自己计算的 ETag, 这里改为与响应中的 ETag, Last-Modified 比较
+  '''
+  def _should_use_range(self, http_if_range: str, stat_result: os.stat_result) -> bool:
+    return http_if_range in (self.headers.get('etag'), self.headers.get('last-modified'))
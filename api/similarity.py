@@ -0,0 +1,194 @@
+'''
+  相似图片检索
+
+  将每张图片的感知 hash 打包为 uint64 位数组, 分块异或之后用 popcount 计算汉明距离,
+  避免在 python 中逐对比较 O(n²) 个 imagehash 对象
+  图片数量非常多并且阈值较高(搜索半径较小)时, 使用 BK-tree 进一步减少比较次数
+
+  两张图片的相似度定义与原来一致: 对每一种 hash 计算 1 - 汉明距离 / 位数, 取最大值
+  相似度 > threshold 即认为相似
+'''
+
+import os
+import numpy as np
+import imagehash
+from PIL import Image
+from .job import progress
+from . import decode
+
+
+# 计算 hash 的方法的版本, 保存在索引中, 修改计算方法之后需要增加, 不同版本的 hash 不能相互比较
+# 1: 原图; 2: 解码缓存中的预览图(短边 448, 透明部分合成到白色背景上)
+HASH_VERSION = 2
+BLOCK_SIZE = 512            # 分块比较时每个块的图片数量
+BKTREE_MIN_IMAGES = 20000   # auto 模式下超过该数量才考虑使用 BK-tree
+
+
+def preview_hash(preview: np.ndarray) -> dict[str, str]:
+  '''
+    从解码缓存中的图片(短边 448 的 RGB 数组)计算 phash, ahash, dhash 与 whash, 以十六进制字符串返回
+    各种 hash 最多使用 128x128 的灰度图, 不透明的图片与使用原图计算的结果基本一致(见 benchmark/hash.py),
+    带有透明通道的图片差别较大, 因此不同 HASH_VERSION 的 hash 不能混用
+  '''
+  highfreq_factor = 4 # resize的尺度
+  hash_size = 32 # 最终返回hash数值长度
+  image_scale = 64
+  image = Image.fromarray(preview)
+  phash = imagehash.phash(image, hash_size=hash_size,highfreq_factor=highfreq_factor)
+  ahash = imagehash.average_hash(image,hash_size=hash_size)
+  dhash = imagehash.dhash(image,hash_size=hash_size)
+  whash = imagehash.whash(image,image_scale=image_scale,hash_size=hash_size,mode = 'db4')
+  return {
+    "phash": str(phash), "ahash": str(ahash), "dhash": str(dhash), "whash": str(whash)
+  }
+
+
+def image_hash(abs_path: str) -> tuple[dict[str, str], np.ndarray, os.stat_result] | None:
+  '''
+    解码单张图片并计算 hash, 图片无法读取时返回 None
+    会在子进程中执行, 因此只接收绝对路径; 同时返回解码后的图片与解码之前的 stat, 由主进程放入解码缓存
+  '''
+  try:
+    st = os.stat(abs_path)
+    preview = decode.decode(abs_path)
+    return preview_hash(preview), preview, st
+  except Exception as e:
+    print(abs_path, e)
+    return None
+
+
+if hasattr(np, 'bitwise_count'):
+  def popcount(x: np.ndarray) -> np.ndarray:
+    return np.bitwise_count(x)
+else:
+  _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+  def popcount(x: np.ndarray) -> np.ndarray:
+    return _POPCOUNT_TABLE[x.view(np.uint8)].reshape(*x.shape, 8).sum(-1, dtype=np.uint8)
+
+
+def pack_bits(bits: list[np.ndarray]) -> np.ndarray:
+  '''
+    将 n 个形状相同的 bool 数组打包为 (n, words) 的 uint64 数组
+  '''
+  bits = np.stack([np.asarray(b, dtype=bool).reshape(-1) for b in bits])
+  nbits = bits.shape[1]
+  padding = (-nbits) % 64
+  if padding > 0:
+    bits = np.pad(bits, ((0, 0), (0, padding)))
+  return np.packbits(bits, axis=1).view(np.uint64)
+
+
+def max_distance(threshold: float, nbits: int) -> int:
+  '''
+    满足 1 - d / nbits > threshold 的最大汉明距离 d, 不存在时返回 -1
+  '''
+  d = min(nbits, max(-1, int((1 - threshold) * nbits)))
+  while d >= 0 and not (1 - d / nbits > threshold):
+    d -= 1
+  while d + 1 <= nbits and 1 - (d + 1) / nbits > threshold:
+    d += 1
+  return d
+
+
+def block_pairs(packed: list[np.ndarray], radius: list[int], block_size: int = BLOCK_SIZE):
+  '''
+    分块计算所有图片两两之间的汉明距离, 任意一种 hash 的距离不超过对应 radius 即返回该对下标
+    packed 为每一种 hash 的 (n, words) 数组
+  '''
+  n = packed[0].shape[0]
+  blocks = range(0, n, block_size)
+  for i0 in progress(blocks, total=len(blocks), desc='compare'):
+    i1 = min(n, i0 + block_size)
+    for j0 in range(i0, n, block_size):
+      j1 = min(n, j0 + block_size)
+      matched = np.zeros((i1 - i0, j1 - j0), dtype=bool)
+      for hashes, r in zip(packed, radius):
+        if r < 0:
+          continue
+        distance = popcount(hashes[i0:i1, None, :] ^ hashes[None, j0:j1, :]).sum(-1, dtype=np.int32)
+        matched |= distance <= r
+      if i0 == j0:
+        # 同一个块只取上三角, 去掉自身与重复的对
+        matched = np.triu(matched, k=1)
+      for i, j in zip(*np.nonzero(matched)):
+        yield i0 + int(i), j0 + int(j)
+
+
+class BKTree:
+  '''
+    以汉明距离为度量的 BK-tree, 节点为 [下标, hash, { 距离: 子节点 }]
+  '''
+  def __init__(self):
+    self.root = None
+
+  def add(self, index: int, value: int):
+    if self.root is None:
+      self.root = [index, value, {}]
+      return
+    node = self.root
+    while True:
+      d = (node[1] ^ value).bit_count()
+      child = node[2].get(d)
+      if child is None:
+        node[2][d] = [index, value, {}]
+        return
+      node = child
+
+  def search(self, value: int, radius: int) -> list[int]:
+    result = []
+    if self.root is None:
+      return result
+    stack = [self.root]
+    while len(stack) > 0:
+      index, v, children = stack.pop()
+      d = (v ^ value).bit_count()
+      if d <= radius:
+        result.append(index)
+      for k, child in children.items():
+        if d - radius <= k <= d + radius:
+          stack.append(child)
+    return result
+
+
+def bktree_pairs(packed: list[np.ndarray], radius: list[int]):
+  '''
+    对每一种 hash 分别建立 BK-tree, 每张图片只和已经插入的图片比较, 因此每一对只会返回一次(可能因为多种 hash 重复)
+  '''
+  n = packed[0].shape[0]
+  for hashes, r in zip(packed, radius):
+    if r < 0:
+      continue
+    tree = BKTree()
+    values = [int.from_bytes(row.tobytes(), 'little') for row in hashes]
+    for j in progress(range(n), total=n, desc='compare'):
+      for i in tree.search(values[j], r):
+        yield i, j
+      tree.add(j, values[j])
+
+
+def find_similar_pairs(hashes: list[dict], threshold: float, method: str = 'auto'):
+  '''
+    hashes 为每张图片的 { 'phash': ImageHash, 'ahash': ..., ... }
+    method: exact 分块暴力比较, bktree 使用 BK-tree, auto 根据图片数量与搜索半径自动选择
+    返回相似图片的下标对 (i, j), i < j 不保证, 可能重复
+  '''
+  if len(hashes) < 2:
+    return
+  packed, radius = [], []
+  for kind in hashes[0].keys():
+    bits = [h[kind].hash for h in hashes]
+    packed.append(pack_bits(bits))
+    radius.append(max_distance(threshold, bits[0].size))
+
+  if method == 'auto':
+    nbits = hashes[0][next(iter(hashes[0]))].hash.size
+    # BK-tree 只有在半径较小时才能有效剪枝
+    small_radius = max(radius) <= nbits // 16
+    method = 'bktree' if len(hashes) >= BKTREE_MIN_IMAGES and small_radius else 'exact'
+
+  if method == 'bktree':
+    yield from bktree_pairs(packed, radius)
+  elif method == 'exact':
+    yield from block_pairs(packed, radius)
+  else:
+    raise ValueError(f'unknown method {method}')
@@ -2,14 +2,21 @@ from fastapi import APIRouter, HTTPException
 from typing import List, Dict
 import os
 import imagehash
-from .config import CONF_HOST, CONF_PORT, CONF_REPO_DIR
+from .config import CONF_HOST, CONF_PORT, CONF_REPO_DIR, CONF_TAGGER_BATCH_SIZE, CONF_TAGGER_WORKERS, CONF_HASH_WORKERS
 from pydantic import BaseModel
-from .tagger import interrogators
+from .tagger import interrogators, model_manager
 from pathlib import Path
 from PIL import Image
 from .tagger import Interrogator
-from tqdm import tqdm
+from .job import progress
+from . import job
 from .imageset import load_caption, save_caption
+from . import catalog
+from . import caption
+from . import confidence
+from . import decode
+from .similarity import find_similar_pairs, image_hash, preview_hash, HASH_VERSION
+from concurrent.futures import ProcessPoolExecutor
 
 
 api_tag = APIRouter()
@@ -32,20 +39,43 @@ def update_captions(image_path: str, tags: list[str]) -> list[str]:
 
 
 def compute_hash(filenames: list[str]) -> dict:
-  result = {}
-  for filename in tqdm(filenames):
-    highfreq_factor = 4 # resize的尺度
-    hash_size = 32 # 最终返回hash数值长度
-    image_scale = 64
-    image = Image.open(os.path.join(CONF_REPO_DIR, filename))
-    phash = imagehash.phash(image, hash_size=hash_size,highfreq_factor=highfreq_factor)
-    ahash = imagehash.average_hash(image,hash_size=hash_size)   
-    dhash = imagehash.dhash(image,hash_size=hash_size) 
-    whash = imagehash.whash(image,image_scale=image_scale,hash_size=hash_size,mode = 'db4')
-    result[filename] = {
-      "phash": phash, "ahash": ahash, "dhash": dhash, "whash": whash 
-    }
-  return result
+  '''
+    hash 以 path + mtime + size 为键缓存在索引中, 只计算缺失的部分, 并且使用多进程并行计算
+    return { path: { 'phash': ImageHash, 'ahash': ..., 'dhash': ..., 'whash': ... } }, 无法读取的图片不会出现在返回值中
+  '''
+  cached = catalog.get_hashes(filenames, HASH_VERSION)
+  missing = list(dict.fromkeys(filename for filename in filenames if filename not in cached))
+  if len(missing) > 0:
+    computed = {}
+    def save():
+      catalog.set_hashes(computed, HASH_VERSION)
+      cached.update(computed)
+      computed.clear()
+    def add(filename: str, hashes: dict[str, str]):
+      computed[filename] = hashes
+      # 分批写入, 任务被取消时已经计算的部分也不会丢失
+      if len(computed) >= 256:
+        save()
+    # 已经在解码缓存中(例如刚打过标)的图片直接计算, 不需要再次解码
+    decoded = [(filename, decode.get(os.path.join(CONF_REPO_DIR, filename))) for filename in missing]
+    missing = [filename for filename, preview in decoded if preview is None]
+    for filename, preview in progress([item for item in decoded if item[1] is not None], desc='hash (cached)'):
+      add(filename, preview_hash(preview))
+    if len(missing) > 0:
+      abs_paths = [os.path.join(CONF_REPO_DIR, filename) for filename in missing]
+      with ProcessPoolExecutor(max_workers=max(1, min(CONF_HASH_WORKERS, len(missing)))) as executor:
+        results = executor.map(image_hash, abs_paths, chunksize=max(1, min(16, len(missing) // (CONF_HASH_WORKERS * 4))))
+        for abs_path, filename, result in progress(zip(abs_paths, missing, results), total=len(missing), desc='hash'):
+          if result is None:
+            continue
+          hashes, preview, st = result
+          decode.put(abs_path, preview, st)
+          add(filename, hashes)
+    save()
+  return {
+    filename: { kind: imagehash.hex_to_hash(value) for kind, value in cached[filename].items() }
+    for filename in filenames if filename in cached
+  }
 
 class ImageListInterrogateRequest(BaseModel):
   images: List[str]               # 图片元信息列表
@@ -53,26 +83,82 @@ class ImageListInterrogateRequest(BaseModel):
   exclude_tags: List[str] = []
   model_name: str                 # 模型名称
   threshold: float                # 可选的阈值
-@api_tag.post('/image_list_interrogate')
-async def image_list_interrogate(request_body: ImageListInterrogateRequest):
+  batch_size: int = CONF_TAGGER_BATCH_SIZE
+def interrogate_images(request_body: ImageListInterrogateRequest) -> dict:
   interrogator = interrogators[request_body.model_name]
+  abs_paths = {os.path.join(CONF_REPO_DIR, image_path): image_path for image_path in request_body.images}
   ret = {}
-  for image_path in tqdm(request_body.images):
+
+  def interrogate():
+    batches = interrogator.batch_confidents(list(abs_paths.keys()), batch_size=request_body.batch_size, num_workers=CONF_TAGGER_WORKERS)
+    saved_tag_names = False
+    for batch_paths, confidents in batches:
+      if isinstance(confidents, Exception):
+        for abs_path in batch_paths:
+          yield abs_path, confidents
+        continue
+      # 保存完整的置信度, 之后可以通过 /rethreshold 使用新的阈值重新过滤
+      if not saved_tag_names:
+        confidence.save_tag_names(request_body.model_name, interrogator.tag_names, interrogator.rating_count)
+        saved_tag_names = True
+      confidence.save(request_body.model_name, [abs_paths[abs_path] for abs_path in batch_paths], confidents)
+      # 整个 batch 的置信度矩阵一次过滤, 只有超过阈值的标签才会转换为 dict
+      results = interrogator.postprocess_batch(
+        confidents,
+        threshold=request_body.threshold,
+        additional_tags=request_body.additional_tags, # 要添加的标签
+        exclude_tags=request_body.exclude_tags, # 要排除的标签, 给出一个标签的列表即可
+      )
+      yield from zip(batch_paths, results)
+
+  for abs_path, result in progress(interrogate(), total=len(abs_paths), desc='interrogate'):
+    image_path = abs_paths[abs_path]
+    if isinstance(result, Exception):
+      print(image_path, result)
+      continue
     # 注意添加将原有的标签添加到 additional 的逻辑
-    im = Image.open(Path(os.path.join(CONF_REPO_DIR, image_path)))
-    _, result = interrogator.interrogate(im)
-    im.close()
-    tags = Interrogator.postprocess_tags(
-      result,
-      threshold=request_body.threshold,
-      additional_tags=request_body.additional_tags, # 要添加的标签
-      exclude_tags=request_body.exclude_tags, # 要排除的标签, 给出一个标签的列表即可
-    )
-    tags = list(tags.keys())
-    tags = update_captions(image_path, tags)
+    tags = update_captions(image_path, list(result.keys()))
     ret[image_path] = tags
   return ret
 
+@api_tag.post('/image_list_interrogate')
+async def image_list_interrogate(request_body: ImageListInterrogateRequest, background: bool = False):
+  return await job.run('image_list_interrogate', interrogate_images, request_body, background=background)
+
+class RethresholdRequest(BaseModel):
+  images: List[str]
+  model_name: str
+  threshold: float
+  additional_tags: List[str] = []
+  exclude_tags: List[str] = []
+def rethreshold_images(request_body: RethresholdRequest) -> dict:
+  '''
+    使用 image_list_interrogate 保存的置信度重新过滤, 不需要加载模型
+    return { tags: { path: [tag, ...] }, missing: [path] } , missing 为没有保存置信度(或者之后被修改过)的图片
+  '''
+  tag_names = confidence.load_tag_names(request_body.model_name)
+  if tag_names is None:
+    raise HTTPException(status_code=404, detail=f'no confidences saved for model {request_body.model_name}')
+  names, rating_count = tag_names
+  found, confidents = confidence.load(request_body.model_name, request_body.images)
+  tags = {}
+  if confidents is not None:
+    results = Interrogator.postprocess_matrix(
+      names, rating_count, confidents,
+      threshold=request_body.threshold,
+      additional_tags=request_body.additional_tags,
+      exclude_tags=request_body.exclude_tags,
+    )
+    tags = { path: list(result.keys()) for path, result in zip(found, results) }
+  return {
+    'tags': tags,
+    'missing': [path for path in request_body.images if path not in tags],
+  }
+
+@api_tag.post('/rethreshold')
+async def rethreshold(request_body: RethresholdRequest):
+  return await job.run('rethreshold', rethreshold_images, request_body)
+
 
 class UnionFind:
   def __init__(self, elements):
@@ -106,61 +192,44 @@ class UnionFind:
 class DetectSimilarRequest(BaseModel):
   images: List[str]               # 图片元信息列表, path
   threshold: float                # 可选的阈值
-@api_tag.post("/detect_similar_images")
-async def find_similar_images(request: DetectSimilarRequest):
+  method: str = 'auto'            # exact 分块比较, bktree 使用 BK-tree, auto 自动选择
+def find_similar_images(request: DetectSimilarRequest) -> list:
+  if request.method not in ('auto', 'exact', 'bktree'):
+    raise HTTPException(status_code=400, detail=f'unknown method {request.method}')
   # 第一步, 求出每张图片的 hash 值
   hash = compute_hash(request.images)
-  uf = UnionFind(request.images)
-  
-  image_pair = []
-  for i in range(len(request.images)):
-    for j in range(i+1, len(request.images)):
-      image_pair.append((request.images[i], request.images[j]))
+  images = [image for image in request.images if image in hash]
+  uf = UnionFind(images)
   
-  for f1, f2 in tqdm(image_pair):
-    d1 = hash[f1]
-    d2 = hash[f2]
-    phash1 = d1['phash']
-    phash2 = d2['phash']
-    phash_value = 1-(phash1-phash2)/len(phash1.hash)**2
-    
-    ahash1 = d1['ahash']
-    ahash2 = d2['ahash']  
-    ahash_value = 1-(ahash1-ahash2)/len(ahash1.hash)**2
-    
-    dhash1 = d1['dhash']
-    dhash2 = d2['dhash']
-    dhash_value = 1-(dhash1-dhash2)/len(dhash1.hash)**2  
-
-    whash1 = d1['whash']
-    whash2 = d2['whash']
-    whash_value = 1-(whash1-whash2)/len(whash1.hash)**2  
-
-    value_hash = max(phash_value,ahash_value,dhash_value,whash_value)
-    if value_hash > request.threshold:
-      uf.union(f1, f2)
+  # 第二步, 向量化地找出所有相似的图片对
+  hashes = [hash[image] for image in images]
+  for i, j in find_similar_pairs(hashes, request.threshold, request.method):
+    uf.union(images[i], images[j])
   all_sets = uf.get_all_sets()  
+  infos = catalog.get_images_info([imagefilename for images in all_sets for imagefilename in images])
   result = []
   for images in all_sets:
     t = []
     for imagefilename in images:
       basename = os.path.basename(imagefilename)
       filename, _ = os.path.splitext(basename)
-      abs_path = os.path.join(CONF_REPO_DIR, imagefilename)
-      with Image.open(abs_path) as img:
-        width, height = img.size
+      info = infos[imagefilename]
       t.append({
         'src': f'http://{CONF_HOST}:{CONF_PORT}/image/{imagefilename}', 
-        'thumbnail': f'http://{CONF_HOST}:{CONF_PORT}/image/thumbnail/{imagefilename}',
+        'thumbnail': f'http://{CONF_HOST}:{CONF_PORT}/image/thumbnail/{imagefilename}?v={info["version"]}',
         'filename': filename,
         'basename': basename,
         'path': imagefilename,
-        'size': os.path.getsize(abs_path),
-        'width': width,
-        'height': height,
+        'size': info['size'],
+        'width': info['width'],
+        'height': info['height'],
       })
     result.append(t)
   return result
+
+@api_tag.post("/detect_similar_images")
+async def detect_similar_images(request: DetectSimilarRequest, background: bool = False):
+  return await job.run('detect_similar_images', find_similar_images, request, background=background)
   
 
 
@@ -171,41 +240,49 @@ class InterrogateRequest(BaseModel):
   model_name: str                     # 模型名称
   threshold: float                    # 可选的阈值
   ignore: bool
-@api_tag.post("/interrogate")
-async def image_interrogate(request: InterrogateRequest):
+def interrogate_image(request: InterrogateRequest) -> list[str]:
   interrogator = interrogators[request.model_name]
   image_path = os.path.join(CONF_REPO_DIR, request.image)
   tags = load_caption(image_path)
   if len(tags) > 0:
     return tags
-  im = Image.open(Path(image_path))
-  _, result = interrogator.interrogate(im)
-  im.close()
-  tags = Interrogator.postprocess_tags(
-    result,
-    threshold=request.threshold,
-    additional_tags=request.additional_tags,  # 要添加的标签
-    exclude_tags=request.exclude_tags,        # 要排除的标签, 给出一个标签的列表即可
-  )
+  with interrogator.using(), Image.open(Path(image_path)) as im:
+    tags = interrogator.postprocess_batch(
+      interrogator.confidents(im)[None],
+      threshold=request.threshold,
+      additional_tags=request.additional_tags,  # 要添加的标签
+      exclude_tags=request.exclude_tags,        # 要排除的标签, 给出一个标签的列表即可
+    )[0]
   tags = list(tags.keys())
   tags = update_captions(image_path, tags)
   return tags
 
+@api_tag.post("/interrogate")
+async def image_interrogate(request: InterrogateRequest):
+  return await job.run('interrogate', interrogate_image, request)
+
 
 class TagMap(BaseModel):
   tags: Dict[str, List[str]]
+  sync: bool = False  # 是否等待标签写回 exif 与 txt 文件之后再返回
   
 @api_tag.put("/save")
 async def save_tags(data: TagMap):
   '''
-    i = Image(image_path)
-    i.read_comment()
-    i.modity_comment('')
-    i.close()
     Map<path, caption[]>
+    标签保存到索引中, 与已有标签相同的图片会被跳过, exif 与 txt 文件在后台合并写回
+    return { path: { status: 'saved' | 'unchanged' | 'failed', error: string | null } }
   '''
-  # 接下来直接保存
-  for path, captions in tqdm(data.tags.items()):
-    save_caption(path, captions)
-  
+  return await job.run('save tags', caption.save, data.tags, data.sync)
 
+
+@api_tag.get("/models")
+async def get_models():
+  '''
+    打标模型的加载状态
+    {
+      memory_budget: number | null, memory: number,  // 字节
+      models: [{ key, name, loaded, loading, in_use, memory, last_used, error }]
+    }
+  '''
+  return model_manager.status()
@@ -1,15 +1,19 @@
 import os
+import time
 import pandas as pd
 import numpy as np
 
-from typing import Iterable, Tuple, List, Dict
+from typing import Iterable, Iterator, Tuple, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
 from PIL import Image
 
 from pathlib import Path
 from huggingface_hub import hf_hub_download
 import re
 import json
-from onnxruntime import InferenceSession
+from onnxruntime import InferenceSession, SessionOptions
 
 
 from numpy import asarray, float32, expand_dims, exp
@@ -17,6 +21,8 @@ from numpy import asarray, float32, expand_dims, exp
 tag_escape_pattern = re.compile(r'([\\()])')
 
 from .dbimutils import *
+from ..config import CONF_TAGGER_INTRA_OP_THREADS, CONF_TAGGER_INTER_OP_THREADS
+from .. import decode
 
 
 class Interrogator:
@@ -35,22 +41,21 @@ class Interrogator:
         for t in additional_tags:
             tags[t] = 1.0
 
-        # those lines are totally not "pythonic" but looks better to me
+        # 先过滤再排序, 只有少量标签会超过阈值
+        exclude_tags = set(exclude_tags)
         tags = {
             t: c
 
             # sort by tag name or confident
             for t, c in sorted(
-                tags.items(),
+                (
+                    (t, c) for t, c in tags.items()
+                    # filter tags
+                    if c >= threshold and t not in exclude_tags
+                ),
                 key=lambda i: i[0 if sort_by_alphabetical_order else 1],
                 reverse=not sort_by_alphabetical_order
             )
-
-            # filter tags
-            if (
-                c >= threshold
-                and t not in exclude_tags
-            )
         }
 
         new_tags = []
@@ -74,6 +79,13 @@ class Interrogator:
     def __init__(self, name: str) -> None:
         self.name = name
         self.providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+        self.key = name
+        self.manager = None  # 由 ModelManager.register 设置
+        self.memory = 0      # 估计的内存占用(字节), 在 load 时设置
+        # 以下在 load 时设置: 模型输出中每一项对应的标签名与分类, 前 rating_count 项为 rating
+        self.tag_names: np.ndarray | None = None
+        self.tag_categories: np.ndarray | None = None
+        self.rating_count = 0
 
     def load(self):
         raise NotImplementedError()
@@ -89,11 +101,137 @@ class Interrogator:
         if hasattr(self, 'tags'):
             del self.tags
 
+        self.tag_names = None
+        self.tag_categories = None
+        self.memory = 0
         return unloaded
 
     def use_cpu(self) -> None:
         self.providers = ['CPUExecutionProvider']
 
+    def session_options(self) -> SessionOptions:
+        options = SessionOptions()
+        options.intra_op_num_threads = CONF_TAGGER_INTRA_OP_THREADS
+        options.inter_op_num_threads = CONF_TAGGER_INTER_OP_THREADS
+        return options
+
+    @property
+    def loaded(self) -> bool:
+        return getattr(self, 'model', None) is not None
+
+    def ensure_loaded(self) -> None:
+        if self.manager is not None:
+            self.manager.ensure_loaded(self.key)
+        elif not self.loaded:
+            self.load()
+
+    @contextmanager
+    def using(self):
+        '''
+            推理期间使用, 由 ModelManager 管理时保证模型不会在推理过程中被卸载
+        '''
+        if self.manager is None:
+            self.ensure_loaded()
+            yield self
+            return
+        with self.manager.use(self.key):
+            yield self
+
+    def max_batch_size(self) -> int | None:
+        # 模型的 batch 维度是固定值时只能按照该值送入
+        batch = self.model.get_inputs()[0].shape[0]
+        return batch if isinstance(batch, int) and batch > 0 else None
+
+    def preprocess(self, image: Image) -> np.ndarray:
+        '''
+            将图片转换为模型的单个输入(不包含 batch 维度), 可以在多个线程中并行调用
+        '''
+        raise NotImplementedError()
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        '''
+            batch 为 preprocess 结果堆叠而成, 返回 (N, 标签数量) 的置信度矩阵
+        '''
+        raise NotImplementedError()
+
+    def split_confidents(
+        self,
+        confidents: np.ndarray
+    ) -> Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]:
+        confidents = confidents.reshape(-1).tolist()
+        n = self.rating_count
+        return dict(zip(self.tag_names[:n], confidents[:n])), dict(zip(self.tag_names[n:], confidents[n:]))
+
+    @staticmethod
+    def postprocess_matrix(
+        tag_names: np.ndarray,
+        rating_count: int,
+        confidents: np.ndarray,
+        threshold=0.35,
+        additional_tags: List[str] = [],
+        exclude_tags: Iterable[str] = [],
+        **kwargs
+    ) -> List[Dict[str, float]]:
+        '''
+            confidents 为 (N, 标签数量) 置信度矩阵, 列与 tag_names 对应, 前 rating_count 列为 rating
+            结果与对每一行的 split_confidents 调用 postprocess_tags 一致
+            阈值与排除标签在整个矩阵上用 numpy 过滤, 只有留下的少量标签才会转换为 dict 交给 postprocess_tags
+        '''
+        names = tag_names[rating_count:]
+        confidents = confidents.reshape(len(confidents), -1)[:, rating_count:]
+        if confidents.dtype == np.float16 and threshold > 0:
+            # 非负的 float16 按照 int16 比较与按照数值比较的顺序一致(负数的符号位使其小于正的阈值),
+            # 避免将整个矩阵转换为 float
+            bound = np.float16(threshold)
+            if float(bound) < threshold:
+                bound = np.nextafter(bound, np.float16(np.inf))
+            mask = confidents.view(np.int16) >= bound.view(np.int16)
+        else:
+            # 使用 float64 的阈值比较, 与 postprocess_tags 中 python float 的比较结果一致
+            mask = confidents >= np.float64(threshold)
+        exclude_tags = list(exclude_tags)
+        if len(exclude_tags) > 0:
+            mask &= ~np.isin(names, exclude_tags)
+        # 一次取出整个矩阵中留下的标签, 再按行切分
+        rows, columns = np.nonzero(mask)
+        all_names = names[columns].tolist()
+        all_confidents = confidents[rows, columns].astype(np.float32).tolist()
+        ends = np.cumsum(np.bincount(rows, minlength=len(confidents))).tolist()
+        results = []
+        start = 0
+        for end in ends:
+            tags = dict(zip(all_names[start:end], all_confidents[start:end]))
+            start = end
+            results.append(Interrogator.postprocess_tags(
+                tags,
+                threshold=threshold,
+                additional_tags=additional_tags,
+                exclude_tags=exclude_tags,
+                **kwargs
+            ))
+        return results
+
+    def postprocess_batch(
+        self,
+        confidents: np.ndarray,
+        **kwargs
+    ) -> List[Dict[str, float]]:
+        '''
+            confidents 为 run 返回的 (N, 标签数量) 置信度矩阵, 参数与 postprocess_tags 相同
+        '''
+        return self.postprocess_matrix(self.tag_names, self.rating_count, confidents, **kwargs)
+
+    def confidents(self, image: Image) -> np.ndarray:
+        '''
+            单张图片的置信度向量
+        '''
+        with self.using():
+            x = np.expand_dims(self.preprocess(image), 0)
+            return self.run(x)[0]
+
     def interrogate(
         self,
         image: Image
@@ -101,7 +239,104 @@ class Interrogator:
         Dict[str, float],  # rating confidents
         Dict[str, float]  # tag confidents
     ]:
-        raise NotImplementedError()
+        with self.using():
+            return self.split_confidents(self.confidents(image))
+
+    def _load_and_preprocess(self, path: str) -> np.ndarray:
+        # 从解码缓存中读取短边 448 的 RGB 图片, 模型的输入不超过 448, 结果与使用原图基本一致
+        return self.preprocess(decode.load_image(path))
+
+    def batch_interrogate(
+        self,
+        paths: List[str],
+        batch_size: int = 8,
+        num_workers: int = 4,
+    ) -> Iterator[Tuple[str, Tuple[Dict[str, float], Dict[str, float]] | Exception]]:
+        '''
+            批量打标, 按照 paths 的顺序逐个返回 (path, (ratings, tags)),
+            读取或者推理失败的图片返回 (path, exception)
+
+            图片的解码与预处理在线程池中进行, 与 InferenceSession.run 并行,
+            线程池中最多提前准备 2 个 batch 的图片, 避免占用过多内存
+        '''
+        for batch_paths, confidents in self.batch_confidents(paths, batch_size, num_workers):
+            if isinstance(confidents, Exception):
+                for path in batch_paths:
+                    yield path, confidents
+                continue
+            for path, c in zip(batch_paths, confidents):
+                yield path, self.split_confidents(c)
+
+    def batch_confidents(
+        self,
+        paths: List[str],
+        batch_size: int = 8,
+        num_workers: int = 4,
+    ) -> Iterator[Tuple[List[str], np.ndarray | Exception]]:
+        '''
+            按照 paths 的顺序逐个 batch 返回 (batch 中的 paths, (N, 标签数量) 置信度矩阵),
+            读取或者推理失败时返回 (paths, exception), 可以直接交给 postprocess_batch
+            迭代期间模型不会被卸载
+        '''
+        with self.using():
+            yield from self._batch_confidents(paths, batch_size, num_workers)
+
+    def _batch_confidents(
+        self,
+        paths: List[str],
+        batch_size: int,
+        num_workers: int,
+    ) -> Iterator[Tuple[List[str], np.ndarray | Exception]]:
+        max_batch_size = self.max_batch_size()
+        if max_batch_size is not None:
+            batch_size = max_batch_size
+        batch_size = max(1, batch_size)
+
+        start = time.perf_counter()
+        count = 0
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            pending = deque()
+            todo = iter(paths)
+
+            def fill():
+                while len(pending) < batch_size * 2:
+                    path = next(todo, None)
+                    if path is None:
+                        return
+                    pending.append((path, executor.submit(self._load_and_preprocess, path)))
+
+            fill()
+            while len(pending) > 0:
+                # 取出一个 batch, 形状不同的图片(例如保持比例缩放的模型)不能放在同一个 batch 中
+                batch_paths, batch = [], []
+                while len(pending) > 0 and len(batch) < batch_size:
+                    path, future = pending[0]
+                    try:
+                        x = future.result()
+                    except Exception as e:
+                        pending.popleft()
+                        yield [path], e
+                        continue
+                    if len(batch) > 0 and x.shape != batch[0].shape:
+                        break
+                    pending.popleft()
+                    batch_paths.append(path)
+                    batch.append(x)
+                fill()
+                if len(batch) <= 0:
+                    continue
+                try:
+                    confidents = self.run(np.stack(batch))
+                except Exception as e:
+                    yield batch_paths, e
+                    continue
+                count += len(batch_paths)
+                yield batch_paths, confidents
+
+        elapsed = time.perf_counter() - start
+        if count > 0:
+            print(f'{self.name}: interrogated {count} images in {elapsed:.2f}s '
+                  f'({count / elapsed:.2f} images/sec, batch size {batch_size})')
 
 class WaifuDiffusionInterrogator(Interrogator):
     def __init__(
@@ -127,23 +362,18 @@ class WaifuDiffusionInterrogator(Interrogator):
 
     def load(self) -> None:
         model_path, tags_path = self.download()
-        self.model = InferenceSession(str(model_path), providers=self.providers)
+        self.model = InferenceSession(str(model_path), sess_options=self.session_options(), providers=self.providers)
+        self.memory = os.path.getsize(model_path)
 
         print(f'Loaded {self.name} model from {model_path}')
 
         self.tags = pd.read_csv(tags_path)
+        # first 4 items are for rating (general, sensitive, questionable, explicit)
+        self.tag_names = self.tags['name'].to_numpy(dtype=object)
+        self.tag_categories = self.tags['category'].to_numpy() if 'category' in self.tags else None
+        self.rating_count = 4
 
-    def interrogate(
-        self,
-        image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
-    ]:
-        # init model
-        if not hasattr(self, 'model') or self.model is None:
-            self.load()
-
+    def preprocess(self, image: Image) -> np.ndarray:
         # code for converting the image and running the model is taken from the link below
         # thanks, SmilingWolf!
         # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
@@ -163,24 +393,13 @@ class WaifuDiffusionInterrogator(Interrogator):
 
         image = make_square(image, height)
         image = smart_resize(image, height)
-        image = image.astype(np.float32)
-        image = np.expand_dims(image, 0)
+        return image.astype(np.float32)
 
+    def run(self, batch: np.ndarray) -> np.ndarray:
         # evaluate model
         input_name = self.model.get_inputs()[0].name
         label_name = self.model.get_outputs()[0].name
-        confidents = self.model.run([label_name], {input_name: image})[0]
-
-        tags = self.tags[:][['name']]
-        tags['confidents'] = confidents[0]
-
-        # first 4 items are for rating (general, sensitive, questionable, explicit)
-        ratings = dict(tags[:4].values)
-
-        # rest are regular tags
-        tags = dict(tags[4:].values)
-
-        return ratings, tags
+        return self.model.run([label_name], {input_name: batch})[0]
 
 class MLDanbooruInterrogator(Interrogator):
     """ Interrogator for the MLDanbooru model. """
@@ -214,41 +433,29 @@ class MLDanbooruInterrogator(Interrogator):
     def load(self) -> None:
         model_path, tags_path = self.download()
         self.model = InferenceSession(model_path,
+                                        sess_options=self.session_options(),
                                         providers=self.providers)
+        self.memory = os.path.getsize(model_path)
         print(f'Loaded {self.name} model from {model_path}')
 
         with open(tags_path, 'r', encoding='utf-8') as filen:
             self.tags = json.load(filen)
+        self.tag_names = np.array(self.tags, dtype=object)
+        self.rating_count = 0
 
-    def interrogate(
-        self,
-        image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
-    ]:
-        # init model
-        if self.model is None:
-            self.load()
-
+    def preprocess(self, image: Image) -> np.ndarray:
         image = fill_transparent(image)
         image = resize(image, 448)  # TODO CUSTOMIZE
 
         x = asarray(image, dtype=float32) / 255
-        # HWC -> 1CHW
-        x = x.transpose((2, 0, 1))
-        x = expand_dims(x, 0)
+        # HWC -> CHW
+        return x.transpose((2, 0, 1))
 
+    def run(self, batch: np.ndarray) -> np.ndarray:
         input_ = self.model.get_inputs()[0]
         output = self.model.get_outputs()[0]
         # evaluate model
-        y, = self.model.run([output.name], {input_.name: x})
+        y, = self.model.run([output.name], {input_.name: batch})
 
         # Softmax
-        y = 1 / (1 + exp(-y))
-
-        tags = {tag: float(conf) for tag, conf in zip(self.tags, y.flatten())}
-        return {}, tags
-
-    def large_batch_interrogate(self, images: List, dry_run=False) -> str:
-        raise NotImplementedError()
+        return 1 / (1 + exp(-y))
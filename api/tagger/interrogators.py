@@ -1,6 +1,8 @@
 from typing import List, Dict
 
 from .interrogator import Interrogator, WaifuDiffusionInterrogator, MLDanbooruInterrogator
+from .manager import ModelManager
+from ..config import CONF_TAGGER_MEMORY_BUDGET
 
 interrogators: Dict[str, Interrogator] = {
     'wd14-vit.v1': WaifuDiffusionInterrogator(
@@ -74,3 +76,8 @@ interrogators: Dict[str, Interrogator] = {
         model_path='TResnet-D-FLq_ema_6-30000.onnx'
     ),
 }
+
+# 按照内存预算管理模型的加载与卸载, 预算单位为 MB
+model_manager = ModelManager(CONF_TAGGER_MEMORY_BUDGET * 1024 * 1024 if CONF_TAGGER_MEMORY_BUDGET else None)
+for key, interrogator in interrogators.items():
+    model_manager.register(key, interrogator)
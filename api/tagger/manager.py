@@ -0,0 +1,148 @@
+'''
+    模型管理
+
+    打标模型在第一次使用时加载, 所有已加载模型的内存占用(按照 onnx 模型文件的大小估计)
+    超过 tagger_memory_budget 时, 卸载最久没有使用并且当前没有在推理的模型
+    启动时在后台线程中预先下载并加载 tagger_preload 中配置的模型
+'''
+
+import gc
+import time
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+class ModelManager:
+    def __init__(self, memory_budget: int | None = None) -> None:
+        self.memory_budget = memory_budget  # 字节, None 表示不限制
+        self.interrogators = {}
+        self._lock = threading.RLock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._loaded: OrderedDict[str, None] = OrderedDict()  # 按照最近使用的顺序, 最近使用的在最后
+        self._loading = set()
+        self._in_use: Dict[str, int] = {}
+        self._last_used: Dict[str, float] = {}
+        self._errors: Dict[str, str] = {}
+
+    def register(self, key: str, interrogator) -> None:
+        with self._lock:
+            interrogator.key = key
+            interrogator.manager = self
+            self.interrogators[key] = interrogator
+            self._load_locks[key] = threading.Lock()
+            self._in_use[key] = 0
+
+    def memory(self) -> int:
+        with self._lock:
+            return sum(self.interrogators[key].memory for key in self._loaded)
+
+    def ensure_loaded(self, key: str) -> None:
+        interrogator = self.interrogators[key]
+        with self._load_locks[key]:
+            if not interrogator.loaded:
+                with self._lock:
+                    self._loading.add(key)
+                try:
+                    interrogator.load()
+                    self._errors.pop(key, None)
+                except Exception as e:
+                    self._errors[key] = str(e)
+                    raise
+                finally:
+                    with self._lock:
+                        self._loading.discard(key)
+        with self._lock:
+            self._loaded[key] = None
+            self._loaded.move_to_end(key)
+            self._last_used[key] = time.time()
+        self._evict(keep=key)
+
+    def _evict(self, keep: str) -> None:
+        # 不能在持有 self._lock 时卸载, 否则会与正在加载(持有 load lock)的线程死锁
+        if self.memory_budget is None:
+            return
+        tried = set()
+        while True:
+            with self._lock:
+                if self.memory() <= self.memory_budget:
+                    return
+                candidates = [key for key in self._loaded if key != keep and key not in tried and self._in_use[key] <= 0]
+            if len(candidates) <= 0:
+                return
+            tried.add(candidates[0])
+            self.unload(candidates[0])
+
+    def unload(self, key: str) -> bool:
+        '''
+            卸载模型, 正在加载或者推理的模型不会被卸载
+        '''
+        if not self._load_locks[key].acquire(blocking=False):
+            return False
+        try:
+            with self._lock:
+                if self._in_use[key] > 0:
+                    return False
+                self._loaded.pop(key, None)
+            unloaded = self.interrogators[key].unload()
+        finally:
+            self._load_locks[key].release()
+        gc.collect()
+        return unloaded
+
+    @contextmanager
+    def use(self, key: str):
+        '''
+            推理期间持有模型, 保证不会被其他请求触发的淘汰卸载
+        '''
+        with self._lock:
+            self._in_use[key] += 1
+        try:
+            self.ensure_loaded(key)
+            yield self.interrogators[key]
+        finally:
+            with self._lock:
+                self._in_use[key] -= 1
+                self._last_used[key] = time.time()
+                if key in self._loaded:
+                    self._loaded.move_to_end(key)
+            self._evict(keep=key)
+
+    def preload(self, keys: List[str]) -> None:
+        '''
+            在后台线程中依次下载并加载模型, 立即返回
+        '''
+        def run():
+            for key in keys:
+                if key not in self.interrogators:
+                    print(f'unknown model {key}, skip preloading')
+                    continue
+                try:
+                    self.ensure_loaded(key)
+                except Exception as e:
+                    print(f'fail to preload {key}', e)
+
+        if len(keys) > 0:
+            threading.Thread(target=run, name='tagger-preload', daemon=True).start()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'memory_budget': self.memory_budget,
+                'memory': self.memory(),
+                'models': [
+                    {
+                        'key': key,
+                        'name': interrogator.name,
+                        'loaded': key in self._loaded,
+                        'loading': key in self._loading,
+                        'in_use': self._in_use[key],
+                        'memory': interrogator.memory if key in self._loaded else 0,
+                        'last_used': self._last_used.get(key),
+                        'error': self._errors.get(key),
+                    }
+                    for key, interrogator in self.interrogators.items()
+                ],
+            }
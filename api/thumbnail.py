@@ -0,0 +1,193 @@
+'''
+  缩略图服务
+
+  缩略图保存在 repo_dir/.thumbnail 中, 生成过程在线程池中执行, 不阻塞事件循环
+  - 支持多种尺寸(thumbnail_sizes, 例如 grid, preview, cover), 可以选择保存为 WEBP/AVIF(thumbnail_format)
+    默认的 grid 尺寸并且不转换格式时保存在 .thumbnail/{path}, 其他的保存在 .thumbnail/{dir}/.{size}/{basename}[.{format}]
+  - JPEG 使用 draft 模式在解码时直接按 1/2, 1/4, 1/8 缩小, 其他格式在 thumbnail 中使用 reduce 先粗略缩小
+  - 同一张缩略图同时只会生成一次, 并发的请求会等待同一个 future
+  - 导入, 上传以及移动图片之后会在后台预先生成缩略图, 预生成使用单独的线程池, 不会挤占页面请求
+  - 原图的内容发生变化(catalog 中内容版本的 mtime 比缩略图新)时重新生成, 写回标签只修改 exif, 不会重新生成
+  - 最近访问的缩略图(包括封面)保存在内存中的 LRU 缓存里(thumbnail_cache_size), 以原图内容的版本号校验,
+    图片被修改, 移动或者删除时通过 remove/remove_dir 同时删除
+'''
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from PIL import Image
+from .config import CONF_REPO_DIR, CONF_THUMBNAIL_WORKERS, CONF_THUMBNAIL_SIZES, CONF_THUMBNAIL_FORMAT, CONF_THUMBNAIL_QUALITY, CONF_THUMBNAIL_CACHE_SIZE
+from .cache import LRUCache
+from . import catalog
+import mimetypes
+import threading
+import asyncio
+import shutil
+import os
+
+
+DEFAULT_SIZE = 'grid'
+THUMBNAIL_SIZES: dict[str, tuple[int, int]] = { name: tuple(size) for name, size in CONF_THUMBNAIL_SIZES.items() }
+PREWARM_WORKERS = 2
+
+Image.init()
+THUMBNAIL_FORMAT = CONF_THUMBNAIL_FORMAT.upper() if CONF_THUMBNAIL_FORMAT else None
+if THUMBNAIL_FORMAT is not None and THUMBNAIL_FORMAT not in Image.SAVE:
+  print(f'pillow does not support saving {THUMBNAIL_FORMAT}, thumbnails will keep the original format')
+  THUMBNAIL_FORMAT = None
+
+_executor = ThreadPoolExecutor(max_workers=CONF_THUMBNAIL_WORKERS, thread_name_prefix='thumbnail')
+_prewarm_executor = ThreadPoolExecutor(max_workers=PREWARM_WORKERS, thread_name_prefix='thumbnail-prewarm')
+_pending: dict[tuple[str, str], Future] = {}
+_pending_lock = threading.RLock() # future.cancel() 会在持有锁时同步调用回调
+cache = LRUCache(CONF_THUMBNAIL_CACHE_SIZE * 1024 * 1024)
+
+
+def _key(image_name: str) -> str:
+  return os.path.normpath(image_name).replace('\\', '/')
+
+
+def thumbnail_path(image_name: str, size: str = DEFAULT_SIZE) -> str:
+  if size == DEFAULT_SIZE and THUMBNAIL_FORMAT is None:
+    return os.path.join(CONF_REPO_DIR, '.thumbnail', image_name)
+  dirname, basename = os.path.split(image_name)
+  if THUMBNAIL_FORMAT is not None:
+    basename = f'{basename}.{THUMBNAIL_FORMAT.lower()}'
+  return os.path.join(CONF_REPO_DIR, '.thumbnail', dirname, f'.{size}', basename)
+
+def media_type(image_name: str) -> str | None:
+  '''
+    缩略图的 Content-Type, 保持原图格式时根据扩展名判断
+  '''
+  if THUMBNAIL_FORMAT is not None:
+    return Image.MIME.get(THUMBNAIL_FORMAT)
+  return mimetypes.guess_type(image_name)[0]
+
+def content_version(image_name: str) -> tuple[int, int] | None:
+  '''
+    原图内容的版本 (mtime_ns, size), 见 catalog, 原图不存在时返回 None
+  '''
+  return catalog.get_content_versions([image_name]).get(image_name)
+
+def version(content: tuple[int, int]) -> str:
+  '''
+    由原图内容的版本得到的版本号, 与 load_concept 返回的 url 中的 v 一致
+  '''
+  return catalog.version(content)
+
+def etag(image_version: str, size: str) -> str:
+  return f'"{image_version}-{size}-{THUMBNAIL_FORMAT or "orig"}"'
+
+def make_thumbnail(image_name: str, size: str = DEFAULT_SIZE) -> str | None:
+  '''
+    生成缩略图并返回缩略图的绝对路径, 原图不存在时返回 None
+  '''
+  image_path = os.path.join(CONF_REPO_DIR, image_name)
+  path = thumbnail_path(image_name, size)
+  content = content_version(image_name)
+  if content is None:
+    return None
+  try:
+    if os.stat(path).st_mtime_ns >= content[0]:
+      return path
+  except OSError:
+    pass
+  target_size = THUMBNAIL_SIZES[size]
+  with Image.open(image_path) as img:
+    # JPEG 在解码时直接缩小到不小于目标尺寸两倍的大小, 避免完整解码
+    img.draft('RGB', (target_size[0] * 2, target_size[1] * 2))
+    if img.mode not in ('RGB', 'RGBA', 'L'):
+      # 调色板等模式缩放时只能使用最近邻, 先转换一次
+      img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    img.thumbnail(size=target_size, reducing_gap=2.0)
+    img = img.convert('RGB')
+    parent_dir = os.path.dirname(path)
+    os.makedirs(parent_dir, exist_ok=True)
+    # 先写入临时文件再重命名, 其他请求不会读到写了一半的缩略图
+    _, ext = os.path.splitext(path)
+    temp_path = f'{path}.{threading.get_ident()}.tmp{ext}'
+    if THUMBNAIL_FORMAT is not None:
+      img.save(temp_path, THUMBNAIL_FORMAT, quality=CONF_THUMBNAIL_QUALITY)
+    else:
+      img.save(temp_path)
+    os.replace(temp_path, path)
+  return path
+
+def _submit(image_name: str, size: str, executor: ThreadPoolExecutor) -> Future:
+  key = (image_name, size)
+  with _pending_lock:
+    future = _pending.get(key)
+    if future is not None:
+      # 还在预生成队列中排队的任务, 取消之后放到页面请求的线程池中, 避免等待整个队列
+      if executor is _prewarm_executor or not future.cancel():
+        return future
+    future = executor.submit(make_thumbnail, image_name, size)
+    _pending[key] = future
+  def done(_):
+    with _pending_lock:
+      if _pending.get(key) is future:
+        del _pending[key]
+  future.add_done_callback(done)
+  return future
+
+async def get_thumbnail(image_name: str, size: str = DEFAULT_SIZE) -> str | None:
+  '''
+    返回缩略图的绝对路径, 不存在或者过期时在线程池中生成, 原图不存在时返回 None
+  '''
+  return await asyncio.wrap_future(_submit(image_name, size, _executor))
+
+def _read(path: str) -> bytes:
+  with open(path, 'rb') as f:
+    return f.read()
+
+async def get_thumbnail_data(image_name: str, size: str, image_version: str) -> bytes | None:
+  '''
+    返回缩略图的内容, 优先从内存缓存中读取, image_version 为原图的版本号, 原图不存在时返回 None
+  '''
+  key = (_key(image_name), size)
+  data = cache.get(key, image_version)
+  if data is not None:
+    return data
+  path = await get_thumbnail(image_name, size)
+  if path is None:
+    return None
+  data = await asyncio.wrap_future(_executor.submit(_read, path))
+  cache.put(key, data, len(data), image_version)
+  return data
+
+def prewarm(image_names: list[str], size: str = DEFAULT_SIZE):
+  '''
+    在后台预先生成缩略图, 立即返回
+  '''
+  for image_name in image_names:
+    future = _submit(image_name, size, _prewarm_executor)
+    future.add_done_callback(_log_error)
+
+def _log_error(future: Future):
+  if not future.cancelled() and future.exception() is not None:
+    print('fail to make thumbnail', future.exception())
+
+def remove(image_names: list[str]):
+  '''
+    删除图片所有尺寸的缩略图, 图片被修改, 移动或者删除之后调用
+  '''
+  for image_name in image_names:
+    for size in THUMBNAIL_SIZES:
+      cache.pop((_key(image_name), size))
+    paths = { os.path.join(CONF_REPO_DIR, '.thumbnail', image_name) }
+    paths.update(thumbnail_path(image_name, size) for size in THUMBNAIL_SIZES)
+    for path in paths:
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      except Exception as e:
+        print(e)
+
+def remove_dir(dir: str):
+  '''
+    删除 dir(imageset-xxx, imageset-xxx/src 或者 imageset-xxx/src/8_katana) 下的所有缩略图
+  '''
+  prefix = _key(dir).rstrip('/') + '/'
+  cache.discard(lambda key: key[0].startswith(prefix))
+  thumbnail_dir = os.path.join(CONF_REPO_DIR, '.thumbnail', dir)
+  if os.path.exists(thumbnail_dir):
+    shutil.rmtree(thumbnail_dir)
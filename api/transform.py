@@ -0,0 +1,266 @@
+'''
+  批量图片变换(翻转, 旋转, 裁剪, 放大)
+
+  1. 图片在进程池中并行地解码, 变换并写入同一目录下的临时文件, 同时提交的任务数量有上限,
+     任意时刻只有少量图片被解码在内存中, 任务被取消时也不需要等待整个队列
+  2. 主进程持有 caption.file_lock 将临时文件重命名为原文件, 读取图片的请求不会看到写了一半的文件
+  3. 替换之后统一失效缓存: 缩略图, 打标置信度, 索引中的宽高与 hash;
+     重新编码会丢失 exif 中的标签, 有标签的图片标记为需要写回
+  4. 返回每张图片的结果 { path: { status: 'transformed' | 'skipped' | 'failed', error, lossless } }
+  JPEG 的翻转, 旋转以及左上角对齐到 MCU 的裁剪通过 jpegtran 直接变换 DCT 系数, 不会损失画质;
+  没有安装 jpegtran 或者不能无损完成时重新编码, 质量与色度抽样由 jpeg_quality, jpeg_subsampling 配置
+  图片较少时直接在当前线程中执行, 避免启动进程池的开销
+'''
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image, JpegImagePlugin
+from .config import CONF_REPO_DIR, CONF_TRANSFORM_WORKERS, CONF_JPEGTRAN, CONF_JPEG_QUALITY, CONF_JPEG_SUBSAMPLING
+from .job import progress
+from . import catalog
+from . import caption
+from . import confidence
+from . import thumbnail
+from . import decode
+import subprocess
+import shutil
+import uuid
+import os
+
+
+PARALLEL_MIN = 4
+PENDING_PER_WORKER = 2 # 每个进程最多排队的任务数量
+
+
+def flip(img: Image.Image, horizontal: bool) -> Image.Image:
+  return img.transpose(Image.FLIP_LEFT_RIGHT if horizontal else Image.FLIP_TOP_BOTTOM)
+
+
+def rotate(img: Image.Image, degrees: int) -> Image.Image:
+  '''
+    顺时针旋转 90, 180 或者 270 度
+  '''
+  return img.transpose({ 90: Image.ROTATE_270, 180: Image.ROTATE_180, 270: Image.ROTATE_90 }[degrees])
+
+
+def crop_box(img: Image.Image, x: float, y: float, width: float, height: float) -> tuple[int, int, int, int]:
+  '''
+    x, y, width, height 为百分比, 返回像素坐标 (left, top, right, bottom)
+  '''
+  left = x * img.width / 100
+  right = left + width * img.width / 100
+  top = y * img.height / 100
+  bottom = top + height * img.height / 100
+  return tuple(int(round(value)) for value in (left, top, right, bottom))
+
+
+def cut(img: Image.Image, x: float, y: float, width: float, height: float) -> Image.Image:
+  return img.crop(crop_box(img, x, y, width, height))
+
+
+def upscale(img: Image.Image, width: int, height: int) -> Image.Image | None:
+  '''
+    放大到不小于 width x height, 已经足够大时返回 None
+  '''
+  if img.width >= width and img.height >= height:
+    return None
+  scale = max(width / img.width, height / img.height)
+  return img.resize((int(img.width * scale + 0.001), int(img.height * scale + 0.001)), Image.Resampling.LANCZOS)
+
+
+OPERATIONS = {
+  'flip': flip,
+  'rotate': rotate,
+  'cut': cut,
+  'upscale': upscale,
+}
+
+
+def mcu_size(img: Image.Image) -> tuple[int, int]:
+  '''
+    JPEG 的最小编码单元(MCU)尺寸, 由各个分量中最大的抽样因子决定, 例如 4:2:0 为 16x16
+  '''
+  layers = getattr(img, 'layer', None) or []
+  if len(layers) <= 1:
+    return 8, 8
+  return 8 * max(layer[1] for layer in layers), 8 * max(layer[2] for layer in layers)
+
+
+def lossless_flip(img: Image.Image, horizontal: bool) -> list[str] | None:
+  # 翻转方向上的尺寸不是 MCU 的整数倍时, 边缘不完整的 MCU 无法无损翻转
+  mcu_width, mcu_height = mcu_size(img)
+  if horizontal:
+    return ['-flip', 'horizontal'] if img.width % mcu_width == 0 else None
+  return ['-flip', 'vertical'] if img.height % mcu_height == 0 else None
+
+
+def lossless_rotate(img: Image.Image, degrees: int) -> list[str] | None:
+  mcu_width, mcu_height = mcu_size(img)
+  if degrees in (90, 180) and img.height % mcu_height != 0:
+    return None
+  if degrees in (180, 270) and img.width % mcu_width != 0:
+    return None
+  return ['-rotate', str(degrees)]
+
+
+def lossless_cut(img: Image.Image, x: float, y: float, width: float, height: float) -> list[str] | None:
+  # 左上角对齐到 MCU 时才能无损裁剪, 右边与下边可以是任意位置
+  left, top, right, bottom = crop_box(img, x, y, width, height)
+  mcu_width, mcu_height = mcu_size(img)
+  if left < 0 or top < 0 or right > img.width or bottom > img.height or right <= left or bottom <= top:
+    return None
+  if left % mcu_width != 0 or top % mcu_height != 0:
+    return None
+  return ['-crop', f'{right - left}x{bottom - top}+{left}+{top}']
+
+
+# 返回 jpegtran 参数, 无法无损完成时返回 None
+LOSSLESS_OPERATIONS = {
+  'flip': lossless_flip,
+  'rotate': lossless_rotate,
+  'cut': lossless_cut,
+}
+
+JPEGTRAN = shutil.which(CONF_JPEGTRAN) if CONF_JPEGTRAN else None
+
+
+def jpegtran(abs_path: str, temp_path: str, args: list[str]) -> bool:
+  '''
+    直接变换 DCT 系数, 不解码也不重新量化, 保留所有 exif(包括标签)
+    -perfect 保证无法无损完成时失败, 而不是丢弃边缘或者部分重新编码
+  '''
+  try:
+    completed = subprocess.run(
+      [JPEGTRAN, '-copy', 'all', '-perfect', *args, '-outfile', temp_path, abs_path],
+      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60,
+    )
+  except (OSError, subprocess.TimeoutExpired) as e:
+    print('jpegtran', abs_path, e)
+    return False
+  if completed.returncode != 0 or not os.path.exists(temp_path):
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+    return False
+  return True
+
+
+def save_options(img: Image.Image) -> dict:
+  '''
+    重新编码时使用的参数, img 为原图
+  '''
+  options = {}
+  if img.info.get('icc_profile'):
+    options['icc_profile'] = img.info['icc_profile']
+  if img.format != 'JPEG':
+    return options
+  if CONF_JPEG_QUALITY == 'keep':
+    # 沿用原图的量化表, 多次编辑不会因为质量设置不同而逐渐变差
+    if getattr(img, 'quantization', None):
+      options['qtables'] = img.quantization
+  else:
+    options['quality'] = int(CONF_JPEG_QUALITY)
+  if CONF_JPEG_SUBSAMPLING == 'keep':
+    subsampling = JpegImagePlugin.get_sampling(img)
+    if subsampling != -1:
+      options['subsampling'] = subsampling
+  else:
+    options['subsampling'] = CONF_JPEG_SUBSAMPLING
+  if img.info.get('progressive'):
+    options['progressive'] = True
+  return options
+
+
+def apply(operation: str, abs_path: str, temp_path: str, params: dict) -> tuple[str, str | None, bool]:
+  '''
+    在子进程中执行, 结果写入 temp_path, 返回 (status, error, lossless), status 为 transformed, skipped 或者 failed
+    JPEG 优先使用 jpegtran 无损变换, 不能无损完成时重新编码
+  '''
+  try:
+    with Image.open(abs_path) as img:
+      format = img.format
+      if JPEGTRAN is not None and format == 'JPEG' and operation in LOSSLESS_OPERATIONS:
+        args = LOSSLESS_OPERATIONS[operation](img, **params)
+        if args is not None and jpegtran(abs_path, temp_path, args):
+          return 'transformed', None, True
+      result = OPERATIONS[operation](img, **params)
+      if result is None:
+        return 'skipped', None, False
+      result.save(temp_path, format, **save_options(img))
+    return 'transformed', None, False
+  except Exception as e:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+    return 'failed', str(e), False
+
+
+def _run_parallel(tasks: list[tuple]):
+  '''
+    按照完成的顺序返回 (下标, (status, error)), 同时提交的任务不超过 workers * PENDING_PER_WORKER
+  '''
+  workers = max(1, min(CONF_TRANSFORM_WORKERS, len(tasks)))
+  executor = ProcessPoolExecutor(max_workers=workers)
+  try:
+    pending = {}
+    queued = iter(enumerate(tasks))
+    while True:
+      for i, args in queued:
+        pending[executor.submit(apply, *args)] = i
+        if len(pending) >= workers * PENDING_PER_WORKER:
+          break
+      if len(pending) <= 0:
+        return
+      done, _ = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        yield pending.pop(future), future.result()
+  finally:
+    executor.shutdown(wait=True, cancel_futures=True)
+
+
+def run(operation: str, items: list[tuple[str, dict]], desc: str | None = None) -> dict[str, dict]:
+  '''
+    items 为 [(path, params)], path 从 imageset-xxx 开始, params 为 OPERATIONS 中函数的参数
+    return { path: { status: 'transformed' | 'skipped' | 'failed', error: str | None, lossless: bool } }
+  '''
+  # 同一张图片只变换一次, 避免两个进程同时写入
+  items = list(dict(items).items())
+  # 标签可能还只保存在 exif 中, 先导入索引, 重新编码之后才能写回
+  captions = catalog.get_captions([path for path, _ in items])
+  batch_id = uuid.uuid4().hex
+  tasks = []
+  for i, (path, params) in enumerate(items):
+    abs_path = os.path.join(CONF_REPO_DIR, path)
+    # 保留扩展名, 临时文件与原文件位于同一目录, 保证可以原子地重命名
+    temp_path = os.path.join(os.path.dirname(abs_path), f'.transform-{batch_id}-{i}.tmp{os.path.splitext(path)[1]}')
+    tasks.append((operation, abs_path, temp_path, params))
+
+  if len(tasks) >= PARALLEL_MIN:
+    results = _run_parallel(tasks)
+  else:
+    results = ((i, apply(*args)) for i, args in enumerate(tasks))
+
+  report = {}
+  try:
+    for i, (status, error, lossless) in progress(results, total=len(tasks), desc=desc or operation):
+      path = items[i][0]
+      report[path] = { 'status': status, 'error': error, 'lossless': lossless }
+      if status == 'failed':
+        print(path, error)
+        continue
+      if status == 'skipped':
+        continue
+      _, abs_path, temp_path, _ = tasks[i]
+      with caption.file_lock:
+        os.replace(temp_path, abs_path)
+        catalog.invalidate_images([path])
+        # jpegtran 保留了 exif, 其他情况需要重新写回标签
+        if not lossless and len(captions.get(path, [])) > 0:
+          caption.rewrite([path])
+      thumbnail.remove([path])
+      decode.remove([path])
+      confidence.remove([path])
+  finally:
+    # 任务被取消或者出错时停止进程池并清理剩余的临时文件
+    results.close()
+    for _, _, temp_path, _ in tasks:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+  return report
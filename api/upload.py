@@ -0,0 +1,412 @@
+'''
+  流式, 可续传的批量上传
+
+  原来的 /imageset/uploadimages 需要整个 multipart 表单解析完成才开始处理, 并且每张图片都读入内存之后在事件循环中重新编码
+  这里每个文件单独以原始的请求体上传, 边接收边写入 repo_dir/.upload/{id}/ 下的临时文件, 内存占用与文件大小无关
+  - 创建会话时提交所有文件的名称与大小, 之后按照任意顺序, 任意大小的分块 PUT 每个文件的内容
+  - 文件接收完整之后立即提交到进程池(upload_workers)中转换格式, 与后续文件的上传并行
+  - 转换完成的文件按照提交时的顺序通过 naming 发布为编号, 前面的文件还没有完成(done 或者 failed)时先保留转换结果
+  - 每个文件的状态 pending(还没有接收完整), processing, done, failed 通过 GET /upload/{id} 查询
+  - 会话的信息保存在 session.json 中, 连接中断或者服务重启之后, 根据 received 从中断的位置继续上传即可
+  - 所有文件完成之后删除临时目录, 超过 SESSION_TIMEOUT 没有完成的会话在创建新的会话时清理
+    POST   /upload/                      创建会话
+    GET    /upload/{id}                  查询状态
+    PUT    /upload/{id}/{index}?offset=  从 offset 开始上传第 index 个文件的内容
+    DELETE /upload/{id}                  取消, 已经发布的图片不会删除
+'''
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from concurrent.futures import ProcessPoolExecutor, Future
+from pydantic import BaseModel
+from typing import List
+from .config import CONF_REPO_DIR, CONF_UPLOAD_WORKERS
+from .importer import convert_image
+from . import naming
+from . import thumbnail
+import threading
+import shutil
+import json
+import time
+import uuid
+import re
+import os
+
+
+api_upload = APIRouter()
+
+UPLOAD_DIR = os.path.join(CONF_REPO_DIR, '.upload')
+SESSION_TIMEOUT = 24 * 3600  # 秒
+WRITE_SIZE = 1024 * 1024     # 接收到的数据累积到该大小之后在线程池中写入文件
+
+_sessions: dict[str, 'Session'] = {}
+_sessions_lock = threading.Lock()
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def _submit(fn, *args) -> Future:
+  global _executor
+  with _executor_lock:
+    if _executor is None:
+      _executor = ProcessPoolExecutor(max_workers=max(1, CONF_UPLOAD_WORKERS))
+    return _executor.submit(fn, *args)
+
+
+class Session:
+  def __init__(self, id: str, dest_dir: str, reencode: bool, files: list[dict], created: float):
+    self.id = id
+    self.dest_dir = dest_dir
+    self.reencode = reencode
+    self.files = files          # [{ name, size, received, status, target, error }]
+    self.created = created
+    self.cancelled = False
+    self.uploading: set[int] = set()
+    self.converted: dict[int, str] = {} # 已经转换但是还没有发布的文件, { index: 临时文件的绝对路径 }
+    self.allocation: naming.Allocation | None = None
+    self.lock = threading.Lock()                # 只在读写内存中的状态时持有, 不做磁盘操作
+    self.publish_lock = threading.RLock()       # 保证按照顺序发布, allocation 只在持有时访问
+    self.save_lock = threading.Lock()           # session.json 按照快照的顺序写入
+
+  @property
+  def dir(self) -> str:
+    return os.path.join(UPLOAD_DIR, self.id)
+
+  def part_path(self, index: int) -> str:
+    return os.path.join(self.dir, f'{index}.part')
+
+  def save(self):
+    # 已经接收的大小由 .part 文件的大小决定, 不需要保存
+    with self.save_lock:
+      if self.cancelled:
+        return
+      with self.lock:
+        data = {
+          'dest_dir': self.dest_dir,
+          'reencode': self.reencode,
+          'created': self.created,
+          'files': [{ key: value for key, value in file.items() if key != 'received' } for file in self.files],
+          'converted': dict(self.converted),
+        }
+      temp_path = os.path.join(self.dir, f'session.json.{threading.get_ident()}.tmp')
+      with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+      os.replace(temp_path, os.path.join(self.dir, 'session.json'))
+
+  @staticmethod
+  def read(id: str) -> dict | None:
+    try:
+      with open(os.path.join(UPLOAD_DIR, id, 'session.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  @staticmethod
+  def load(id: str) -> 'Session | None':
+    data = Session.read(id)
+    if data is None:
+      return None
+    session = Session(id, data['dest_dir'], data['reencode'], data['files'], data['created'])
+    for index, file in enumerate(session.files):
+      file['received'] = os.path.getsize(session.part_path(index)) if os.path.exists(session.part_path(index)) else 0
+    session.converted = {
+      int(index): temp_path for index, temp_path in data.get('converted', {}).items()
+      if os.path.exists(temp_path)
+    }
+    # 服务重启之前正在处理的文件, 已经转换完成的等待发布, 否则重新处理
+    for index, file in enumerate(session.files):
+      if file['status'] == 'processing' and index not in session.converted:
+        if file['received'] == file['size']:
+          session.process(index)
+        else:
+          file['status'] = 'pending'
+    session._publish_ready()
+    return session
+
+  def status(self) -> dict:
+    with self.lock:
+      files = [dict(file) for file in self.files]
+    return {
+      'id': self.id,
+      'dest_dir': self.dest_dir,
+      'files': files,
+      'total': sum(file['size'] for file in files),
+      'received': sum(file['received'] for file in files),
+      'done': len([file for file in files if file['status'] == 'done']),
+      'failed': len([file for file in files if file['status'] == 'failed']),
+      'finished': all(file['status'] in ('done', 'failed') for file in files),
+    }
+
+  def process(self, index: int):
+    '''
+      文件已经接收完整, 在进程池中转换为 CONF_IMAGE_EXT 并写入目标目录下的临时文件
+    '''
+    with self.lock:
+      self.files[index]['status'] = 'processing'
+    self.save()
+    temp_path = naming.temp_path(self.dest_dir, f'upload-{index}')
+    future = _submit(convert_image, self.part_path(index), temp_path, self.reencode)
+    future.add_done_callback(lambda future: self._processed(index, temp_path, future))
+
+  def _error(self, index: int, error: str, *paths: str) -> str:
+    # 错误信息中的服务端路径替换为上传时的文件名
+    for path in (self.part_path(index), *paths):
+      error = error.replace(path, self.files[index]['name'])
+    return error.replace(os.path.join(CONF_REPO_DIR, ''), '')
+
+  def _fail(self, index: int, error: str):
+    with self.lock:
+      self.files[index].update(status='failed', error=error)
+    if os.path.exists(self.part_path(index)):
+      os.remove(self.part_path(index))
+
+  def _processed(self, index: int, temp_path: str, future: Future):
+    # 服务退出时被取消, 保持 processing, 重启之后重新处理
+    if self.cancelled or future.cancelled():
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      return
+    try:
+      status, error = future.result()
+    except Exception as e:
+      print('upload', self.id, index, e)
+      status, error = 'failed', str(e)
+    if status == 'failed':
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      self._fail(index, self._error(index, error, temp_path))
+    else:
+      with self.lock:
+        self.converted[index] = temp_path
+    self._publish_ready()
+
+  def _next_ready(self) -> tuple[int, str, int] | None:
+    '''
+      取出下一个可以发布的文件 (index, 临时文件, 需要分配的编号数量), 前面还有没有完成的文件时返回 None
+    '''
+    with self.lock:
+      if self.cancelled:
+        return None
+      for index, file in enumerate(self.files):
+        if file['status'] in ('done', 'failed'):
+          continue
+        if index not in self.converted:
+          return None
+        count = len([file for file in self.files if file['status'] != 'failed'])
+        return index, self.converted.pop(index), count
+    return None
+
+  def _publish_ready(self):
+    '''
+      按照顺序发布已经转换的文件, 遇到还没有完成的文件时停止
+      publish_lock 保证同时只有一个线程发布, 编号分配, 链接文件与预热缩略图时不持有 lock
+    '''
+    with self.publish_lock:
+      while (ready := self._next_ready()) is not None:
+        index, temp_path, count = ready
+        try:
+          if self.allocation is None:
+            self.allocation = naming.allocate(self.dest_dir, count)
+          target = self.allocation.publish(temp_path)
+          with self.lock:
+            self.files[index].update(status='done', target=target, error=None)
+          thumbnail.prewarm([target])
+          if os.path.exists(self.part_path(index)):
+            os.remove(self.part_path(index))
+        except Exception as e:
+          print('upload', self.id, index, e)
+          self._fail(index, self._error(index, str(e), temp_path))
+        finally:
+          if os.path.exists(temp_path):
+            os.remove(temp_path)
+      if not self.cancelled:
+        self.save()
+        self._finish()
+
+  def _finish(self):
+    # 所有文件都已经完成, 释放编号并删除临时目录, 状态仍然可以查询
+    with self.lock:
+      finished = all(file['status'] in ('done', 'failed') for file in self.files)
+    if finished:
+      self.close()
+
+  def close(self):
+    # 等待正在进行的发布完成
+    with self.publish_lock:
+      with self.lock:
+        temp_paths = list(self.converted.values())
+        self.converted.clear()
+      # 转换完成但是没有发布的临时文件位于目标目录中, 一起删除
+      for temp_path in temp_paths:
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+      if self.allocation is not None:
+        self.allocation.close()
+        self.allocation = None
+      with self.save_lock:
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def _cleanup():
+  '''
+    清理超时的会话, 以及内存中已经完成很久的会话
+  '''
+  now = time.time()
+  with _sessions_lock:
+    for id in [id for id, session in _sessions.items() if now - session.created > SESSION_TIMEOUT and session.status()['finished']]:
+      del _sessions[id]
+  if not os.path.isdir(UPLOAD_DIR):
+    return
+  for id in os.listdir(UPLOAD_DIR):
+    path = os.path.join(UPLOAD_DIR, id)
+    try:
+      expired = now - os.stat(path).st_mtime > SESSION_TIMEOUT
+    except OSError:
+      continue
+    if expired:
+      with _sessions_lock:
+        session = _sessions.pop(id, None)
+      if session is not None:
+        session.cancelled = True
+        session.close()
+        continue
+      data = Session.read(id)
+      for temp_path in (data or {}).get('converted', {}).values():
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+      shutil.rmtree(path, ignore_errors=True)
+
+
+def _get_session(id: str) -> Session:
+  if re.fullmatch(r'[0-9a-f]{32}', id) is None:
+    raise HTTPException(status_code=404, detail=f"upload {id} is not found")
+  with _sessions_lock:
+    session = _sessions.get(id)
+    if session is None:
+      session = Session.load(id)
+      if session is None:
+        raise HTTPException(status_code=404, detail=f"upload {id} is not found")
+      _sessions[id] = session
+  return session
+
+
+class UploadFileInfo(BaseModel):
+  name: str
+  size: int
+
+class UploadRequest(BaseModel):
+  imageset_name: str
+  type: str                   # train 或者 regular
+  concept_folder: str
+  files: List[UploadFileInfo]
+  reencode: bool = True       # 为 false 时已经是 CONF_IMAGE_EXT 格式的图片直接复制
+
+@api_upload.post('/')
+async def create_upload(request: UploadRequest):
+  '''
+    return 与 GET /upload/{id} 相同
+  '''
+  subdir = 'reg' if request.type == "regular" else "src"
+  dest_dir = os.path.join('imageset-' + request.imageset_name, subdir, request.concept_folder).replace('\\', '/')
+  if any(file.size < 0 for file in request.files):
+    raise HTTPException(status_code=400, detail="file size should not be negative")
+  await run_in_threadpool(_cleanup)
+  files = [
+    { 'name': file.name, 'size': file.size, 'received': 0, 'status': 'pending', 'target': None, 'error': None }
+    for file in request.files
+  ]
+  session = Session(uuid.uuid4().hex, dest_dir, request.reencode, files, time.time())
+  def create():
+    os.makedirs(os.path.join(CONF_REPO_DIR, dest_dir), exist_ok=True)
+    os.makedirs(session.dir)
+    session.save()
+  await run_in_threadpool(create)
+  with _sessions_lock:
+    _sessions[session.id] = session
+  return session.status()
+
+@api_upload.get('/{id}')
+async def get_upload(id: str):
+  '''
+    {
+      id, dest_dir, total, received, done, failed, finished,
+      files: [{ name, size, received, status: 'pending' | 'processing' | 'done' | 'failed', target: string | null, error: string | null }]
+    }
+  '''
+  return (await run_in_threadpool(_get_session, id)).status()
+
+@api_upload.put('/{id}/{index}')
+async def upload_file(id: str, index: int, request: Request, offset: int = 0):
+  '''
+    请求体为文件从 offset 开始的原始内容, offset 需要与已经接收的大小一致, 否则返回 409 与当前的 received
+    return 该文件的状态
+  '''
+  session = await run_in_threadpool(_get_session, id)
+  if index < 0 or index >= len(session.files):
+    raise HTTPException(status_code=404, detail=f"file {index} is not found")
+  file = session.files[index]
+
+  # session.lock 可能被发布文件的线程持有, 不在事件循环中等待
+  def begin():
+    with session.lock:
+      if session.cancelled or file['status'] != 'pending':
+        return dict(file)
+      if offset != file['received'] or index in session.uploading:
+        return JSONResponse(status_code=409, content={ 'detail': 'offset mismatch', 'received': file['received'] })
+      session.uploading.add(index)
+
+  def end(received: int) -> bool:
+    with session.lock:
+      file['received'] = received
+      session.uploading.discard(index)
+      return file['received'] == file['size'] and file['status'] == 'pending' and not session.cancelled
+
+  def current() -> dict:
+    with session.lock:
+      return dict(file)
+
+  response = await run_in_threadpool(begin)
+  if response is not None:
+    return response
+  f = await run_in_threadpool(open, session.part_path(index), 'ab')
+  received = offset
+  try:
+    buffer = bytearray()
+    try:
+      async for chunk in request.stream():
+        if received + len(buffer) + len(chunk) > file['size']:
+          raise HTTPException(status_code=400, detail="more data than the declared size")
+        buffer += chunk
+        if len(buffer) >= WRITE_SIZE:
+          await run_in_threadpool(f.write, bytes(buffer))
+          received += len(buffer)
+          buffer.clear()
+    except ClientDisconnect:
+      pass
+    # 连接中断时也保留已经接收的部分, 之后从 received 继续
+    if len(buffer) > 0:
+      await run_in_threadpool(f.write, bytes(buffer))
+      received += len(buffer)
+  finally:
+    await run_in_threadpool(f.close)
+    complete = await run_in_threadpool(end, received)
+  if complete:
+    await run_in_threadpool(session.process, index)
+  return await run_in_threadpool(current)
+
+@api_upload.delete('/{id}')
+async def cancel_upload(id: str):
+  session = await run_in_threadpool(_get_session, id)
+  session.cancelled = True
+  await run_in_threadpool(session.close)
+  with _sessions_lock:
+    _sessions.pop(id, None)
+
+
+def shutdown():
+  # 等待正在转换的文件完成, 还没有开始的保持 processing, 重启之后重新处理
+  with _executor_lock:
+    if _executor is not None:
+      _executor.shutdown(wait=True, cancel_futures=True)
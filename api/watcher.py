@@ -0,0 +1,417 @@
+'''
+  目录列表缓存与文件监视
+
+  get_concept_folder_list 与 get_image_list 通过 listdir 读取目录, 结果按照目录缓存
+  - 每次读取只 stat 目录本身, 目录的 mtime 没有变化时直接使用缓存, 否则重新 scandir
+    (新增, 删除, 重命名都会改变目录的 mtime, 不需要逐个 stat 文件)
+    网络存储与 FAT 的时间戳精度较低, 扫描之后同一个时间戳内新增的文件不会改变 mtime,
+    因此目录的 mtime 与扫描时间相差不到 RACY_WINDOW 秒时不信任缓存, 每次重新扫描
+  - 扫描时每个条目只 stat 一次, scandir 返回带有大小与 mtime 的 Entry, 供 load_concept 等直接使用
+    原地改写文件不会改变目录的 mtime, 因此 Entry 中的大小与 mtime 只在 listing_ttl 秒内有效, 之后重新扫描
+  - 重新扫描时与缓存比较, 已经不存在的图片与目录删除对应的缩略图(包括内存缓存)
+  可选的后台监视(watcher 配置), 在外部程序(训练脚本, 文件管理器)修改 repo_dir 之后主动更新
+  - inotify: Linux 下通过 ctypes 调用 inotify, 目录变化时刷新列表, 图片被写入时删除缩略图
+  - polling: 其他系统或者网络存储上每隔 watch_interval 秒 stat 一次所有已知的目录
+  - auto: 优先使用 inotify, 不可用时使用 polling
+  以 . 开头的目录(.thumbnail, .confidence 等)与文件(临时文件)不会被监视
+  监视只维护可以重新生成的数据(目录列表与缩略图), 索引与标签仍然由各个接口自己维护
+    GET  /watcher/status   扫描与监视的状态
+    POST /watcher/rescan   重新扫描整个 repo_dir
+'''
+
+from fastapi import APIRouter, HTTPException
+from .config import CONF_REPO_DIR, CONF_WATCHER, CONF_WATCH_INTERVAL, CONF_LISTING_TTL
+from . import importer
+from . import thumbnail
+from . import decode
+from typing import NamedTuple
+import threading
+import select
+import struct
+import time
+import stat
+import sys
+import os
+
+
+api_watcher = APIRouter()
+
+DEBOUNCE = 0.2     # 合并短时间内的多个事件
+RACY_WINDOW = 2.0  # 秒, 覆盖 FAT(2 秒)与 SMB/NFS 的时间戳精度
+
+
+def _key(dir: str) -> str:
+  if os.path.isabs(dir):
+    dir = os.path.relpath(dir, CONF_REPO_DIR)
+  dir = os.path.normpath(dir).replace('\\', '/')
+  return '' if dir == '.' else dir
+
+def _join(dir: str, name: str) -> str:
+  return f'{dir}/{name}' if dir else name
+
+def _is_image(name: str) -> bool:
+  return os.path.splitext(name)[1].lower() in importer.IMAGE_EXTENSIONS
+
+
+class Entry(NamedTuple):
+  is_dir: bool
+  size: int
+  mtime_ns: int
+
+
+class _Listing(NamedTuple):
+  mtime: int                  # 目录的 mtime_ns
+  scanned: float              # 扫描的时间(time.monotonic)
+  racy: bool                  # 目录的 mtime 离扫描时间太近, 之后同一个时间戳内的修改无法发现
+  names: dict[str, bool]      # { name: is_dir }
+  entries: dict[str, Entry]
+
+
+_listings: dict[str, _Listing] = {}
+_listings_lock = threading.Lock()
+_stats = {
+  'listings': 0,           # 重新扫描目录的次数
+  'events': 0,             # 处理的文件系统事件数量
+  'thumbnails_removed': 0, # 因为图片被外部删除或者修改而删除的缩略图数量
+  'last_event': None,
+  'last_scan': None,
+}
+
+
+def _scan(dir: str) -> _Listing:
+  abs_dir = os.path.join(CONF_REPO_DIR, dir)
+  # 先读取 mtime 再扫描, 扫描期间发生的变化会在下次读取时发现
+  mtime = os.stat(abs_dir).st_mtime_ns
+  scanned = time.monotonic()
+  entries = {}
+  with os.scandir(abs_dir) as it:
+    for entry in it:
+      try:
+        st = entry.stat()
+      except OSError:
+        # 失效的符号链接, 或者扫描期间被删除
+        continue
+      entries[entry.name] = Entry(stat.S_ISDIR(st.st_mode), st.st_size, st.st_mtime_ns)
+  racy = time.time_ns() - mtime < RACY_WINDOW * 1e9
+  return _Listing(mtime, scanned, racy, { name: entry.is_dir for name, entry in entries.items() }, entries)
+
+
+def _remove_thumbnails(image_names: list[str], dirs: list[str]):
+  if len(image_names) > 0:
+    thumbnail.remove(image_names)
+    decode.remove(image_names)
+  for dir in dirs:
+    thumbnail.remove_dir(dir)
+    decode.remove_dir(dir)
+  _stats['thumbnails_removed'] += len(image_names) + len(dirs)
+
+
+def _forget(dir: str):
+  # 删除 dir 以及所有子目录的缓存, 调用方持有 _listings_lock
+  prefix = dir + '/'
+  for key in [key for key in _listings if key == dir or key.startswith(prefix)]:
+    del _listings[key]
+
+
+def _get(dir: str, fresh: bool) -> _Listing:
+  key = _key(dir)
+  abs_dir = os.path.join(CONF_REPO_DIR, key)
+  try:
+    mtime = os.stat(abs_dir).st_mtime_ns
+  except OSError:
+    with _listings_lock:
+      _forget(key)
+    raise FileNotFoundError(abs_dir)
+  cached = _listings.get(key)
+  if cached is not None and cached.mtime == mtime and not cached.racy and (not fresh or time.monotonic() - cached.scanned < CONF_LISTING_TTL):
+    return cached
+  listing = _scan(key)
+  with _listings_lock:
+    old = _listings.get(key)
+    _listings[key] = listing
+    removed = [name for name in old.names if name not in listing.names] if old is not None else []
+    for name in removed:
+      if old.names[name]:
+        _forget(_join(key, name))
+  _stats['listings'] += 1
+  # 图片已经不存在, 缩略图一起删除
+  removed = [name for name in removed if not name.startswith('.')]
+  _remove_thumbnails(
+    [_join(key, name) for name in removed if not old.names[name] and _is_image(name)],
+    [_join(key, name) for name in removed if old.names[name]],
+  )
+  return listing
+
+
+def listdir(dir: str) -> dict[str, bool]:
+  '''
+    dir 从 repo_dir 开始, 返回 { name: is_dir }, 目录不存在时抛出 FileNotFoundError
+    目录没有变化时返回同一个 dict, 不要修改
+  '''
+  return _get(dir, fresh=False).names
+
+
+def scandir(dir: str) -> dict[str, Entry]:
+  '''
+    与 listdir 相同, 返回 { name: Entry }, 其中的大小与 mtime 不超过 listing_ttl 秒
+  '''
+  return _get(dir, fresh=True).entries
+
+
+def _expire(dir: str):
+  # 目录中的文件被原地改写, 下次 scandir 时重新读取大小与 mtime
+  with _listings_lock:
+    cached = _listings.get(dir)
+    if cached is not None:
+      _listings[dir] = cached._replace(scanned=float('-inf'))
+
+
+def _walk(dir: str):
+  '''
+    扫描 dir 以及所有子目录, 返回所有目录
+  '''
+  dirs = [dir]
+  i = 0
+  while i < len(dirs):
+    try:
+      entries = listdir(dirs[i])
+    except FileNotFoundError:
+      entries = {}
+    dirs.extend(_join(dirs[i], name) for name, is_dir in entries.items() if is_dir and not name.startswith('.'))
+    i += 1
+  return dirs
+
+
+class _Inotify:
+  '''
+    通过 ctypes 调用 inotify, 只在 Linux 下可用
+  '''
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE = 0x00000200
+  IN_DELETE_SELF = 0x00000400
+  IN_MOVE_SELF = 0x00000800
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  IN_ONLYDIR = 0x01000000
+  IN_ISDIR = 0x40000000
+  MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+  EVENT = struct.Struct('iIII')
+
+  def __init__(self):
+    import ctypes, ctypes.util
+    self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    self._ctypes = ctypes
+    self.fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    self.dirs: dict[int, str] = {} # wd: dir
+    self.wds: dict[str, int] = {}
+
+  def add(self, dir: str):
+    if dir in self.wds:
+      return
+    wd = self._libc.inotify_add_watch(self.fd, os.path.join(CONF_REPO_DIR, dir).encode(), self.MASK)
+    if wd < 0:
+      errno = self._ctypes.get_errno()
+      # 目录在扫描之后被删除
+      if errno != 2:
+        print('inotify_add_watch', dir, os.strerror(errno))
+      return
+    self.dirs[wd] = dir
+    self.wds[dir] = wd
+
+  def discard(self, wd: int):
+    dir = self.dirs.pop(wd, None)
+    if dir is not None and self.wds.get(dir) == wd:
+      del self.wds[dir]
+
+  def read(self, timeout: float) -> list[tuple[str, int, str]]:
+    '''
+      返回 [(dir, mask, name)]
+    '''
+    readable, _, _ = select.select([self.fd], [], [], timeout)
+    if not readable:
+      return []
+    try:
+      data = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+    events = []
+    offset = 0
+    while offset + self.EVENT.size <= len(data):
+      wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+      offset += self.EVENT.size
+      name = data[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+      offset += length
+      if mask & self.IN_Q_OVERFLOW:
+        events.append((None, mask, ''))
+        continue
+      dir = self.dirs.get(wd)
+      if mask & self.IN_IGNORED:
+        self.discard(wd)
+      if dir is not None:
+        events.append((dir, mask, name))
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+
+class Watcher:
+  def __init__(self, mode: str | None, interval: float):
+    self.mode = mode
+    self.interval = interval
+    self.running = False
+    self.scanning = False
+    self.error = None
+    self._inotify = None
+    self._thread = None
+    self._stop = threading.Event()
+    self._rescan = threading.Event()
+
+  def start(self):
+    if self.mode is None or self.running:
+      return
+    mode = self.mode
+    if mode in ('auto', 'inotify'):
+      try:
+        if not sys.platform.startswith('linux'):
+          raise OSError('inotify is only available on linux')
+        self._inotify = _Inotify()
+        mode = 'inotify'
+      except Exception as e:
+        if mode == 'inotify':
+          print('fail to start inotify, fallback to polling', e)
+        mode = 'polling'
+    self.mode = mode
+    self.running = True
+    self._stop.clear()
+    self._rescan.set()
+    self._thread = threading.Thread(target=self._run, name='repo-watcher', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    if not self.running:
+      return
+    self._stop.set()
+    self._thread.join()
+    self.running = False
+    if self._inotify is not None:
+      self._inotify.close()
+      self._inotify = None
+
+  def rescan(self):
+    self._rescan.set()
+
+  def _scan_all(self):
+    self.scanning = True
+    try:
+      dirs = _walk('')
+      if self._inotify is not None:
+        for dir in dirs:
+          self._inotify.add(dir)
+      _stats['last_scan'] = time.time()
+    finally:
+      self.scanning = False
+
+  def _run(self):
+    while not self._stop.is_set():
+      try:
+        if self._rescan.is_set():
+          self._rescan.clear()
+          self._scan_all()
+        if self._inotify is not None:
+          self._process(self._inotify.read(timeout=1.0))
+        else:
+          self._stop.wait(self.interval)
+          self._poll()
+        self.error = None
+      except Exception as e:
+        self.error = str(e)
+        print('watcher', e)
+        self._stop.wait(1.0)
+
+  def _poll(self):
+    # 只 stat 已知的目录, 变化的目录重新扫描, 新的子目录在扫描时加入
+    for dir in list(_listings):
+      if self._stop.is_set() or self._rescan.is_set():
+        return
+      try:
+        entries = listdir(dir)
+      except FileNotFoundError:
+        continue
+      for name, is_dir in entries.items():
+        if is_dir and not name.startswith('.') and _join(dir, name) not in _listings:
+          _walk(_join(dir, name))
+    _stats['last_scan'] = time.time()
+
+  def _process(self, events: list[tuple[str, int, str]]):
+    if len(events) <= 0:
+      return
+    # 等待一小段时间, 合并批量操作产生的大量事件
+    time.sleep(DEBOUNCE)
+    events.extend(self._inotify.read(timeout=0))
+    _stats['events'] += len(events)
+    _stats['last_event'] = time.time()
+    changed_dirs = set()
+    modified = []
+    for dir, mask, name in events:
+      if dir is None:
+        # 事件队列溢出, 重新扫描所有目录
+        self._rescan.set()
+        return
+      if name.startswith('.'):
+        continue
+      if mask & (_Inotify.IN_DELETE_SELF | _Inotify.IN_MOVE_SELF):
+        changed_dirs.add(os.path.dirname(dir) if '/' in dir else '')
+        continue
+      if mask & (_Inotify.IN_CREATE | _Inotify.IN_DELETE | _Inotify.IN_MOVED_FROM | _Inotify.IN_MOVED_TO):
+        changed_dirs.add(dir)
+      if mask & _Inotify.IN_ISDIR and mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO):
+        for sub_dir in _walk(_join(dir, name)):
+          self._inotify.add(sub_dir)
+      elif mask & _Inotify.IN_CLOSE_WRITE and _is_image(name):
+        # 图片被外部程序改写, 缩略图已经过期
+        modified.append(_join(dir, name))
+        _expire(dir)
+    for dir in changed_dirs:
+      try:
+        listdir(dir)
+      except FileNotFoundError:
+        pass
+    _remove_thumbnails(modified, [])
+
+  def status(self) -> dict:
+    return {
+      'mode': self.mode,
+      'running': self.running,
+      'scanning': self.scanning,
+      'error': self.error,
+      'watched_dirs': len(self._inotify.wds) if self._inotify is not None else None,
+      'cached_dirs': len(_listings),
+      **_stats,
+    }
+
+
+watcher = Watcher(CONF_WATCHER, CONF_WATCH_INTERVAL)
+
+
+@api_watcher.get('/status')
+async def watcher_status():
+  '''
+    {
+      mode: 'inotify' | 'polling' | null, running, scanning, error,
+      watched_dirs, cached_dirs, listings, events, thumbnails_removed, last_event, last_scan
+    }
+  '''
+  return watcher.status()
+
+@api_watcher.post('/rescan')
+async def watcher_rescan():
+  if not watcher.running:
+    raise HTTPException(status_code=400, detail='watcher is not enabled')
+  watcher.rescan()
+  return watcher.status()
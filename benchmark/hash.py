@@ -0,0 +1,111 @@
+'''
+  预览图 hash 与原图 hash 的一致性
+
+  similarity.preview_hash 使用解码缓存中的预览图(短边 448, 透明部分合成到白色背景上)计算 hash,
+  原来的方式直接使用原图计算(索引中 hash_version 为 1)
+  在临时目录中生成一批图片(平滑的渐变与色块, 部分带有透明通道), 分别用两种方式计算,
+  对每一种 hash 统计 1 - 汉明距离 / 位数 的平均值与最小值, 并单独统计带有透明通道的图片
+
+  python benchmark/hash.py --images 200
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+
+KINDS = ['phash', 'ahash', 'dhash', 'whash']
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='preview hash agreement benchmark')
+  parser.add_argument('--images', type=int, default=200)
+  parser.add_argument('--size', type=int, default=1536, help='测试图片的最大边长, 需要大于 448 才会缩小')
+  return parser.parse_args()
+
+
+def make_images(work_dir: str, count: int, size: int) -> list[tuple[str, bool]]:
+  import numpy as np
+  from PIL import Image, ImageDraw
+  rng = np.random.default_rng(0)
+  paths = []
+  for i in range(count):
+    width, height = (int(v) for v in rng.integers(size // 2, size, 2))
+    # 渐变背景加上随机的色块, 接近照片与插画的低频结构
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([(x * rng.uniform(0.1, 0.3) + y * rng.uniform(0.1, 0.3) + rng.uniform(0, 255)) % 256 for _ in range(3)], -1)
+    img = Image.fromarray(base.astype(np.uint8))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+      x0, y0 = int(rng.integers(0, width)), int(rng.integers(0, height))
+      x1, y1 = x0 + int(rng.integers(20, width // 2)), y0 + int(rng.integers(20, height // 2))
+      draw.ellipse((x0, y0, x1, y1), fill=tuple(int(v) for v in rng.integers(0, 255, 3)))
+    alpha = i % 3 == 0
+    if alpha:
+      mask = Image.new('L', img.size, 0)
+      ImageDraw.Draw(mask).ellipse((width // 8, height // 8, width * 7 // 8, height * 7 // 8), fill=255)
+      img.putalpha(mask)
+    path = os.path.join(work_dir, f'{i:06d}.png')
+    img.save(path, 'PNG')
+    paths.append((path, alpha))
+  return paths
+
+
+def original_hash(abs_path: str) -> dict[str, str]:
+  # hash_version 1: 与 user-021 之前的 similarity.image_hash 相同, 直接使用原图
+  import imagehash
+  from PIL import Image
+  with Image.open(abs_path) as image:
+    image.load()
+    return {
+      'phash': str(imagehash.phash(image, hash_size=32, highfreq_factor=4)),
+      'ahash': str(imagehash.average_hash(image, hash_size=32)),
+      'dhash': str(imagehash.dhash(image, hash_size=32)),
+      'whash': str(imagehash.whash(image, image_scale=64, hash_size=32, mode='db4')),
+    }
+
+
+def similarity(a: str, b: str) -> float:
+  import imagehash
+  a, b = imagehash.hex_to_hash(a), imagehash.hex_to_hash(b)
+  return 1 - (a - b) / a.hash.size
+
+
+def report(name: str, pairs: list[tuple[dict, dict]]):
+  if len(pairs) <= 0:
+    return
+  print(f'{name} ({len(pairs)} images)')
+  for kind in KINDS:
+    values = [similarity(a[kind], b[kind]) for a, b in pairs]
+    print(f'  {kind}  mean {sum(values) / len(values):.4f}  min {min(values):.4f}')
+  best = [max(similarity(a[kind], b[kind]) for kind in KINDS) for a, b in pairs]
+  print(f'  max over kinds (用于相似度判断)  mean {sum(best) / len(best):.4f}  min {min(best):.4f}')
+
+
+def main():
+  args = parse_args()
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  work_dir = tempfile.mkdtemp(prefix='imageset-benchmark-')
+  # config.yaml 从当前目录读取, 在临时目录中启动, 不影响真实的 repo_dir
+  with open(os.path.join(work_dir, 'config.yaml'), 'w', encoding='utf-8') as f:
+    f.write(f"repo_dir: '{os.path.join(work_dir, 'repo')}'\n")
+  os.chdir(work_dir)
+  sys.path.insert(0, root)
+
+  try:
+    print(f'generating {args.images} images in {work_dir}')
+    paths = make_images(work_dir, args.images, args.size)
+
+    from api import decode, similarity as sim
+    pairs = [(original_hash(path), sim.preview_hash(decode.decode(path)), alpha) for path, alpha in paths]
+    report('opaque', [(a, b) for a, b, alpha in pairs if not alpha])
+    report('alpha', [(a, b) for a, b, alpha in pairs if alpha])
+  finally:
+    os.chdir(root)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,105 @@
+'''
+  读取图片宽高的速度
+
+  在临时目录中生成一个概念(默认 10000 张, JPEG, PNG, WebP, GIF, BMP, TIFF 混合, JPEG 带有较大的 exif 与 icc),
+  分别测量
+    pil          原来的方式, 逐个 Image.open 读取 size
+    probe        只解析文件头, 单线程
+    probe batch  probe.image_sizes, 线程池并行
+    catalog      第一次 load_concept 时 catalog.get_images_info 建立索引的耗时
+  并检查 probe 的结果与 Image.open 一致
+
+  python benchmark/probe.py --images 10000
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+FORMATS = [('jpg', 'JPEG'), ('png', 'PNG'), ('webp', 'WEBP'), ('gif', 'GIF'), ('bmp', 'BMP'), ('tif', 'TIFF')]
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='image header probe benchmark')
+  parser.add_argument('--images', type=int, default=10000)
+  parser.add_argument('--size', type=int, default=256, help='测试图片的最大边长, 只影响生成的速度与文件大小')
+  return parser.parse_args()
+
+
+def make_images(repo_dir: str, count: int, size: int) -> list[str]:
+  import numpy as np
+  from PIL import Image
+  concept_dir = os.path.join('imageset-benchmark', 'src', '1_benchmark')
+  os.makedirs(os.path.join(repo_dir, concept_dir))
+  rng = np.random.default_rng(0)
+  # 相机或者编辑软件导出的 JPEG 通常在 SOF 之前带有几十 KB 的 exif 与 icc
+  exif = Image.Exif()
+  exif[0x010F] = 'benchmark'
+  exif[0x9286] = 'x' * 30000
+  icc = bytes(3000)
+  paths = []
+  for i in range(count):
+    ext, format = FORMATS[i % len(FORMATS)]
+    width, height = (int(v) for v in rng.integers(size // 4, size, 2))
+    img = Image.new('RGB', (width, height), tuple(int(v) for v in rng.integers(0, 255, 3)))
+    path = os.path.join(concept_dir, f'{i:06d}.{ext}').replace('\\', '/')
+    if format == 'JPEG':
+      img.save(os.path.join(repo_dir, path), format, exif=exif, icc_profile=icc)
+    else:
+      img.save(os.path.join(repo_dir, path), format)
+    paths.append(path)
+  return paths
+
+
+def timed(name: str, count: int, fn):
+  start = time.perf_counter()
+  result = fn()
+  elapsed = time.perf_counter() - start
+  print(f'{name:<12} {count / elapsed:10.1f} images/s  {elapsed:7.3f}s')
+  return result
+
+
+def main():
+  args = parse_args()
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  work_dir = tempfile.mkdtemp(prefix='imageset-benchmark-')
+  repo_dir = os.path.join(work_dir, 'repo')
+  # config.yaml 从当前目录读取, 在临时目录中启动, 不影响真实的 repo_dir
+  with open(os.path.join(work_dir, 'config.yaml'), 'w', encoding='utf-8') as f:
+    f.write(f"repo_dir: '{repo_dir}'\n")
+  os.chdir(work_dir)
+  sys.path.insert(0, root)
+
+  try:
+    print(f'generating {args.images} images in {repo_dir}')
+    paths = make_images(repo_dir, args.images, args.size)
+    abs_paths = [os.path.join(repo_dir, path) for path in paths]
+
+    from PIL import Image
+    from api import probe, catalog
+
+    def pil():
+      sizes = []
+      for abs_path in abs_paths:
+        with Image.open(abs_path) as img:
+          sizes.append((img.width, img.height, img.format))
+      return sizes
+
+    expected = timed('pil', len(paths), pil)
+    single = timed('probe', len(paths), lambda: [probe.probe(abs_path) for abs_path in abs_paths])
+    batch = timed('probe batch', len(paths), lambda: probe.image_sizes(abs_paths))
+    timed('catalog', len(paths), lambda: catalog.get_images_info(paths))
+
+    mismatched = [path for path, a, b, c in zip(paths, expected, single, batch) if not (a == b == c)]
+    print(f'mismatched {len(mismatched)}', mismatched[:5])
+  finally:
+    os.chdir(root)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,166 @@
+'''
+  并发获取缩略图的吞吐量
+
+  在临时目录中生成测试图片, 启动服务之后并发请求缩略图, 分别测量
+    cold         缩略图不存在, 需要解码原图并生成
+    warm         缩略图已经生成
+    conditional  带 If-None-Match, 返回 304
+  同时每隔 10ms 请求一次 /job/ 统计延迟, 用于观察事件循环是否被文件访问阻塞
+  --stat-latency 在每次 stat 之前等待指定的秒数, 模拟位于网络存储上的 repo_dir
+
+  python benchmark/thumbnail.py --images 500 --concurrency 32 --stat-latency 0.02
+'''
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='concurrent thumbnail fetch benchmark')
+  parser.add_argument('--images', type=int, default=300)
+  parser.add_argument('--size', type=int, default=1024, help='测试图片的边长')
+  parser.add_argument('--concurrency', type=int, default=32)
+  parser.add_argument('--stat-latency', type=float, default=0.0, help='每次 stat 额外等待的秒数')
+  return parser.parse_args()
+
+
+def make_images(repo_dir: str, count: int, size: int) -> list[str]:
+  import numpy as np
+  from PIL import Image
+  concept_dir = os.path.join('imageset-benchmark', 'src', '1_benchmark')
+  os.makedirs(os.path.join(repo_dir, concept_dir))
+  rng = np.random.default_rng(0)
+  # 低频的随机图案, 编码之后的大小与真实图片接近
+  base = rng.integers(0, 255, (size // 32, size // 32, 3), dtype=np.uint8)
+  paths = []
+  for i in range(count):
+    img = Image.fromarray(np.roll(base, i, axis=0)).resize((size, size), Image.Resampling.BILINEAR)
+    path = os.path.join(concept_dir, f'{i:06d}.jpg').replace('\\', '/')
+    img.save(os.path.join(repo_dir, path), quality=90)
+    paths.append(path)
+  return paths
+
+
+def free_port() -> int:
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def start_server(port: int):
+  import uvicorn
+  import launch
+  server = uvicorn.Server(uvicorn.Config(launch.app, host='127.0.0.1', port=port, log_level='warning'))
+  thread = threading.Thread(target=server.run, daemon=True)
+  thread.start()
+  while not server.started:
+    time.sleep(0.05)
+  return server
+
+
+async def probe(client, stop: asyncio.Event) -> list[float]:
+  '''
+    请求一个不访问文件系统的接口, 返回每次的延迟
+  '''
+  latencies = []
+  while not stop.is_set():
+    start = time.perf_counter()
+    await client.get('/job/')
+    latencies.append(time.perf_counter() - start)
+    await asyncio.sleep(0.01)
+  return latencies
+
+
+async def fetch_all(client, urls: list[str], concurrency: int, headers: dict[str, str] | None = None) -> tuple[float, dict[int, int], dict[str, str]]:
+  queue = list(reversed(urls))
+  statuses, etags = {}, {}
+
+  async def worker():
+    while queue:
+      url = queue.pop()
+      response = await client.get(url, headers={ 'If-None-Match': headers[url] } if headers else None)
+      statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+      if 'etag' in response.headers:
+        etags[url] = response.headers['etag']
+
+  start = time.perf_counter()
+  await asyncio.gather(*(worker() for _ in range(concurrency)))
+  return time.perf_counter() - start, statuses, etags
+
+
+def percentile(values: list[float], p: float) -> float:
+  if len(values) <= 0:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run(args, port: int, paths: list[str]):
+  import httpx
+  urls = [f'/image/thumbnail/{path}' for path in paths]
+  limits = httpx.Limits(max_connections=args.concurrency + 1)
+  base_url = f'http://127.0.0.1:{port}'
+  # 探测延迟使用单独的连接, 不与缩略图请求排队
+  async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client, httpx.AsyncClient(base_url=base_url) as probe_client:
+    etags = {}
+    for name in ('cold', 'warm', 'conditional'):
+      stop = asyncio.Event()
+      probe_task = asyncio.create_task(probe(probe_client, stop))
+      elapsed, statuses, fetched = await fetch_all(client, urls, args.concurrency, etags if name == 'conditional' else None)
+      etags.update(fetched)
+      stop.set()
+      latencies = await probe_task
+      print(
+        f'{name:<12} {len(urls) / elapsed:8.1f} req/s  {elapsed:6.2f}s  status {statuses}  '
+        f'probe p50 {percentile(latencies, 0.5) * 1000:6.1f}ms p99 {percentile(latencies, 0.99) * 1000:6.1f}ms'
+      )
+
+
+def main():
+  args = parse_args()
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  work_dir = tempfile.mkdtemp(prefix='imageset-benchmark-')
+  repo_dir = os.path.join(work_dir, 'repo')
+  # config.yaml 从当前目录读取, 在临时目录中启动, 不影响真实的 repo_dir
+  with open(os.path.join(work_dir, 'config.yaml'), 'w', encoding='utf-8') as f:
+    f.write(f"repo_dir: '{repo_dir}'\n")
+  os.chdir(work_dir)
+  sys.path.insert(0, root)
+
+  print(f'generating {args.images} images in {repo_dir}')
+  paths = make_images(repo_dir, args.images, args.size)
+
+  if args.stat_latency > 0:
+    from api import serving
+    stat_file = serving._stat_file
+    def slow_stat_file(path):
+      time.sleep(args.stat_latency)
+      return stat_file(path)
+    serving._stat_file = slow_stat_file
+    # 缩略图接口通过 catalog 读取原图内容的版本, 其中同样会 stat 原图
+    from api import thumbnail
+    content_version = thumbnail.content_version
+    def slow_content_version(image_name):
+      time.sleep(args.stat_latency)
+      return content_version(image_name)
+    thumbnail.content_version = slow_content_version
+
+  port = free_port()
+  server = start_server(port)
+  try:
+    asyncio.run(run(args, port, paths))
+  finally:
+    server.should_exit = True
+    os.chdir(root)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -17,6 +17,12 @@ app = FastAPI()
 from api.image import api_image
 from api.imageset import api_imageset
 from api.tag import api_tag
+from api.job import api_job
+from api.caption import api_caption, flush as flush_captions, start as start_caption_writer
+from api.tagger import model_manager
+from api.config import CONF_TAGGER_PRELOAD
+from api.watcher import api_watcher, watcher
+from api.upload import api_upload, shutdown as shutdown_uploads
 
 # 定义允许的来源, 发布的时候可以注释掉,
 origins = [
@@ -41,6 +47,26 @@ app.add_middleware(
 app.include_router(api_image, prefix="/image", tags=['图片接口'])
 app.include_router(api_imageset, prefix="/imageset", tags=["数据集接口"])  
 app.include_router(api_tag, prefix="/tag", tags=["标签"])
+app.include_router(api_job, prefix="/job", tags=["后台任务"])
+app.include_router(api_caption, prefix="/caption", tags=["标签存储"])
+app.include_router(api_watcher, prefix="/watcher", tags=["文件监视"])
+app.include_router(api_upload, prefix="/upload", tags=["上传"])
+
+@app.on_event("startup")
+async def startup():
+  # 在后台预先下载并加载配置的打标模型
+  model_manager.preload(CONF_TAGGER_PRELOAD)
+  # 监视 repo_dir 的外部修改
+  watcher.start()
+  # 在后台写回保存的标签
+  start_caption_writer()
+
+@app.on_event("shutdown")
+async def shutdown():
+  watcher.stop()
+  shutdown_uploads()
+  # 退出前写回还没有写入文件的标签
+  flush_captions()
 
 @app.get('/web/{path:path}')
 async def web_handler(path: str):
@@ -55,6 +81,9 @@ async def index():
 
 
 if __name__ == "__main__":
+  # 打包之后使用多进程(计算图片 hash 等)需要先调用 freeze_support
+  import multiprocessing
+  multiprocessing.freeze_support()
   import argparse
   parser = argparse.ArgumentParser(description="imageset editor")
   parser.add_argument('--reload', action='store_true')
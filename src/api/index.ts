@@ -15,11 +15,37 @@ const host = window.api_host || 'localhost';
 // 设置后端路径
 axios.defaults.baseURL = `http://${host}:${port}`;
 
-async function flip_images(images: ImageState[], horizontal: boolean) {
-  await axios.put("/image/flip", { 
+// 翻转, 旋转, 裁剪与放大返回每张图片的处理结果
+export interface TransformResult {
+  status: 'transformed' | 'skipped' | 'failed',
+  error: string | null,
+  lossless: boolean,
+};
+
+export type TransformReport = { [path: string]: TransformResult };
+
+// 处理失败的图片的提示, 全部成功时返回 null
+export function transform_failures(report: TransformReport): string | null {
+  const failed = Object.entries(report).filter(([_, result]) => result.status === 'failed');
+  if (failed.length <= 0) {
+    return null;
+  }
+  return `${failed.length} images failed: ${failed.map(([path, result]) => `${path.split('/').pop()} (${result.error})`).join(', ')}`;
+}
+
+async function flip_images(images: ImageState[], horizontal: boolean): Promise<TransformReport> {
+  return (await axios.put("/image/flip", { 
     images: images.map(image => image.path),
     horizontal,
-  });
+  })).data;
+}
+
+async function rotate_images(images: ImageState[], degrees: 90 | 180 | 270): Promise<TransformReport> {
+  // 顺时针旋转
+  return (await axios.put("/image/rotate", {
+    images: images.map(image => image.path),
+    degrees,
+  })).data;
 }
 
 async function delete_imageset(imageset_name: string) {
@@ -62,28 +88,88 @@ async function rename_concept(imageset_name: string,
 }
 
 type Metadata = { train: ImageSetMetadata, regular: ImageSetMetadata };
-async function get_imageset_metadata(name: string): Promise<Metadata> {
-  let result: Metadata = (await axios.get("/imageset/metadata", { params: { name } })).data
+async function get_imageset_metadata(name: string, refresh_cover: boolean = false): Promise<Metadata> {
+  // 封面保持不变, refresh_cover 为 true 时重新随机选择
+  let result: Metadata = (await axios.get("/imageset/metadata", { params: { name, refresh_cover } })).data
   return result;
 }
 
+// 从目录导入图片的结果, status 为 imported(重新编码), copied(直接复制), skipped(不支持的扩展名) 或者 failed
+export interface ImportReport {
+  imported: number,
+  skipped: number,
+  failed: number,
+  files: { source: string, target: string | null, status: 'imported' | 'copied' | 'skipped' | 'failed', error: string | null }[],
+};
+
 async function add_concept(
   imageset_name: string,
   concept_name: string,
   repeat: number,
   type: 'train' | 'regular',
   load_directory: string,
-) {
-  let result: number = (await axios.post("/imageset/add_concept", {}, {
+): Promise<ImportReport> {
+  return (await axios.post("/imageset/add_concept", {}, {
     params: { imageset_name, concept_name, repeat, type, load_directory: load_directory.trim() }
   })).data;
-  return result;
 }
 
 async function load_concept(imageset_name: string, is_regular: boolean, concept_name: string, repeat: number): Promise<ConceptState> {
   return (await axios.get("/imageset/load_concept", { params: { imageset_name, is_regular, concept_name, repeat } })).data;
 }
 
+// 以 ndjson 流的方式加载 concept, 每收到一批图片就回调一次, 方便首屏尽快渲染
+async function load_concept_stream(
+  imageset_name: string, 
+  is_regular: boolean, 
+  concept_name: string, 
+  repeat: number,
+  onProgress: (concept: ConceptState, images: ImageState[]) => void,
+): Promise<ConceptState> {
+  const params = new URLSearchParams({ 
+    imageset_name, is_regular: `${is_regular}`, concept_name, repeat: `${repeat}`, stream: 'true' 
+  });
+  const response = await fetch(`${axios.defaults.baseURL}/imageset/load_concept?${params}`);
+  if (!response.ok || !response.body) {
+    throw new Error(`${response.status} ${await response.text()}`);
+  }
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let concept: ConceptState | null = null;
+  let images: ImageState[] = [];
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop() || '';
+    const received: ImageState[] = [];
+    for (const line of lines) {
+      if (line.trim().length <= 0) {
+        continue;
+      }
+      if (concept === null) {
+        // 第一行是 concept 的信息
+        concept = { ...JSON.parse(line), images: [] };
+      } else {
+        received.push(JSON.parse(line));
+      }
+    }
+    if (concept !== null && received.length > 0) {
+      // 只传递新收到的图片, 避免每次复制整个列表
+      images.push(...received);
+      onProgress(concept, received);
+    }
+  }
+  if (concept === null) {
+    throw new Error(`fail to load concept ${concept_name}`);
+  }
+  return { ...concept, images };
+}
+
 
 async function open_in_file_explore(imageset_name: string) {
   await axios.get("/imageset/open_in_file_explore", { params: { imageset_name } });
@@ -121,22 +207,115 @@ async function interrogate(
   })).data;
 }
 
-async function upload_images(files: FileWithPath[], imageset_name: string, is_regular: boolean, concept_folder: string) {
+export interface UploadFileState {
+  name: string,
+  size: number,
+  received: number,
+  status: 'pending' | 'processing' | 'done' | 'failed',
+  target: string | null,
+  error: string | null,
+};
+
+export interface UploadState {
+  id: string,
+  dest_dir: string,
+  files: UploadFileState[],
+  total: number,
+  received: number,
+  done: number,
+  failed: number,
+  finished: boolean,
+};
+
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+const UPLOAD_CONCURRENCY = 3;
+const UPLOAD_RETRIES = 5;
+
+async function upload_images(
+  files: FileWithPath[],
+  imageset_name: string,
+  is_regular: boolean,
+  concept_folder: string,
+  on_progress?: (state: UploadState) => void,
+): Promise<UploadState | undefined> {
   if(files.length <= 0) {
     return;
   }
-  
-  const form_data = new FormData();
-  files.forEach((file, index) => {
-    form_data.append("files", file, `image${index}`);
-  });
-  form_data.append("imageset_name", imageset_name);
-  form_data.append("type", is_regular ? "regular" : "train");
-  form_data.append("concept_folder", concept_folder);
 
-  return (await axios.post("/imageset/uploadimages", form_data, {
-    headers: { 'Content-Type': 'multipart/form-data' }
-  })).data;
+  // 每个文件分块上传到服务端的临时文件, 接收完整之后在服务端转换格式, 与后续文件的上传并行
+  // 同一批文件中断之后再次上传时, 从服务端记录的位置继续
+  const type = is_regular ? "regular" : "train";
+  const key = `upload:${imageset_name}/${type}/${concept_folder}`;
+  const signature = files.map(file => `${file.name}:${file.size}:${file.lastModified}`).join('|');
+  const saved = JSON.parse(localStorage.getItem(key) || 'null');
+  let state: UploadState | null = null;
+  if (saved?.signature === signature) {
+    state = (await axios.get(`/upload/${saved.id}`).catch(() => null))?.data ?? null;
+  }
+  if (state === null) {
+    state = (await axios.post("/upload/", {
+      imageset_name, type, concept_folder,
+      files: files.map(file => ({ name: file.name, size: file.size })),
+    })).data as UploadState;
+    localStorage.setItem(key, JSON.stringify({ id: state.id, signature }));
+  }
+  const id = state.id;
+  let current: UploadState = state;
+
+  function report(index: number, file: UploadFileState) {
+    const files = current.files.map((f, i) => i === index ? file : f);
+    current = {
+      ...current, files,
+      received: files.reduce((sum, f) => sum + f.received, 0),
+      done: files.filter(f => f.status === 'done').length,
+      failed: files.filter(f => f.status === 'failed').length,
+    };
+    on_progress?.(current);
+  }
+
+  async function upload_file(index: number) {
+    let retries = 0;
+    while (current.files[index].status === 'pending') {
+      const offset = current.files[index].received;
+      try {
+        const file: UploadFileState = (await axios.put(`/upload/${id}/${index}`, files[index].slice(offset, offset + UPLOAD_CHUNK_SIZE), {
+          params: { offset },
+          headers: { 'Content-Type': 'application/octet-stream' },
+          onUploadProgress: (event) => report(index, { ...current.files[index], received: offset + event.loaded }),
+        })).data;
+        report(index, file);
+        retries = 0;
+      } catch (err: any) {
+        if (++retries > UPLOAD_RETRIES) {
+          throw err;
+        }
+        // 连接中断或者 offset 不一致, 从服务端已经接收的位置继续
+        await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+        const state: UploadState | null = (await axios.get(`/upload/${id}`).catch(() => null))?.data ?? null;
+        if (state !== null) {
+          report(index, state.files[index]);
+        }
+      }
+    }
+  }
+
+  let next = 0;
+  await Promise.all(Array.from({ length: UPLOAD_CONCURRENCY }, async () => {
+    while (next < files.length) {
+      await upload_file(next++);
+    }
+  }));
+
+  // 等待服务端处理完剩余的文件
+  while (!current.finished) {
+    current = (await axios.get(`/upload/${id}`)).data;
+    on_progress?.(current);
+    if (!current.finished) {
+      await new Promise(resolve => setTimeout(resolve, 500));
+    }
+  }
+  localStorage.removeItem(key);
+  return current;
 }
 
 async function rename_and_convert(imageset_name: string, is_regular: boolean, concept_folder: string) {
@@ -144,9 +323,9 @@ async function rename_and_convert(imageset_name: string, is_regular: boolean, co
 }
 
 
-async function save_tags(image_captions: Map<string, string[]>) {
+async function save_tags(image_captions: Map<string, string[]>): Promise<Record<string, { status: 'saved' | 'unchanged' | 'failed', error: string | null }>> {
   const data = Object.fromEntries(image_captions);
-  await axios.put("/tag/save", { tags: data });
+  return (await axios.put("/tag/save", { tags: data })).data;
 }
 
 async function detect_similar_images(images: ImageState[], threshold: number) {
@@ -159,25 +338,25 @@ async function move_images(imageset_name: string, images:ImageState[], is_regula
   });
 }
 
-async function upscale_images(images: ImageState[], width: number, height: number) {
-  await axios.put("/image/upscale", { filenames: images.map(img => img.path), width, height });
+async function upscale_images(images: ImageState[], width: number, height: number): Promise<TransformReport> {
+  return (await axios.put("/image/upscale", { filenames: images.map(img => img.path), width, height })).data;
 }
 
 async function explore(imageset_name: string) {
-  const response = (await axios.post("/imageset/explore", {}, { params: { imageset_name }, responseType: 'blob' }));
-  const url = window.URL.createObjectURL(new Blob([response.data]));
+  // 直接由浏览器下载 zip 流, 不需要先读入内存, 中断之后浏览器可以断点续传
+  const params = new URLSearchParams({ imageset_name });
   const link = document.createElement('a');
-  link.href = url;
+  link.href = `${axios.defaults.baseURL}/imageset/explore?${params}`;
   link.setAttribute('download', `${imageset_name}.zip`); // 设置下载文件的名称
   document.body.appendChild(link);
   link.click(); // 模拟点击下载
   link.remove(); // 下载后移除链接
 }
 
-async function cut_images(images: CropperImageState[]) {
+async function cut_images(images: CropperImageState[]): Promise<TransformReport> {
   // 直接传递 percent 
   const _images = images.map(image => ({ path: image.image.path, ...image.crop}));
-  await axios.put("/image/cut", _images);
+  return (await axios.put("/image/cut", _images)).data as TransformReport;
 }
 
 const api = {
@@ -202,7 +381,9 @@ const api = {
   move_images,
   rename_concept,
   load_concept,
+  load_concept_stream,
   flip_images,
+  rotate_images,
   explore,
   upscale_images,
   // find_concept_list,
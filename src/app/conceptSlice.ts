@@ -71,6 +71,27 @@ export const conceptSlice = createSlice({
       state.filters = filters;
     },
 
+    // 流式加载时追加收到的一批图片, 只更新 [all], 不修改已有的 selection
+    // 全部收到之后需要再以完整的列表调用 loadConcept
+    appendImages: (state, action: PayloadAction<{ concept: ConceptState, images: ImageState[], reset: boolean }>) => {
+      const { concept, images, reset } = action.payload;
+      const same = state.name === concept.name
+        && state.is_regular === concept.is_regular
+        && state.repeat === concept.repeat
+        && state.imageset_name === concept.imageset_name;
+      if (reset) {
+        state.images = images;
+      } else {
+        state.images.push(...images);
+      }
+      state.name = concept.name;
+      state.is_regular = concept.is_regular;
+      state.imageset_name = concept.imageset_name;
+      state.repeat = concept.repeat;
+      const selections = same ? state.filters.filter(filter => filter.name !== '[all]') : [];
+      state.filters = [{ name: '[all]', images: state.images }, ...selections];
+    },
+
     addFilter: (state, action: PayloadAction<FilterState>) => {
       const filters = state.filters.filter(filter => filter.name !== action.payload.name);
       state.filters = [...filters, action.payload];
@@ -88,5 +109,5 @@ export const conceptSlice = createSlice({
 
 
 export default conceptSlice.reducer;
-export const { loadConcept, addFilter, removeFilter, updateImages } = conceptSlice.actions;
+export const { loadConcept, appendImages, addFilter, removeFilter, updateImages } = conceptSlice.actions;
 
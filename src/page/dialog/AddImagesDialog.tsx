@@ -1,5 +1,5 @@
 
-import { Backdrop, Button, IconButton, ImageList, ImageListItem, CircularProgress, Dialog, DialogActions, DialogContent, DialogTitle } from "@mui/material";
+import { Button, IconButton, ImageList, ImageListItem, Dialog, DialogActions, DialogContent, DialogTitle, LinearProgress, Typography } from "@mui/material";
 import { Group, Text } from '@mantine/core';
 import { Dropzone, DropzoneProps, FileWithPath, IMAGE_MIME_TYPE } from '@mantine/dropzone';
 import CloudUploadIcon from '@mui/icons-material/CloudUpload';
@@ -7,7 +7,7 @@ import ImageIcon from '@mui/icons-material/Image';
 import ErrorIcon from '@mui/icons-material/Error';
 import { useState } from 'react';
 import { CloseOutlined } from '@mui/icons-material';
-import api from '../../api';
+import api, { UploadState } from '../../api';
 import { useDispatch } from "react-redux";
 import { addMessage } from "../../app/messageSlice";
 import { exception2string } from "../../utils";
@@ -96,17 +96,31 @@ function AddImageDialog(props: addImageDialogProps) {
   const dispatch = useDispatch();
   const [loading, setLoading] = useState(false);
   const [files, setFiles] = useState<FileWithPath[]>([]);
+  const [progress, setProgress] = useState<UploadState | null>(null);
 
   return (<><Dialog open={props.open} onClose={props.onClose}>
     <DialogTitle>Add images for <b>{props.concept_folder}</b></DialogTitle>
     <DialogContent>
       <ImageUploader preview onChange={(files) => setFiles(files)}></ImageUploader>
+      {
+        loading && progress !== null ? <>
+          <LinearProgress variant="determinate" value={progress.total > 0 ? progress.received / progress.total * 100 : 100} sx={{ marginTop: 2 }} />
+          <Typography variant="body2" color="text.secondary">
+            {progress.done} / {progress.files.length} done{progress.failed > 0 ? `, ${progress.failed} failed` : ''}
+          </Typography>
+        </> : <></>
+      }
     </DialogContent>
     <DialogActions>
       <Button onClick={() => { props.onClose() }}>Cancel</Button>
       <Button disabled={loading} onClick={() => {
         setLoading(true);
-        api.upload_images(files, props.imageset_name, props.is_regular, props.concept_folder).then((result) => {
+        setProgress(null);
+        api.upload_images(files, props.imageset_name, props.is_regular, props.concept_folder, setProgress).then((result) => {
+          if (result && result.failed > 0) {
+            const names = result.files.filter(file => file.status === 'failed').map(file => file.name);
+            dispatch(addMessage({ msg: `${result.failed} images failed: ${names.join(', ')}`, severity: 'warning' }));
+          }
           props.onSubmit?.();
         }).catch((err: any) => {
           dispatch(addMessage({ msg: exception2string(err), severity: 'error' }));
@@ -118,13 +132,6 @@ function AddImageDialog(props: addImageDialogProps) {
       </Button>
 
     </DialogActions>
-
-    <Backdrop
-      sx={(theme) => ({ color: '#fff', zIndex: theme.zIndex.drawer + 10 })}
-      open={loading}
-    >
-      <CircularProgress color="inherit" />
-    </Backdrop>
   </Dialog>
   </>);
 }
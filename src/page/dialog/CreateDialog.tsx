@@ -69,7 +69,13 @@ function CreateDialog(props: createDialogProps) {
           <Button onClick={() => { props.onClose() }}>Cancel</Button>
           <Button disabled={loading} onClick={() => {
             setLoading(true);
-            api.add_concept(props.imageset_name, conceptName, repeat, props.type, loadDirectory).then((_) => {
+            api.add_concept(props.imageset_name, conceptName, repeat, props.type, loadDirectory).then((report) => {
+              // 导入失败或者跳过的文件提示给用户
+              const problems = report.files.filter(file => file.status === 'failed' || file.status === 'skipped');
+              if (problems.length > 0) {
+                const names = problems.map(file => `${file.source.split(/[\\/]/).pop()} (${file.status}: ${file.error})`);
+                dispatch(addMessage({ msg: `${report.failed} failed, ${report.skipped} skipped: ${names.join(', ')}`, severity: 'warning' }));
+              }
               // 需要先 submit
               props.onSubmit?.();
               
@@ -2,7 +2,7 @@ import { Backdrop, Button, CircularProgress, Dialog, DialogActions, DialogConten
 import { FilterState, updateImages } from "../../app/conceptSlice";
 import { ImageState } from "../../app/imageSetSlice";
 import { useState } from "react";
-import api from "../../api";
+import api, { transform_failures } from "../../api";
 import { useDispatch } from "react-redux";
 import { addMessage } from "../../app/messageSlice";
 import { exception2string } from "../../utils";
@@ -38,7 +38,11 @@ function UpscaleDialog({
 
     const images = openImage ? [openImage] : filter.images;
     try {
-      await api.upscale_images(images, width, height);
+      const report = await api.upscale_images(images, width, height);
+      const failures = transform_failures(report);
+      if (failures) {
+        dispatch(addMessage({ msg: failures, severity: 'warning' }));
+      }
       onSubmit?.();
       dispatch(updateImages());
     } catch (err: any) {
@@ -242,7 +242,11 @@ function CaptionEditorCard({
     setLoading(true);
     // 调用保存api
     try {
-      await api.save_tags(captionState.image_captions);
+      const results = await api.save_tags(captionState.image_captions);
+      const failed = Object.entries(results).filter(([_, result]) => result.status === 'failed');
+      if (failed.length > 0) {
+        dispatch(addMessage({ msg: `fail to save ${failed.length} images: ${failed.map(([path, result]) => `${path} ${result.error}`).join(', ')}`, severity: 'error' }));
+      }
     } catch (err: any) {
       dispatch(addMessage({ msg: exception2string(err), severity: 'error' }));
       setLoading(false);
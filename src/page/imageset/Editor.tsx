@@ -22,7 +22,7 @@ import { useSelector } from "react-redux";
 import { useEffect, useState } from "react";
 import { useDispatch } from "react-redux";
 import { addFilter, FilterState, loadConcept, removeFilter, updateImages } from "../../app/conceptSlice";
-import api from "../../api";
+import api, { transform_failures } from "../../api";
 import CreateDialog from "../dialog/CreateDialog";
 import AddImageDialog from "../dialog/AddImagesDialog";
 import TaggerDialog from "../dialog/TaggerDialog";
@@ -104,7 +104,11 @@ function Tool({
     }
 
     try {
-      await api.flip_images(images, horizontal);
+      const report = await api.flip_images(images, horizontal);
+      const failures = transform_failures(report);
+      if (failures) {
+        dispatch(addMessage({ msg: failures, severity: 'warning' }));
+      }
       await reload();
     } catch (err: any) {
       dispatch(addMessage({ msg: exception2string(err), severity: 'error' }));
@@ -22,9 +22,9 @@ import 'react-image-crop/dist/ReactCrop.css';
 import { useEffect, useRef, useState } from "react";
 import { useNavigate, useParams } from "react-router-dom";
 import { selectFilterNameList } from "./Editor";
-import { FilterState, updateImages } from "../../app/conceptSlice";
+import { FilterState, loadConcept, updateImages } from "../../app/conceptSlice";
 import { Close } from "@mui/icons-material";
-import api from "../../api";
+import api, { transform_failures } from "../../api";
 import { useDispatch } from "react-redux";
 import { addMessage } from "../../app/messageSlice";
 import { exception2string } from "../../utils";
@@ -74,7 +74,6 @@ function CropperEditor({
   }, [filters, filter_name]);
 
 
-  const timestamp = useSelector((state: RootState) => state.concept.time);
 
 
   function CropperItem({ image, aspect }: { image: CropperImageState, aspect?: number | undefined }) {
@@ -129,7 +128,7 @@ function CropperEditor({
           <img
             ref={imgRef}
             alt="Crop me"
-            src={`${image.image.thumbnail}?t=${timestamp}`}
+            src={`${image.image.thumbnail}`}
             onLoad={onImageLoad}
           />
           {/* 能否添加一个按钮 */}
@@ -179,7 +178,14 @@ function CropperEditor({
     if (response) {
       setLoading(true);
       try {
-        await api.cut_images(currentFilter.images.filter(image => image.crop));
+        const report = await api.cut_images(currentFilter.images.filter(image => image.crop));
+        const failures = transform_failures(report);
+        if (failures) {
+          dispatch(addMessage({ msg: failures, severity: 'warning' }));
+        }
+        // 缩略图的地址带有图片的版本号, 需要重新加载才能显示修改之后的图片
+        const result = await api.load_concept(imageset_name, is_regular, concept_name, repeat);
+        dispatch(loadConcept(result));
       } catch(err: any) {
         dispatch(addMessage({msg: exception2string(err), severity: 'error'}));
       }
@@ -44,7 +44,7 @@ function ImageGallery({
       <>
         <ImageListItem key={props.image.path}
         >
-          <img alt="fail to load" src={`${props.image.thumbnail}?t=${timestamp}`} // 显示缩略图算了
+          <img alt="fail to load" src={`${props.image.thumbnail}`} // 显示缩略图算了
             onMouseEnter={() => setHovered(true)}
             onMouseLeave={() => setHovered(false)}
             loading="lazy"
@@ -4,7 +4,7 @@ import api from "../../api";
 import { Backdrop, CircularProgress, Toolbar } from "@mui/material";
 import { useEffect, useState } from "react";
 import { useDispatch } from "react-redux";
-import { loadConcept } from "../../app/conceptSlice";
+import { appendImages, loadConcept } from "../../app/conceptSlice";
 import Editor from "./Editor";
 import CaptionEditor from "./CaptionEditor";
 import SimilarImageEditor from "./SimilarImageEditor";
@@ -82,7 +82,14 @@ function ImageSet() {
     // 加载
     setLoading(true);
     try {
-      const result = await api.load_concept(imageset_name, is_regular, concept_name, repeat);
+      // 收到第一批图片之后就可以关闭加载动画, 剩余的图片继续流式加载
+      // 加载过程中只追加图片, 全部收到之后再以完整的列表更新 selection
+      let reset = true;
+      const result = await api.load_concept_stream(imageset_name, is_regular, concept_name, repeat, (concept, images) => {
+        dispatch(appendImages({ concept, images, reset }));
+        reset = false;
+        setLoading(false);
+      });
       dispatch(loadConcept(result));
       const { train, regular } = await api.get_imageset_metadata(imageset_name);
       const imageset: ImageSetState = { 
@@ -143,7 +143,7 @@ function SelectionEditor({
     return (
       <ImageListItem key={props.image.image.path}
       >
-        <img src={`${props.image.image.thumbnail}?t=${timestamp}`} // 显示缩略图算了
+        <img src={`${props.image.image.thumbnail}`} // 显示缩略图算了
           alt={props.image.image.filename}
           onMouseEnter={() => setHovered(true)}
           onMouseLeave={() => setHovered(false)}
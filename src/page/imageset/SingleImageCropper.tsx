@@ -13,11 +13,11 @@ import ReactCrop, {
 import 'react-image-crop/dist/ReactCrop.css';
 import { useEffect, useRef, useState } from "react";
 import { useNavigate } from "react-router-dom";
-import { updateImages } from "../../app/conceptSlice";
+import { loadConcept, updateImages } from "../../app/conceptSlice";
 import { useDispatch } from "react-redux";
 import { addMessage } from "../../app/messageSlice";
 import { exception2string } from "../../utils";
-import api from "../../api";
+import api, { transform_failures } from "../../api";
 import { closeImage } from "../../app/openImageSlice";
 
 
@@ -93,7 +93,14 @@ function SingleCropperEditor({
 
       if (image && crop) {
         try {
-          await api.cut_images([{ image, crop: { ...crop, unit: '%' } }]);
+          const report = await api.cut_images([{ image, crop: { ...crop, unit: '%' } }]);
+          const failures = transform_failures(report);
+          if (failures) {
+            dispatch(addMessage({ msg: failures, severity: 'warning' }));
+          }
+          // 缩略图的地址带有图片的版本号, 需要重新加载才能显示修改之后的图片
+          const result = await api.load_concept(imageset_name, is_regular, concept_name, repeat);
+          dispatch(loadConcept(result));
         } catch (err: any) {
           dispatch(addMessage({ msg: exception2string(err), severity: 'error' }));
         }